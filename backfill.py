@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Save the shouts from a chat's existing history, so that the bot has something to reply with straight away.
+
+	$ ./backfill.py @some_group
+
+Bots can't read chat history, so this logs in as a user account which is in the chat (you'll be asked to log in the
+first time). It can be stopped at any point and picks up where it left off when run again.
+
+To test it without Telegram, record some history and then backfill from the recording:
+
+	$ ./backfill.py @some_group --limit 1000 --record messages.txt
+	$ ./backfill.py --fixture messages.txt
+"""
+
+import argparse
+import ast
+import asyncio
+import base64
+import logging
+import time
+
+import telethon.utils
+from telethon import TelegramClient
+from telethon.extensions import BinaryReader
+from telethon.tl import types
+
+import db
+import utils
+
+logger = logging.getLogger('backfill')
+
+async def backfill(messages, database, *, bot_id=None, batch_size=5000):
+	"""Save the shouts among messages, an async iterable of messages in ascending ID order.
+	They're saved in batches of up to batch_size messages, and each batch moves its chat's checkpoint forward,
+	so messages at or before the checkpoint are skipped. Returns (messages scanned, shouts saved).
+	"""
+	scanned = saved = 0
+	started = time.perf_counter()
+
+	chat_id = checkpoint = None
+	# (message_id, content, encoded_entities, time, user_id) of the shouts in the current batch
+	batch = []
+	batch_scanned = 0
+	last_message_id = None
+
+	async def flush():
+		nonlocal saved, batch, batch_scanned
+		if not batch_scanned:
+			return
+		saved += await database.copy_shouts(chat_id, batch, last_message_id)
+		batch = []
+		batch_scanned = 0
+		elapsed = time.perf_counter() - started
+		logger.info(
+			'%d messages scanned (%.0f/s), %d shouts saved, up to message %d of chat %d',
+			scanned, scanned / elapsed, saved, last_message_id, chat_id,
+		)
+
+	async for message in messages:
+		message_chat_id = telethon.utils.get_peer_id(message.peer_id)
+		if message_chat_id != chat_id:
+			await flush()
+			chat_id = message_chat_id
+			checkpoint = await database.backfill_checkpoint(chat_id)
+		if message.id <= checkpoint:
+			continue
+
+		scanned += 1
+		batch_scanned += 1
+		last_message_id = message.id
+		if await is_storable_shout(message, database, bot_id):
+			content, entities = db.sanitize_shout(message.message, message.entities)
+			batch.append((message.id, content, list(map(bytes, entities)), message.date, message.from_id.user_id))
+
+		if batch_scanned >= batch_size:
+			await flush()
+
+	await flush()
+	return scanned, saved
+
+async def is_storable_shout(message, database, bot_id):
+	"""whether the bot would have saved this message if it had seen it"""
+	return (
+		isinstance(message, types.Message)
+		and message.message
+		and not isinstance(message.peer_id, types.PeerUser)
+		and isinstance(message.from_id, types.PeerUser)
+		and message.from_id.user_id != bot_id
+		and utils.shout.is_shout(utils.remove_code_and_mentions(message))
+		and await database.state(telethon.utils.get_peer_id(message.peer_id), message.from_id.user_id)
+	)
+
+async def read_fixture(path):
+	"""yield each message recorded in path"""
+	with open(path) as f:
+		for line in f:
+			yield BinaryReader(base64.b64decode(line)).tgread_object()
+
+async def record(messages, path):
+	"""pass through messages, writing each one to path in the format that read_fixture reads"""
+	with open(path, 'w') as f:
+		async for message in messages:
+			f.write(base64.b64encode(bytes(message)).decode() + '\n')
+			yield message
+
+async def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('chat', nargs='?', help='username, invite link or ID of the chat to backfill')
+	parser.add_argument('--fixture', help='backfill from messages recorded with --record instead of from Telegram')
+	parser.add_argument('--record', help='also write the messages read from Telegram to this file')
+	parser.add_argument('--limit', type=int, help='read at most this many messages')
+	parser.add_argument('--batch-size', type=int, default=5000, help='messages per transaction (default: %(default)s)')
+	parser.add_argument('--session', default='backfill', help='session name of the user account (default: %(default)s)')
+	args = parser.parse_args()
+	if (args.chat is None) == (args.fixture is None):
+		parser.error('give either a chat or --fixture')
+
+	with open('config.py') as f:
+		config = ast.literal_eval(f.read())
+
+	storage = await db.open_storage(config)
+	database = db.Database(storage, **config.get('database_options', {}))
+	await database.start()
+	client = None
+	try:
+		if args.fixture is not None:
+			messages = read_fixture(args.fixture)
+		else:
+			client = TelegramClient(args.session, config['api_id'], config['api_hash'])
+			await client.start()
+			chat = await client.get_entity(args.chat)
+			checkpoint = await database.backfill_checkpoint(telethon.utils.get_peer_id(chat))
+			messages = client.iter_messages(chat, limit=args.limit, min_id=checkpoint, reverse=True)
+			if args.record is not None:
+				messages = record(messages, args.record)
+
+		started = time.perf_counter()
+		scanned, saved = await backfill(
+			messages,
+			database,
+			# the bot's replies are shouts which are already stored
+			bot_id=int(config['api_token'].partition(':')[0]),
+			batch_size=args.batch_size,
+		)
+		elapsed = time.perf_counter() - started
+		print(f'scanned {scanned} messages in {elapsed:.1f}s ({scanned / elapsed:.0f}/s), saved {saved} shouts')
+	finally:
+		if client is not None:
+			await client.disconnect()
+		await database.close()
+		await storage.close()
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,79 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmarks for the hot paths of the bot. Run them from the repository root, e.g.
+
+	$ python -m benchmarks.random_shout
+
+The database benchmarks connect using the 'database' section of config.py (or a DSN passed as the first argument)
+and do all their work in a scratch schema which is dropped afterwards, so they are safe to point at a real database.
+"""
+
+import ast
+import contextlib
+import secrets
+import statistics
+import sys
+import time
+
+import asyncpg
+
+def load_config():
+	with open('config.py') as f:
+		return ast.literal_eval(f.read())
+
+async def connect(**kwargs):
+	if len(sys.argv) > 1:
+		return await asyncpg.connect(sys.argv[1], **kwargs)
+	return await asyncpg.connect(**load_config()['database'], **kwargs)
+
+@contextlib.asynccontextmanager
+async def scratch_schema(conn):
+	"""create a throwaway schema containing the tables from schema.sql and make it the current search path"""
+	schema = 'bench_' + secrets.token_hex(4)
+	await conn.execute(f'CREATE SCHEMA {schema}')
+	try:
+		# public too, for extensions that are already installed there
+		await conn.execute(f'SET search_path TO {schema}, public')
+		with open('schema.sql') as f:
+			await conn.execute(f.read())
+		yield schema
+	finally:
+		await conn.execute('RESET search_path')
+		await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+
+async def time_async(f, *, runs):
+	"""call coroutine function f runs times and return the latency of each call in microseconds"""
+	timings = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		await f()
+		timings.append((time.perf_counter() - start) * 1e6)
+	return timings
+
+def time_sync(f, *, runs):
+	timings = []
+	for _ in range(runs):
+		start = time.perf_counter()
+		f()
+		timings.append((time.perf_counter() - start) * 1e6)
+	return timings
+
+def summarize(timings):
+	timings = sorted(timings)
+	return 'median {:9.1f} µs   p99 {:9.1f} µs'.format(
+		statistics.median(timings),
+		timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+	)
@@ -0,0 +1,290 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Replay new messages through the whole bot, the same way Telegram's updates would arrive, and report throughput,
+latency, and database and Telegram calls per message.
+
+	$ python -m benchmarks.pipeline --messages 20000 --rate 2000
+	$ python -m benchmarks.pipeline --fixture messages.txt  # recorded with ./backfill.py --record
+
+The client is fake: it never connects, and sending takes --send-latency milliseconds. Rate limits are lifted, since
+they'd only measure themselves. The database is an in-memory SQLite one, or PostgreSQL (in a scratch schema) with --dsn.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import logging
+import random
+import time
+
+import telethon.utils
+from telethon import TelegramClient
+from telethon.sessions import MemorySession
+from telethon.tl import functions, types
+
+import bot
+import db
+import sqlite_db
+from backfill import read_fixture
+from . import scratch_schema, summarize
+
+BOT = types.User(id=42, is_self=True, bot=True, username='captain_capslock_bot', access_hash=4242)
+
+# what the synthetic stream is made of, and how much of it
+SHOUTS = ['I SHALL', 'PR IT', 'WHY IS IT ALWAYS DNS', 'STOP SHOUTING', 'F U', 'THE BUILD IS BROKEN AGAIN', 'LGTM SHIP IT']
+CHATTER = ['hello', 'ok', 'XD', 'that works for me', 'did you see the release notes?', 'brb', 'lol 10 GiB']
+KINDS = [
+	('shout', 40),
+	('chatter', 35),
+	('shout with a mention', 5),
+	('code', 5),
+	('command', 8),
+	('dm', 7),
+]
+
+class FakeClient(TelegramClient):
+	"""A client which counts the requests it's asked to make instead of making them."""
+
+	def __init__(self, *, send_latency=0.0):
+		super().__init__(MemorySession(), 1, '0' * 32, sequential_updates=True)
+		self.user = BOT
+		self._mb_entity_cache.set_self_user(BOT.id, True, BOT.access_hash)
+		self.send_latency = send_latency
+		self.requests = collections.Counter()
+		self._message_ids = iter(range(10**9, 2 * 10**9))
+
+	async def get_me(self, input_peer=False):
+		return BOT
+
+	async def send_message(self, entity, message='', **kwargs):
+		self.requests['send_message'] += 1
+		await asyncio.sleep(self.send_latency)
+		text = message if isinstance(message, str) else message.message
+		return types.Message(id=next(self._message_ids), peer_id=types.PeerUser(BOT.id), message=text)
+
+	async def delete_messages(self, entity, message_ids, **kwargs):
+		self.requests['delete_messages'] += 1
+		await asyncio.sleep(self.send_latency)
+
+	async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+		self.requests[type(request).__name__] += 1
+		await asyncio.sleep(self.send_latency)
+		if isinstance(request, functions.channels.GetParticipantRequest):
+			return types.channels.ChannelParticipant(
+				participant=types.ChannelParticipant(user_id=request.participant, date=None),
+				chats=[],
+				users=[],
+			)
+		if isinstance(request, functions.channels.GetParticipantsRequest):
+			return types.channels.ChannelParticipants(count=0, participants=[], chats=[], users=[])
+		if isinstance(request, functions.users.GetUsersRequest):
+			# nobody telegram has heard of
+			return [types.UserEmpty(user.user_id) for user in request.id]
+		raise NotImplementedError(type(request).__name__)
+
+class CountingStorage:
+	"""wraps a db.Storage, counting calls to each method"""
+
+	def __init__(self, storage):
+		self.storage = storage
+		self.calls = collections.Counter()
+
+	def __getattr__(self, name):
+		attr = getattr(self.storage, name)
+		if not callable(attr) or name in ('close', 'listen_for_opt_changes', 'stop_listening'):
+			return attr
+
+		def counted(*args, **kwargs):
+			self.calls[name] += 1
+			return attr(*args, **kwargs)
+		return counted
+
+def synthetic_messages(n, *, chats=100, users=1000, seed=0):
+	"""n new messages spread over chats group chats (half basic groups, half supergroups), in order"""
+	rng = random.Random(seed)
+	peers = [
+		types.PeerChat(chat_id=i) if i % 2 else types.PeerChannel(channel_id=10**9 + i)
+		for i in range(1, chats + 1)
+	]
+	message_ids = collections.defaultdict(int)
+	kinds, weights = zip(*KINDS)
+	now = datetime.datetime.now(datetime.timezone.utc)
+
+	for _ in range(n):
+		kind, = rng.choices(kinds, weights)
+		user_id = rng.randrange(1, users + 1)
+		peer = types.PeerUser(user_id) if kind == 'dm' else rng.choice(peers)
+		# message IDs are per chat in channels and per user everywhere else, but any increasing ID will do
+		message_ids[telethon.utils.get_peer_id(peer)] += 1
+		message_id = message_ids[telethon.utils.get_peer_id(peer)]
+		entities = None
+
+		if kind == 'shout':
+			text = f'{rng.choice(SHOUTS)} {rng.randrange(10**6)}'
+			if rng.random() < 0.2:
+				entities = [types.MessageEntityBold(0, 4)]
+		elif kind == 'chatter':
+			text = rng.choice(CHATTER)
+		elif kind == 'shout with a mention':
+			text = f'@someone {rng.choice(SHOUTS)} {rng.randrange(10**6)}'
+			entities = [types.MessageEntityMention(0, 8)]
+		elif kind == 'code':
+			text = 'SELECT * FROM SHOUT'
+			entities = [types.MessageEntityCode(0, len(text))]
+		elif kind == 'command':
+			name = rng.choice(['ping', 'toggle', 'remove', 'stats'])
+			text = f'/{name}@{BOT.username}'
+			entities = [types.MessageEntityBotCommand(0, len(text))]
+		else:
+			text = rng.choice(SHOUTS + CHATTER)
+
+		yield types.Message(
+			id=message_id,
+			peer_id=peer,
+			from_id=types.PeerUser(user_id),
+			date=now,
+			message=text,
+			entities=entities,
+			reply_to=types.MessageReplyHeader(reply_to_msg_id=max(1, message_id - 1)) if text.startswith('/remove') else None,
+		)
+
+def new_message_update(message):
+	if isinstance(message.peer_id, types.PeerChannel):
+		update = types.UpdateNewChannelMessage(message, pts=0, pts_count=0)
+	else:
+		update = types.UpdateNewMessage(message, pts=0, pts_count=0)
+	# the users and chats that came with the update, which telethon would have filled in
+	update._entities = {}
+	return update
+
+class _ErrorCounter(logging.Handler):
+	def __init__(self):
+		super().__init__(logging.ERROR)
+		self.count = 0
+
+	def emit(self, record):
+		self.count += 1
+
+Report = collections.namedtuple('Report', 'messages elapsed dispatch_latencies latencies storage_calls requests errors dropped')
+
+async def replay(messages, storage, *, rate=None, send_latency=0.0, database_options=None):
+	"""Dispatch each message to the bot's handlers as a new message update, rate per second (or as fast as
+	the bot takes them), and wait for them all to be handled. Returns a Report. The storage is closed afterwards.
+	"""
+	client = FakeClient(send_latency=send_latency)
+	storage = CountingStorage(storage)
+	# not inf, which makes the buckets' arithmetic come out as nan
+	unlimited = 1e9
+	await bot.setup_client(client, {
+		'owner_ids': set(),
+		'database_options': database_options or {},
+		'outbox': {'global_rate': unlimited, 'global_burst': unlimited, 'chat_rate': unlimited, 'chat_burst': unlimited},
+	}, storage)
+
+	# time from receiving each message to having handled it
+	received = {}
+	latencies = []
+	handle_new_message = bot.handle_new_message
+
+	async def timed_handle_new_message(event):
+		try:
+			await handle_new_message(event)
+		finally:
+			latencies.append(time.perf_counter() - received.pop(id(event.message)))
+
+	errors = _ErrorCounter()
+	logging.getLogger().addHandler(errors)
+	bot.handle_new_message = timed_handle_new_message
+	try:
+		count = 0
+		dispatch_latencies = []
+		started = time.perf_counter()
+		for count, message in enumerate(messages, 1):
+			if rate:
+				await asyncio.sleep(started + count / rate - time.perf_counter())
+			update = new_message_update(message)
+			received[id(message)] = dispatched = time.perf_counter()
+			# what telethon's update loop does with each update when sequential_updates is on
+			await client._dispatch_update(update)
+			dispatch_latencies.append(time.perf_counter() - dispatched)
+
+		await client.workers.close()
+		while client.outbox.queued():
+			await asyncio.sleep(0.001)
+		elapsed = time.perf_counter() - started
+	finally:
+		bot.handle_new_message = handle_new_message
+		logging.getLogger().removeHandler(errors)
+		await bot.close_client(client)
+
+	return Report(
+		messages=count,
+		elapsed=elapsed,
+		dispatch_latencies=dispatch_latencies,
+		latencies=latencies,
+		storage_calls=storage.calls,
+		requests=client.requests,
+		errors=errors.count,
+		dropped=sum(dropped for *_, dropped in client.workers.stats()),
+	)
+
+def print_report(report):
+	print(f'{report.messages:,} messages in {report.elapsed:.2f}s: {report.messages / report.elapsed:,.0f} messages/s')
+	print(f'\tdispatch  {summarize([latency * 1e6 for latency in report.dispatch_latencies])}')
+	print(f'\thandling  {summarize([latency * 1e6 for latency in report.latencies])}')
+	print(f'\t{report.errors} errors, {report.dropped} messages dropped by the workers')
+	for title, calls in ('database calls', report.storage_calls), ('telegram requests', report.requests):
+		print(f'\t{title} per message: {sum(calls.values()) / report.messages:.3f}')
+		for name, count in calls.most_common():
+			print(f'\t\t{name:<24} {count / report.messages:.3f}')
+
+async def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--messages', type=int, default=20_000, help='how many synthetic messages (default: %(default)s)')
+	parser.add_argument('--chats', type=int, default=100, help='spread them over this many chats (default: %(default)s)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--fixture', help='replay messages recorded with ./backfill.py --record instead')
+	parser.add_argument('--rate', type=float, help='messages per second (default: as fast as they are taken)')
+	parser.add_argument('--send-latency', type=float, default=0.0, help='milliseconds each telegram request takes')
+	parser.add_argument('--write-behind', action='store_true', help='save shouts in batches (database_options)')
+	parser.add_argument('--dsn', help='use this PostgreSQL database instead of SQLite')
+	args = parser.parse_args()
+
+	if args.fixture is not None:
+		messages = [message async for message in read_fixture(args.fixture)]
+	else:
+		messages = list(synthetic_messages(args.messages, chats=args.chats, seed=args.seed))
+
+	options = dict(
+		rate=args.rate,
+		send_latency=args.send_latency / 1000,
+		database_options={'write_behind': args.write_behind},
+	)
+	if args.dsn is None:
+		storage = await sqlite_db.SQLiteStorage.connect(':memory:')
+		print_report(await replay(messages, storage, **options))
+		return
+
+	import asyncpg
+	conn = await asyncpg.connect(args.dsn)
+	async with scratch_schema(conn) as schema:
+		storage = await db.PostgresStorage.connect(dsn=args.dsn, server_settings={'search_path': schema})
+		print_report(await replay(messages, storage, **options))
+	await conn.close()
+
+if __name__ == '__main__':
+	asyncio.get_event_loop().run_until_complete(main())
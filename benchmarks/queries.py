@@ -0,0 +1,70 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Per call overhead of rendering a Jinja macro for every query, compared to rendering it once
+(so that it's prepared the first time and found in asyncpg's statement cache after that),
+and of timing it with db.TimedConnection.
+"""
+
+import asyncio
+
+import jinja2
+
+import db
+from . import connect, scratch_schema, summarize, time_async, time_sync
+
+RUNS = 5000
+
+async def main():
+	with open('queries.sql') as f:
+		module = jinja2.Template(f.read(), line_statement_prefix='-- :').module
+	queries = db.load_queries()
+
+	print('rendering the state macro')
+	print('\t', summarize(time_sync(module.state, runs=RUNS)))
+
+	conn = await connect()
+	timed_conn = db.TimedConnection(conn)
+	async with scratch_schema(conn):
+		await conn.execute('INSERT INTO opt (peer_id, state) SELECT i, i % 2 = 0 FROM generate_series(1, 1000) AS i')
+		# only possible outside of a pool, but it's the lower bound
+		statement = await conn.prepare(queries.state)
+
+		async def rendered():
+			return await conn.fetchval(module.state(), 1, 2)
+
+		async def cached():
+			return await conn.fetchval(queries.state, 1, 2)
+
+		async def timed():
+			return await timed_conn.fetchval(queries.state, 1, 2)
+
+		async def prepared():
+			return await statement.fetchval(1, 2)
+
+		for name, f in (
+			('render every call', rendered),
+			('render once, statement cache', cached),
+			('render once, statement cache, TimedConnection', timed),
+			('PreparedStatement', prepared),
+		):
+			await f()
+			print(name)
+			print('\t', summarize(await time_async(f, runs=RUNS)))
+
+	await conn.close()
+
+if __name__ == '__main__':
+	asyncio.get_event_loop().run_until_complete(main())
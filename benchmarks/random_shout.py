@@ -0,0 +1,73 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare picking a random shout by ordinal against the old OFFSET based query as a chat's history grows."""
+
+import asyncio
+
+from db import load_queries
+from . import connect, scratch_schema, summarize, time_async
+
+CHAT_ID = -1001234567890
+SIZES = 1_000, 100_000, 1_000_000
+RUNS = 200
+
+OFFSET_QUERY = """
+	SELECT message_id, content, entities
+	FROM shout
+	WHERE chat_id = $1
+	OFFSET FLOOR(RANDOM() * (
+		SELECT COUNT(*)
+		FROM shout
+		WHERE chat_id = $1
+	))
+	FETCH FIRST ROW ONLY
+"""
+
+async def main():
+	ordinal_query = load_queries().random_shout
+
+	conn = await connect()
+	async with scratch_schema(conn):
+		# some noise from another chat, so that the predicate actually has to do something
+		await conn.execute("""
+			INSERT INTO shout (chat_id, message_id, content)
+			SELECT 1, i, 'SOME OTHER CHAT ' || i
+			FROM generate_series(1, 10000) AS i
+		""")
+
+		populated = 0
+		for size in SIZES:
+			await conn.execute("""
+				INSERT INTO shout (chat_id, message_id, content)
+				SELECT $1, i, 'SHOUT NUMBER ' || i
+				FROM generate_series($2::INT4 + 1, $3) AS i
+			""", CHAT_ID, populated, size)
+			populated = size
+			await conn.execute('ANALYZE shout')
+			await conn.execute('ANALYZE shout_count')
+
+			print(f'{size:>9,} rows')
+			for name, query in ('offset', OFFSET_QUERY), ('ordinal', ordinal_query):
+				# warm up the statement cache and the buffer cache
+				await conn.fetchrow(query, CHAT_ID)
+				runs = RUNS if name == 'ordinal' or size < 1_000_000 else RUNS // 10
+				timings = await time_async(lambda: conn.fetchrow(query, CHAT_ID), runs=runs)
+				print(f'\t{name:<8} {summarize(timings)}')
+
+	await conn.close()
+
+if __name__ == '__main__':
+	asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,67 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""How /search's query is planned and how long it takes on a big chat, for a rare word, a common one,
+and one that isn't there at all. The plan should use shout_search_idx for each of them,
+both as planned for its parameters and as a generic plan, which is what a prepared statement can end up with.
+"""
+
+import asyncio
+
+import db
+from . import connect, scratch_schema, summarize, time_async
+
+CHAT_ID = -1001234567890
+OTHER_CHAT_ID = -1009876543210
+SHOUTS = 200_000
+BATCH_SIZE = 10_000
+RUNS = 50
+N = 6
+
+TERMS = [
+	# in one shout in a thousand
+	('rare', 'PINEAPPLE'),
+	# in every shout
+	('common', 'SHOUT'),
+	('absent', 'XYZZY'),
+]
+
+async def fill(conn):
+	for chat_id in CHAT_ID, OTHER_CHAT_ID:
+		for start in range(0, SHOUTS, BATCH_SIZE):
+			await conn.copy_records_to_table('shout', columns=['chat_id', 'message_id', 'content'], records=[
+				(chat_id, i, f'SHOUT NUMBER {i}' + ' PINEAPPLE' * (i % 1000 == 0))
+				for i in range(start, start + BATCH_SIZE)
+			])
+	await conn.execute('ANALYZE shout')
+
+async def main():
+	queries = db.load_queries()
+	conn = await connect()
+	async with scratch_schema(conn):
+		await fill(conn)
+		for name, term in TERMS:
+			args = CHAT_ID, f'%{db.escape_like(term)}%', None, N
+			for plan_cache_mode in 'force_custom_plan', 'force_generic_plan':
+				await conn.execute(f'SET plan_cache_mode = {plan_cache_mode}')
+				print(f'{name} ({term}), {plan_cache_mode}')
+				for row in await conn.fetch('EXPLAIN (ANALYZE, BUFFERS) ' + queries.search_shouts, *args):
+					print('\t', row[0])
+			await conn.execute('RESET plan_cache_mode')
+			print('\t', summarize(await time_async(lambda: conn.fetch(queries.search_shouts, *args), runs=RUNS)))
+	await conn.close()
+
+if __name__ == '__main__':
+	asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,124 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare is_shout against the original character by character implementation
+over a few distributions of message lengths, checking that their verdicts agree.
+Short messages are the common case, so they're also timed on their own.
+"""
+
+import random
+import time
+
+from utils.shout import IGNORED_WORDS, is_shout, is_shout_many, unicode_properties
+
+DEFAULT_IGNORABLE = frozenset(unicode_properties.get('Default_Ignorable_Code_Point'))
+
+MESSAGES = 20_000
+# telegram's limit
+MAX_LENGTH = 4096
+SHORT_LENGTH = 32
+
+# the original as it was, except that its table of default ignorable code points was a frozenset literal
+# in utils.shout.derived_core_properties, which now holds ranges instead
+def reference_is_shout(str):
+	# the original imported its table on every call. this costs the same, since the module is already loaded
+	from utils.shout import derived_core_properties
+
+	if str in IGNORED_WORDS:
+		return False
+
+	length = len(str)
+	count = 0
+
+	for c in str:
+		if c.isspace() or c in DEFAULT_IGNORABLE:
+			length -= 1
+		if c.isupper():
+			count += 1
+
+	return length > 1 and count / length > 0.5
+
+WORDS = 'the quick brown fox jumps over lazy dog lol ok pr it tfw nick 10 GiB 🅱️ ñandú ÉCOLE straße'.split()
+
+def message(length, rng):
+	words = []
+	total = 0
+	# most messages are either mostly lowercase or mostly uppercase
+	shouting = rng.random() < 0.3
+	while total < length:
+		word = rng.choice(WORDS)
+		if shouting != (rng.random() < 0.1):
+			word = word.upper()
+		words.append(word)
+		total += len(word) + 1
+	return ' '.join(words)[:length]
+
+def chat_lengths(rng):
+	# most messages are short, with a long tail
+	while True:
+		yield max(1, min(MAX_LENGTH, int(rng.lognormvariate(3.3, 1.0))))
+
+def long_lengths(rng):
+	while True:
+		yield rng.randint(500, MAX_LENGTH)
+
+def max_lengths(rng):
+	while True:
+		yield MAX_LENGTH
+
+def corpus(lengths, rng):
+	lengths = lengths(rng)
+	return [message(next(lengths), rng) for _ in range(MESSAGES)]
+
+def bench(f, messages, runs=3):
+	"""Return the mean time per message in microseconds, from the quickest of several runs."""
+	best = float('inf')
+	for _ in range(runs):
+		start = time.perf_counter()
+		for m in messages:
+			f(m)
+		best = min(best, time.perf_counter() - start)
+	return best / len(messages) * 1e6
+
+def bench_many(messages, runs=3):
+	best = float('inf')
+	for _ in range(runs):
+		start = time.perf_counter()
+		is_shout_many(messages)
+		best = min(best, time.perf_counter() - start)
+	return best / len(messages) * 1e6
+
+def main():
+	rng = random.Random(1)
+	is_shout('warm up the tables')
+
+	chat = corpus(chat_lengths, rng)
+	distributions = [
+		('chat', chat),
+		(f'short chat (up to {SHORT_LENGTH} characters)', [m for m in chat if len(m) <= SHORT_LENGTH]),
+		('long', corpus(long_lengths, rng)),
+		('max', corpus(max_lengths, rng)),
+	]
+	for name, messages in distributions:
+		assert list(map(reference_is_shout, messages)) == is_shout_many(messages)
+
+		mean_length = sum(map(len, messages)) / len(messages)
+		print(f'{name} messages (mean length {mean_length:.0f})')
+		print(f'\treference     {bench(reference_is_shout, messages):8.2f} µs/message')
+		print(f'\tis_shout      {bench(is_shout, messages):8.2f} µs/message')
+		print(f'\tis_shout_many {bench_many(messages):8.2f} µs/message')
+
+if __name__ == '__main__':
+	main()
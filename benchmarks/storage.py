@@ -0,0 +1,87 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Run the same workload against each db.Storage, bypassing db.Database's caches.
+The SQLite database is a file in a temporary directory.
+"""
+
+import asyncio
+import itertools
+import os.path
+import sys
+import tempfile
+import time
+
+import db
+import sqlite_db
+from . import connect, load_config, scratch_schema, summarize, time_async
+
+CHAT_ID = -1001234567890
+SHOUTS = 100_000
+BATCH_SIZE = 1000
+RUNS = 2000
+
+async def bench(storage):
+	started = time.perf_counter()
+	for start in range(0, SHOUTS, BATCH_SIZE):
+		await storage.save_shouts([
+			(CHAT_ID, i, f'SHOUT NUMBER {i}', [], i % 100)
+			for i in range(start, start + BATCH_SIZE)
+		])
+	print(f'\tsave {SHOUTS:,} shouts in batches of {BATCH_SIZE}: {time.perf_counter() - started:.1f}s')
+
+	new_ids = itertools.count(SHOUTS)
+	old_ids = itertools.count(0)
+	user_ids = itertools.count(1)
+
+	def handle_shout():
+		message_id = next(new_ids)
+		return storage.handle_shout(CHAT_ID, 1, message_id, f'NEW SHOUT {message_id}', [], True, True)
+
+	workloads = [
+		('handle_shout', handle_shout),
+		('random_shouts', lambda: storage.random_shouts(CHAT_ID, 64)),
+		('state', lambda: storage.state(CHAT_ID, 1)),
+		('toggle_state', lambda: storage.toggle_state(next(user_ids), False)),
+		('delete_shout', lambda: storage.delete_shout(CHAT_ID, next(old_ids))),
+	]
+	for name, f in workloads:
+		await f()
+		print(f'\t{name:<14} {summarize(await time_async(f, runs=RUNS))}')
+
+async def main():
+	with tempfile.TemporaryDirectory() as directory:
+		started = time.perf_counter()
+		storage = await sqlite_db.SQLiteStorage.connect(os.path.join(directory, 'bench.sqlite3'))
+		print(f'sqlite (opened in {(time.perf_counter() - started) * 1000:.1f}ms)')
+		try:
+			await bench(storage)
+		finally:
+			await storage.close()
+
+	conn = await connect()
+	async with scratch_schema(conn) as schema:
+		options = {'dsn': sys.argv[1]} if len(sys.argv) > 1 else load_config()['database']
+		started = time.perf_counter()
+		storage = await db.PostgresStorage.connect(**options, server_settings={'search_path': schema})
+		print(f'postgresql (connected in {(time.perf_counter() - started) * 1000:.1f}ms)')
+		try:
+			await bench(storage)
+		finally:
+			await storage.close()
+	await conn.close()
+
+if __name__ == '__main__':
+	asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,95 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare the generated range tables against the frozenset of every code point that the generator used to emit:
+how long each takes to load, how much memory it takes, and how fast lookups are.
+"""
+
+import random
+import sys
+import time
+
+from utils.shout import unicode_properties
+from utils.shout.gen_derived_core_properties import DEFAULT_PROPERTIES, constant_name, here
+
+LOOKUPS = 200_000
+RUNS = 20
+
+def frozenset_source():
+	"""the module the generator used to write, extended to every property"""
+	lines = []
+	for property in DEFAULT_PROPERTIES:
+		chars = ''.join(unicode_properties.get(property))
+		lines.append(f'{constant_name(property)} = frozenset({chars!r})')
+	return '\n'.join(lines) + '\n'
+
+def time_load(source):
+	"""(cold: compiling and running the module, warm: running its cached bytecode), in ms"""
+	start = time.perf_counter()
+	for _ in range(RUNS):
+		exec(compile(source, 'module', 'exec'), {})
+	cold = (time.perf_counter() - start) / RUNS * 1e3
+
+	code = compile(source, 'module', 'exec')
+	start = time.perf_counter()
+	for _ in range(RUNS):
+		exec(code, {})
+	warm = (time.perf_counter() - start) / RUNS * 1e3
+	return cold, warm
+
+def time_lookups(table, chars):
+	start = time.perf_counter()
+	for c in chars:
+		c in table
+	return (time.perf_counter() - start) / len(chars) * 1e9
+
+def main():
+	with open(here / 'derived_core_properties.py') as f:
+		ranges_source = f.read()
+	sets_source = frozenset_source()
+
+	print('loading all of', ', '.join(DEFAULT_PROPERTIES))
+	for name, source in ('frozenset', sets_source), ('ranges', ranges_source):
+		cold, warm = time_load(source)
+		print(f'\t{name:<10} {cold:7.2f} ms cold  {warm:7.2f} ms from bytecode')
+
+	print('memory')
+	sets, ranges = {}, {}
+	exec(sets_source, sets)
+	exec(ranges_source, ranges)
+	for name, namespace in ('frozenset', sets), ('ranges', ranges):
+		tables = [namespace[constant_name(property)] for property in DEFAULT_PROPERTIES]
+		size = sum(map(sys.getsizeof, tables))
+		if name == 'frozenset':
+			# each character is a separate str object too
+			size += sum(sys.getsizeof(c) for table in tables for c in table)
+		print(f'\t{name:<10} {size / 1024:7.1f} KiB')
+
+	rng = random.Random(1)
+	# mostly ASCII, like real messages
+	chars = [chr(rng.randrange(0x80) if rng.random() < 0.8 else rng.randrange(0x20000)) for _ in range(LOOKUPS)]
+	print('lookups')
+	for property in DEFAULT_PROPERTIES:
+		table = unicode_properties.get(property)
+		as_set = frozenset(table)
+		assert [c in table for c in chars] == [c in as_set for c in chars]
+		print(
+			f'\t{property:<30}'
+			f'frozenset {time_lookups(as_set, chars):6.1f} ns  '
+			f'ranges {time_lookups(table, chars):6.1f} ns'
+		)
+
+if __name__ == '__main__':
+	main()
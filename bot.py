@@ -18,17 +18,23 @@
 import asyncio
 import contextlib
 import logging
+import signal
+import sys
+import time
 from random import random
-from functools import wraps
+from functools import partial, wraps
 
-import asyncpg
 import telethon
-from telethon import TelegramClient, errors, events, tl
+from telethon import TelegramClient, events, tl
 from jishaku.repl import AsyncCodeExecutor
 from jishaku.functools import AsyncSender
 
 import utils
-from db import Database
+import db
+from utils import metrics, profiling, reloading
+from utils.workers import ChatWorkers
+from utils.outbox import Outbox
+from utils.permissions import AdminCache
 
 # only respond this often to reduce bickering and prevent having the last word all the time
 SHOUT_RESPONSE_PROBABILITY = 0.4
@@ -36,27 +42,38 @@ SHOUT_RESPONSE_PROBABILITY = 0.4
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('bot')
 
-def is_command(event):
-	# this is insanely complicated kill me now
+def parse_command(event):
+	"""If the message is a command meant for us, return the command's name and set event.command_text to the rest
+	of the message. Otherwise return None.
+	"""
 	message = event.message
 	try:
 		me = event.client.user
 		username = me.username
 	except AttributeError:
 		logger.warning('Command ran before event.client was set up!')
-		return False
-
-	if message.from_id == me.id:
-		return False
-
+		return None
+
+	if event.sender_id == me.id:
+		return None
+
+	# commands must start the message
+	entity = next(
+		(entity for entity in message.entities or () if isinstance(entity, tl.types.MessageEntityBotCommand)),
+		None,
+	)
+	if entity is None or entity.offset != 0:
+		return None
+
+	# command names and usernames are ASCII, so UTF-16 offsets are fine to use directly
+	text = message.message[:entity.length]
+	name, _, mention = text[1:].partition('@')
 	dm = isinstance(message.to_id, tl.types.PeerUser)
-	for entity, text in message.get_entities_text(tl.types.MessageEntityBotCommand):
-		if entity.offset != 0:
-			break
-		if dm or text.endswith('@' + username):
-			event.command_text = event.message.raw_text[len(text):].strip()
-			return True
-	return False
+	if not dm and mention != username:
+		return None
+
+	event.command_text = message.raw_text[len(text):].strip()
+	return name
 
 def check(predicate):
 	predicate = utils.ensure_corofunc(predicate)
@@ -68,8 +85,6 @@ def check(predicate):
 		return handler
 	return deco
 
-command_required = check(is_command)
-
 @check
 def owner_required(event):
 	return event.sender.id in event.client.config['owner_ids']
@@ -77,124 +92,332 @@ def owner_required(event):
 @check
 async def group_required(event):
 	if isinstance(event.message.to_id, tl.types.PeerUser):
-		await event.respond('THIS COMMAND MUST BE USED IN A GROUP CHAT')
-		raise events.StopPropagation
+		event.client.outbox.respond(event, 'THIS COMMAND MUST BE USED IN A GROUP CHAT')
+		return False
 	return True
 
+def timed(f):
+	histogram = metrics.HANDLER_SECONDS.labels(f.__name__)
+	@wraps(f)
+	async def handler(*args):
+		started = time.perf_counter()
+		try:
+			await f(*args)
+		finally:
+			histogram.observe(time.perf_counter() - started)
+	return handler
+
 # so that we can register them all in the correct order later (globals() is not guaranteed to be ordered)
 event_handlers = []
 def register_event(*args, **kwargs):
 	def deco(f):
-		event_handlers.append(events.register(*args, **kwargs)(f))
+		event_handlers.append(events.register(*args, **kwargs)(timed(f)))
 		return f
 	return deco
 
+# command name -> handler
+commands = {}
+# the commands given to the BotFather, in the order they're listed there. the rest are owner only, so they aren't advertised.
+LISTED_COMMANDS = ('toggle', 'togglegroup', 'remove', 'stats', 'search', 'license', 'ping', 'py')
+def command(name, description):
+	def deco(f):
+		f.description = description
+		commands[name] = f
+		return f
+	return deco
+
+def command_list():
+	"""the list of commands to give to the BotFather"""
+	return ''.join(f'{name} - {commands[name].description}\n' for name in LISTED_COMMANDS)
+
 @register_event(events.NewMessage)
-async def on_message(event):
-	message = event.message
-	if is_command(event):
+async def on_new_message(event):
+	# handle it on the chat's worker, so that a slow chat doesn't hold up the others
+	await event.client.workers.submit(event.chat_id, handle_new_message, event)
+
+async def handle_new_message(event):
+	name = parse_command(event)
+	if name is None:
+		await on_message(event)
 		return
 
-	if message.from_id == event.client.user.id:
+	handler = commands.get(name)
+	if handler is not None:
+		await handler(event)
+
+async def on_message(event):
+	message = event.message
+	if event.sender_id == event.client.user.id:
 		return
 
 	# ignore formatting, and don't consider code to be a shout
 	# (SQL LIKES TO YELL)
-	if not utils.shout.is_shout(utils.remove_code_and_mentions(message)):
+	is_shout = utils.shout.is_shout(utils.remove_code_and_mentions(message))
+	metrics.SHOUTS.labels(str(is_shout).lower()).inc()
+	if not is_shout:
 		return
 
 	if isinstance(message.to_id, tl.types.PeerUser):
 		# this bot doesn't work in DMs but that doesn't mean we can't have a bit of fun
-		await event.respond('KEEP YOUR VOICE DOWN')
-		raise events.StopPropagation
+		event.client.outbox.respond(event, 'KEEP YOUR VOICE DOWN', auto=True)
+		return
 
 	if not isinstance(message.from_id, tl.types.PeerUser):
 		return
 
-	peer_id, user_id = event.chat_id, message.from_id.user_id
-	if not await event.client.db.state(peer_id, user_id):
+	# try to reduce spam
+	want_reply = random() < SHOUT_RESPONSE_PROBABILITY
+	opted_in, shout = await event.client.db.handle_shout(
+		event.chat_id, message.from_id.user_id, message.id, message.message, message.entities, want_reply,
+	)
+	if not opted_in:
 		return
 
-	# try to reduce spam
-	if random() < SHOUT_RESPONSE_PROBABILITY:
-		shout = await event.client.db.random_shout(message.to_id)
-		await event.respond(shout or "I AIN'T GOT NOTHIN' ON THAT")
+	metrics.REPLY_ROLLS.labels('reply' if want_reply else 'no_reply').inc()
+	if want_reply:
+		event.client.outbox.respond(event, shout or "I AIN'T GOT NOTHIN' ON THAT", auto=True)
+
+@register_event(events.MessageEdited)
+async def on_message_edited(event):
+	await event.client.workers.submit(event.chat_id, handle_message_edited, event)
+
+async def handle_message_edited(event):
+	message = event.message
+	# only shouts from users in groups are stored
+	if (
+		event.sender_id == event.client.user.id
+		or isinstance(message.to_id, tl.types.PeerUser)
+		or not isinstance(message.from_id, tl.types.PeerUser)
+	):
+		return
 
-	await event.client.db.save_shout(message)
-	raise events.StopPropagation
+	is_shout = utils.shout.is_shout(utils.remove_code_and_mentions(message))
+	metrics.SHOUTS.labels(str(is_shout).lower()).inc()
+	event.client.db.edit_shout(event.chat_id, message.id, message.message, message.entities, is_shout=is_shout)
 
-@register_event(events.NewMessage(pattern=r'^/ping'))
-@command_required
+@register_event(events.MessageDeleted)
+async def on_message_deleted(event):
+	# telegram doesn't say which chat messages were deleted from unless it's a channel.
+	# if it doesn't, they're deleted once every chat's worker has handled the messages received before now.
+	await event.client.workers.submit(event.chat_id, handle_message_deleted, event)
+
+async def handle_message_deleted(event):
+	await event.client.db.delete_shouts(event.chat_id, event.deleted_ids)
+
+@register_event(events.ChatAction)
+async def on_chat_action(event):
+	if (event.user_kicked or event.user_left) and event.client.user.id in event.user_ids:
+		event.client.db.forget_chat(event.chat_id)
+		event.client.admins.forget_chat(event.chat_id)
+		return
+
+	# someone joined, left, or was added or kicked, so what we know about their permissions is out of date
+	for user_id in event.user_ids:
+		event.client.admins.invalidate(event.chat_id, user_id)
+
+# when members are hidden, there's no service message for ChatAction to pick up.
+# raw updates don't know their client, so this is registered in setup_client.
+async def on_participant_update(client, update):
+	if isinstance(update, tl.types.UpdateChannelParticipant):
+		# this is also how we hear about admins being promoted and demoted
+		chat_id = telethon.utils.get_peer_id(tl.types.PeerChannel(update.channel_id))
+		client.admins.update(chat_id, update.user_id, update.new_participant)
+
+	if update.user_id != client.user.id:
+		return
+	if not isinstance(update.new_participant, (type(None), tl.types.ChannelParticipantLeft, tl.types.ChannelParticipantBanned)):
+		return
+
+	if isinstance(update, tl.types.UpdateChannelParticipant):
+		peer = tl.types.PeerChannel(update.channel_id)
+	else:
+		peer = tl.types.PeerChat(update.chat_id)
+	client.db.forget_chat(telethon.utils.get_peer_id(peer))
+
+@command('ping', 'PONG')
 async def ping_command(event):
-	await event.respond('PONG')
+	event.client.outbox.respond(event, 'PONG')
 
-@register_event(events.NewMessage(pattern=r'^/license'))
-@command_required
+@command('license', 'SHOWS YOU MY SOURCE CODE LICENSE')
 async def license_command(event):
 	with open('short-license.txt') as f:
-		await event.respond(f.read(), parse_mode='markdown')
+		event.client.outbox.respond(event, f.read(), parse_mode='markdown')
 
-@register_event(events.NewMessage(pattern=r'^/togglegroup'))
+@command('togglegroup', 'TOGGLES THE OPT-IN STATUS OF THE SHOUTING AUTO RESPONSE FOR THIS GROUP')
 @group_required
-@command_required
 async def togglegroup_command(event):
 	message = event.message
 	new_state = await event.client.db.toggle_state(event.chat_id)
 	if new_state:
-		await event.respond('SHOUTING AUTO RESPONSE IS NOW **OPT-OUT** FOR THIS CHAT', parse_mode='markdown')
+		event.client.outbox.respond(event, 'SHOUTING AUTO RESPONSE IS NOW **OPT-OUT** FOR THIS CHAT', parse_mode='markdown')
 	else:
-		await event.respond('SHOUTING AUTO RESPONSE IS NOW **OPT-IN** FOR THIS CHAT', parse_mode='markdown')
-
-	# don't invoke /toggle as well
-	raise events.StopPropagation
+		event.client.outbox.respond(event, 'SHOUTING AUTO RESPONSE IS NOW **OPT-IN** FOR THIS CHAT', parse_mode='markdown')
 
-@register_event(events.NewMessage(pattern=r'^/toggle'))
-@command_required
+@command('toggle', 'TOGGLES THE SHOUTING AUTO RESPONSE FOR YOU')
 async def toggle_command(event):
 	message = event.message
 	chat_id = event.chat_id if not isinstance(message.to_id, tl.types.PeerUser) else None
-	new_state = await event.client.db.toggle_user_state(event.message.from_id, chat_id)
+	new_state = await event.client.db.toggle_user_state(message.from_id.user_id, chat_id)
 	if new_state:
-		await event.respond('OPTED IN TO THE SHOUTING AUTO RESPONSE')
+		event.client.outbox.respond(event, 'OPTED IN TO THE SHOUTING AUTO RESPONSE')
 	else:
-		await event.respond('OPTED OUT OF THE SHOUTING AUTO RESPONSE')
+		event.client.outbox.respond(event, 'OPTED OUT OF THE SHOUTING AUTO RESPONSE')
 
-@register_event(events.NewMessage(pattern=r'^/remove'))
+@command('remove', 'REMOVES A MESSAGE FROM MY DATABASE')
 @group_required
-@command_required
 async def remove_command(event):
 	message = event.message
 
 	if message.reply_to_msg_id is None:
-		await event.respond(
+		event.client.outbox.respond(
+			event,
 			"HOW AM I SUPPOSED TO REMOVE A MESSAGE FROM MY DATABASE IF YOU WON'T TELL ME WHICH ONE TO REMOVE?")
 		return
 
 	if event.is_group and event.is_channel:
-		participant = await event.client(tl.functions.channels.GetParticipantRequest(
-			channel=message.to_id,
-			user_id=message.from_id))
-		if not (isinstance(participant, tl.types.ChannelParticipantAdmin) and participant.admin_rights.delete_messages):
-			await event.respond('YOU MUST BE AN ADMIN WITH DELETE MESSAGES PERMISSION TO RUN THIS COMMAND.')
+		if not await event.client.admins.can_delete_messages(event.chat_id, message.peer_id, event.sender_id):
+			event.client.outbox.respond(event, 'YOU MUST BE AN ADMIN WITH DELETE MESSAGES PERMISSION TO RUN THIS COMMAND.')
 			return
 
 	# we're not in a mega group. members of small groups can delete any message, so they have permission to run this command.
 
-	to_delete = []
-	if await event.client.db.delete_shout(message.to_id.chat_id, message.reply_to_msg_id):
-		to_delete.append(await event.respond('DELETED'))
+	if await event.client.db.delete_shout(event.chat_id, message.reply_to_msg_id):
+		response = 'DELETED'
 	else:
-		to_delete.append(await event.respond('MESSAGE NOT FOUND IN MY DATABASE'))
-	to_delete.append(event.message)  # this comes last because it's more likely to fail
+		response = 'MESSAGE NOT FOUND IN MY DATABASE'
+	# clean up after ourselves. the outbox deletes these together, in one request.
+	event.client.outbox.respond(event, response, delete_after=3)
+	event.client.outbox.delete(event, [message.id], 3)
+
+@command('stats', 'SHOWS HOW MUCH THIS GROUP SHOUTS, AND WHO SHOUTS THE MOST')
+@group_required
+async def stats_command(event):
+	stats = await event.client.db.chat_stats(event.chat_id)
+	# the database drops its stats whenever the chat's shouts change, and this along with them
+	if stats.response is None:
+		stats.response = await format_stats(event.client, stats)
+	event.client.outbox.respond(event, stats.response)
+
+async def format_stats(client, stats):
+	if not stats.total:
+		return "I HAVEN'T SAVED ANY SHOUTS FROM THIS CHAT YET"
+
+	lines = [f'{stats.total:,} SHOUTS SAVED']
+	if stats.top_shouters:
+		names = await display_names(client, [user_id for user_id, shouts in stats.top_shouters])
+		lines += ['', 'TOP SHOUTERS:']
+		lines.extend(
+			f'{i}. {names.get(user_id, f"USER {user_id}")}: {shouts:,}'
+			for i, (user_id, shouts) in enumerate(stats.top_shouters, 1)
+		)
+	lines += ['', 'SHOUTS PER DAY (UTC):']
+	lines.extend(f'{day:%a %b %d}: {shouts:,}' for day, shouts in stats.days)
+	return '\n'.join(lines).upper()
+
+async def display_names(client, user_ids):
+	"""user ID -> display name, for as many of the users as can be looked up in one request"""
+	input_users = []
+	for user_id in user_ids:
+		try:
+			input_users.append(telethon.utils.get_input_user(client.session.get_input_entity(user_id)))
+		except (ValueError, TypeError):
+			# bots can look up users without their access hash, as long as telegram thinks they've met
+			input_users.append(tl.types.InputUser(user_id, access_hash=0))
+	try:
+		users = await client(tl.functions.users.GetUsersRequest(input_users))
+	except telethon.errors.RPCError:
+		logger.exception('Looking up the names of users %s failed', user_ids)
+		return {}
+	return {user.id: telethon.utils.get_display_name(user) for user in users if isinstance(user, tl.types.User)}
+
+# the "MORE" button of /search results carries everything needed to show the next page,
+# so that nothing has to be remembered in between. telegram allows it 64 bytes.
+SEARCH_BUTTON_PREFIX = 'search:'
+MAX_BUTTON_DATA = 64
+# longer shouts are cut short in the results
+SEARCH_RESULT_LENGTH = 200
+SEARCH_TIMED_OUT = 'THAT SEARCH TOOK TOO LONG. TRY SOMETHING MORE SPECIFIC.'
+
+@command('search', 'FINDS SHOUTS FROM THIS GROUP THAT CONTAIN SOME TEXT')
+@group_required
+async def search_command(event):
+	text = event.command_text
+	if len(text) < db.SEARCH_MIN_LENGTH:
+		event.client.outbox.respond(event, f'GIVE ME AT LEAST {db.SEARCH_MIN_LENGTH} CHARACTERS TO SEARCH FOR')
+		return
+	# as long as the button's data can get
+	if len(search_button_data(text, 2**31 - 1, event.client.db.search_max_results)) > MAX_BUTTON_DATA:
+		event.client.outbox.respond(event, "THAT'S TOO LONG TO SEARCH FOR")
+		return
+
+	try:
+		response, buttons = await search_page(event.client, event.chat_id, text)
+	except asyncio.TimeoutError:
+		response, buttons = SEARCH_TIMED_OUT, None
+	event.client.outbox.respond(event, response, buttons=buttons, link_preview=False)
+
+@register_event(events.CallbackQuery(pattern=SEARCH_BUTTON_PREFIX.encode()))
+async def on_search_more(event):
+	# searching can take a while, and updates are handled one at a time
+	await event.client.workers.submit(event.chat_id, handle_search_more, event)
+
+async def handle_search_more(event):
+	text, before, shown = parse_search_button_data(event.data)
+	try:
+		response, buttons = await search_page(event.client, event.chat_id, text, before=before, shown=shown)
+	except asyncio.TimeoutError:
+		await event.answer(SEARCH_TIMED_OUT, alert=True)
+		return
 
-	await asyncio.sleep(3)
-	with contextlib.suppress(errors.MessageDeleteForbiddenError):
-		# we don't use client.delete_messages because that errors if *any* message fails to delete
-		for msg in to_delete:
-			await msg.delete()
+	await event.answer()
+	# pressed twice
+	with contextlib.suppress(telethon.errors.MessageNotModifiedError):
+		await event.edit(response, buttons=buttons, link_preview=False)
+
+async def search_page(client, chat_id, text, *, before=None, shown=0):
+	"""the text of a page of /search results, and its buttons"""
+	results, more = await client.db.search_shouts(chat_id, text, before=before, shown=shown)
+	if not results:
+		return 'NO SHOUTS FOUND', None
+
+	lines = []
+	for i, (message_id, content) in enumerate(results, shown + 1):
+		if len(content) > SEARCH_RESULT_LENGTH:
+			content = content[:SEARCH_RESULT_LENGTH - 1] + '…'
+		lines.append(f'{i}. {content}')
+		link = message_link(chat_id, message_id)
+		if link is not None:
+			lines.append(link)
+
+	buttons = None
+	if more:
+		last_message_id = results[-1][0]
+		buttons = [telethon.Button.inline('MORE', search_button_data(text, last_message_id, shown + len(results)))]
+	return '\n'.join(lines), buttons
+
+def search_button_data(text, before, shown):
+	return f'{SEARCH_BUTTON_PREFIX}{shown}:{before}:{text}'.encode()
+
+def parse_search_button_data(data):
+	"""the inverse of search_button_data"""
+	shown, before, text = data[len(SEARCH_BUTTON_PREFIX):].decode().split(':', 2)
+	return text, int(before), int(shown)
+
+def message_link(chat_id, message_id):
+	"""a link to the message, or None if it's not in a supergroup (messages in basic groups can't be linked to)"""
+	peer_id, peer_type = telethon.utils.resolve_id(chat_id)
+	if peer_type is not tl.types.PeerChannel:
+		return None
+	return f'https://t.me/c/{peer_id}/{message_id}'
+
+@command('reload', 'RELOADS MY CODE AND CONFIG WITHOUT RESTARTING')
+@owner_required
+async def reload_command(event):
+	async with utils.ReplExceptionCatcher(event.message):
+		elapsed = await reload(event.client)
+		await event.reply(f'RELOADED IN {elapsed * 1000:.0f} MS')
 
-@register_event(events.NewMessage(pattern=r'^/py'))
-@command_required
+@command('py', '🐍')
 @owner_required
 async def python(event):
 	message = event.message
@@ -221,30 +444,187 @@ async def python(event):
 
 		await event.reply('✅')
 
-async def init_client():
+MAX_PROFILE_SECONDS = 300
+
+def parse_profile_args(text):
+	"""[seconds] [top] [pstats] -> (seconds, top, whether to attach a pstats file)"""
+	words = text.split()
+	numbers = [int(word) for word in words if word.isdigit()]
+	seconds = min(numbers[0] if numbers else 10, MAX_PROFILE_SECONDS)
+	top = min(numbers[1] if len(numbers) > 1 else 20, 50)
+	return seconds, top, 'pstats' in words
+
+def profiler(f):
+	"""Run the profiling command in the background, so that the chat's worker isn't tied up while it runs,
+	and only one at a time, since profilers get in each other's way.
+	"""
+	@wraps(f)
+	async def handler(event):
+		if event.client.profiling is not None:
+			await event.reply('ALREADY PROFILING')
+			return
+
+		async def run():
+			try:
+				async with utils.ReplExceptionCatcher(event.message):
+					await f(event)
+			finally:
+				event.client.profiling = None
+
+		# kept until it's done, so that it isn't garbage collected while it runs
+		event.client.profiling = asyncio.ensure_future(run())
+		event.client.profiling.add_done_callback(log_profiler_failure)
+	return handler
+
+def log_profiler_failure(task):
+	# such as failing to send the traceback of what went wrong
+	if not task.cancelled() and task.exception() is not None:
+		logger.error('Profiling failed', exc_info=task.exception())
+
+@command('profile', 'SAMPLES WHAT I SPEND MY TIME ON')
+@owner_required
+@profiler
+async def profile_command(event):
+	seconds, top, attach = parse_profile_args(event.command_text)
+	await event.reply(f'PROFILING FOR {seconds} SECONDS')
+	sampler, lag = await profiling.profile_cpu(seconds)
+	await utils.send_code(event.message, sampler.format(top) + '\n\n' + lag.format())
+	if attach:
+		# on its own, since a file's caption can only be 1024 characters long
+		await event.message.reply(file=profiling.pstats_file(sampler))
+
+@command('memprofile', 'SHOWS WHAT I ALLOCATE MEMORY FOR')
+@owner_required
+@profiler
+async def memprofile_command(event):
+	seconds, top, _ = parse_profile_args(event.command_text)
+	await event.reply(f'TRACING ALLOCATIONS FOR {seconds} SECONDS')
+	report, lag = await profiling.profile_memory(seconds, top)
+	await utils.send_code(event.message, report + '\n\n' + lag.format())
+
+def load_config():
 	import ast
 	with open('config.py') as f:
-		config = ast.literal_eval(f.read())
+		return ast.literal_eval(f.read())
+
+async def init_client():
+	config = load_config()
+	# sequential, so that when the workers are backed up, we stop taking in new updates instead of piling them up
+	client = TelegramClient(config['session_name'], config['api_id'], config['api_hash'], sequential_updates=True)
+	await setup_client(client, config)
+	return client
 
-	client = TelegramClient(config['session_name'], config['api_id'], config['api_hash'])
+async def setup_client(client, config, storage=None):
+	"""Attach everything the handlers need to the client, and register them.
+	The storage is opened according to the config unless one is given.
+	benchmarks/pipeline.py does this to a fake client.
+	"""
 	client.parse_mode = None  # disable markdown parsing
 	client.config = config
-	pool = await asyncpg.create_pool(**config['database'])
-	client.db = Database(pool)
+	if storage is None:
+		storage = await db.open_storage(config)
+	client.db = db.Database(storage, **config.get('database_options', {}))
+	await client.db.start()
+	client.db.start_retention()
 	client.last_python_result = None
-
+	# the profiling command's task, while one is running
+	client.profiling = None
+	client.reload_lock = asyncio.Lock()
+	client.workers = ChatWorkers(**config.get('workers', {}))
+	client.workers.start()
+	client.outbox = Outbox(client, **config.get('outbox', {}))
+	client.admins = AdminCache(client, **config.get('admin_cache', {}))
+
+	metrics.track_queue('workers', client.workers.queued)
+	metrics.track_queue('outbox', client.outbox.queued)
+	metrics.track_queue('shouts', lambda: client.db.shout_queue_depth)
+	metrics.track_queue('edits', lambda: len(client.db.edit_queue))
+	if 'metrics' in config:
+		metrics.serve(**config['metrics'])
+
+	add_handlers(client)
+
+def add_handlers(client):
+	"""Register this module's handlers, in place of those of any earlier version of it."""
+	# all at once, with nothing awaited in between, so that no update is missed or handled twice.
+	# an update that's partway through being handled goes on to the new versions of the handlers it hasn't reached.
+	for handler in getattr(client, 'handlers', ()):
+		client.remove_event_handler(handler)
+	participant_update = partial(timed(on_participant_update), client)
 	for handler in event_handlers:
 		client.add_event_handler(handler)
-
-	return client
+	client.add_event_handler(
+		participant_update,
+		events.Raw((tl.types.UpdateChannelParticipant, tl.types.UpdateChatParticipant)),
+	)
+	client.handlers = [*event_handlers, participant_update]
+	client.handler_module = sys.modules[__name__]
+
+# config that's read as it's used. the rest is only read by setup_client, so changes to it need a restart.
+LIVE_CONFIG = frozenset({'owner_ids'})
+
+async def reload(client):
+	"""Re-read the config, and reload the handlers and the utils modules, keeping the telegram connection,
+	the database and everything that's been cached. Return how long that took, in seconds.
+	If anything fails to load, the old handlers go on being used.
+	"""
+	async with client.reload_lock:
+		started = time.perf_counter()
+		config = load_config()
+		reloading.reload_utils()
+		module = reloading.load_again(client.handler_module)
+		module.add_handlers(client)
+
+		restart_needed = sorted(
+			key for key in config.keys() | client.config.keys()
+			if key not in LIVE_CONFIG and config.get(key) != client.config.get(key)
+		)
+		if restart_needed:
+			logger.warning('Changes to these config settings need a restart: %s', ', '.join(restart_needed))
+		client.config = config
+
+		elapsed = time.perf_counter() - started
+		logger.info('Reloaded in %.0f ms', elapsed * 1000)
+		return elapsed
+
+def reload_in_background(client):
+	async def run():
+		try:
+			await client.handler_module.reload(client)
+		except Exception:
+			logger.exception('Reloading failed, so the old handlers are still in use')
+	asyncio.ensure_future(run())
+
+async def close_client(client):
+	"""finish handling the updates that have been received, and save everything"""
+	await client.workers.close()
+	await client.outbox.close()
+	await client.db.close()
+	await client.db.storage.close()
 
 async def main():
 	client = await init_client()
 	await client.start(bot_token=client.config['api_token'])
 	client.user = await client.get_me()
 
-	await client.run_until_disconnected()
+	# disconnect instead of dying on the spot, so that queued shouts get saved
+	loop = asyncio.get_event_loop()
+	for signum in signal.SIGINT, signal.SIGTERM:
+		with contextlib.suppress(NotImplementedError):  # windows
+			loop.add_signal_handler(signum, lambda: asyncio.ensure_future(client.disconnect()))
+	# kill -HUP reloads the config and the handlers, like /reload
+	with contextlib.suppress(NotImplementedError, AttributeError):  # windows has neither
+		loop.add_signal_handler(signal.SIGHUP, reload_in_background, client)
+
+	try:
+		await client.run_until_disconnected()
+	finally:
+		await close_client(client)
 
 if __name__ == '__main__':
+	if sys.argv[1:] == ['--command-list']:
+		print(command_list(), end='')
+		sys.exit()
+
 	with contextlib.suppress(KeyboardInterrupt):
 		asyncio.get_event_loop().run_until_complete(main())
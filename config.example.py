@@ -13,10 +13,98 @@
 	'database': {
 		'database': 'cc_telegram',
 	},
+	# optional. Set this to the path of an SQLite database file to use that instead of postgresql.
+	# It's created if it doesn't exist. Only one bot process can use it at a time.
+	'sqlite': None,
+	# optional tuning knobs for db.Database. These are the defaults.
+	'database_options': {
+		# roughly how many bytes of memory to spend caching random shouts for the most active chats
+		'shout_cache_size': 16_000_000,
+		# how many random shouts to fetch for a chat at once
+		'shout_cache_batch_size': 64,
+		# avoid repeating any of the last this many shouts sent in a chat
+		'recent_shouts': 8,
+		# save shouts in batches in the background rather than one at a time as they come in.
+		# a batch is saved once it has write_behind_batch_size shouts or is write_behind_interval seconds old.
+		'write_behind': False,
+		'write_behind_batch_size': 100,
+		'write_behind_interval': 1.0,
+		# remember which shouts each of the most recently active chats already has, so that repeats aren't even
+		# sent to the database. up to dedup_filter_error_rate of new shouts are wrongly skipped this way.
+		# each chat takes about 1.8 bytes per dedup_filter_capacity at the default error rate.
+		'dedup_filter_capacity': 4096,
+		'dedup_filter_error_rate': 0.001,
+		'dedup_filter_chats': 1024,
+		# edits to stored shouts are applied in batches like write_behind,
+		# so that a message that's edited several times in a row is only updated once
+		'edit_batch_size': 100,
+		'edit_interval': 1.0,
+		# how many shouts to keep per chat, and for how long. None means no limit. These are checked every
+		# retention_interval seconds, and the oldest shouts over either limit are deleted.
+		'retention_max_shouts': None,
+		'retention_max_age_days': None,
+		# chat ID -> limits for that chat, e.g. {-1001234567890: {'max_shouts': 100_000, 'max_age_days': 365}}
+		'retention_overrides': {},
+		'retention_interval': 3600,
+		# big deletes are done this many rows at a time, pausing this many seconds in between
+		'deletion_chunk_size': 1000,
+		'deletion_pause': 0.1,
+		# what /stats shows: this many top shouters, and shouts per day for this many days
+		'stats_top_shouters': 10,
+		'stats_days': 7,
+		# /stats is cached for this many chats until their shouts change, or for at most this many seconds
+		# in case another process changed them
+		'stats_chats': 1024,
+		'stats_ttl': 60,
+		# /search shows this many shouts at a time, and at most search_max_results in all.
+		# a search that takes longer than search_timeout seconds is given up on.
+		'search_page_size': 5,
+		'search_max_results': 50,
+		'search_timeout': 2.0,
+	},
+
+	# optional. Messages are handled by this many workers, each chat always on the same one.
+	# These are the defaults.
+	'workers': {
+		'workers': 16,
+		# messages that can wait for each worker before new ones are held up
+		'queue_size': 256,
+		# how long to hold up new messages for a full worker before dropping them
+		'backpressure_timeout': 1.0,
+	},
+
+	# optional. Limits on outgoing messages, in messages per second. These are the defaults.
+	'outbox': {
+		'global_rate': 30,
+		'global_burst': 30,
+		# telegram allows about 20 messages per minute in a group
+		'chat_rate': 0.33,
+		'chat_burst': 3,
+		# drop automatic replies that have been waiting this many seconds
+		'stale_after': 30.0,
+	},
+
+	# optional. /remove checks that the user may delete messages, and remembers the answer. These are the defaults.
+	'admin_cache': {
+		# for this many seconds
+		'ttl': 600,
+		# for this many users (and this many chats' lists of admins)
+		'max_size': 10_000,
+		# the first check in a chat fetches all of its admins at once
+		'warm': True,
+	},
+
+	# optional. Serve Prometheus metrics at http://address:port/metrics. Leave this out to not serve them.
+	'metrics': {
+		'port': 9108,
+		# keep this local unless you want the world to see how often your users shout
+		'address': '127.0.0.1',
+	},
 
 	# @mention of this bot's admin
 	'owner': ...,
-	# set of user IDs that can run administrative commands on the bot
+	# set of user IDs that can run administrative commands on the bot.
+	# changes to this take effect on /reload (or kill -HUP). Changes to anything else need a restart.
 	'owner_ids': {
 	},
 }
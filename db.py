@@ -13,50 +13,1191 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
 
+import abc
+import asyncio
+import collections
+import contextlib
+import datetime
+import hashlib
+import logging
+import math
+import random
+import sys
+import time
+from types import SimpleNamespace
+
 import asyncpg
 import jinja2
 import telethon.utils
 from telethon.tl import types
 from telethon.extensions import BinaryReader
 
-class Database:
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# the chat IDs of basic groups, as telethon marks them. message IDs are unique across all of a bot's basic groups
+# (and DMs), so telegram doesn't say which chat deletions in them were from.
+# the partial indexes on shout (message_id) in schema.sql and sqlite_schema.sql have these written out.
+BASIC_GROUP_MIN_ID = -999999999999
+BASIC_GROUP_MAX_ID = -1
+
+def is_basic_group(chat_id):
+	return BASIC_GROUP_MIN_ID <= chat_id <= BASIC_GROUP_MAX_ID
+
+def load_queries(path='queries.sql'):
+	"""Render every macro in queries.sql once. Returns a namespace mapping each macro name to its SQL."""
+	with open(path) as f:
+		# as literals rather than parameters, so that the planner knows the partial indexes on them apply
+		module = jinja2.Template(f.read(), line_statement_prefix='-- :').make_module({
+			'basic_group_min_id': BASIC_GROUP_MIN_ID,
+			'basic_group_max_id': BASIC_GROUP_MAX_ID,
+		})
+	queries = SimpleNamespace(**{
+		name: macro()
+		for name, macro in vars(module).items()
+		# macros with arguments are only building blocks for the others
+		if isinstance(macro, jinja2.runtime.Macro) and not macro.arguments
+	})
+	for name, query in vars(queries).items():
+		_query_timers[query] = metrics.QUERY_SECONDS.labels(name)
+	return queries
+
+# query -> histogram of how long it takes, labelled with its macro name
+_query_timers = {}
+_other_query_timer = metrics.QUERY_SECONDS.labels('other')
+
+def _query_timer(query):
+	return _query_timers.get(query, _other_query_timer)
+
+def _timed(name):
+	async def method(self, query, *args, **kwargs):
+		with _query_timer(query).time():
+			return await getattr(self.conn, name)(query, *args, **kwargs)
+	method.__name__ = method.__qualname__ = name
+	return method
+
+class TimedConnection:
+	"""Wraps an asyncpg connection, timing each query by the name of its macro in queries.sql.
+	Anything other than running queries is passed through.
+	"""
+
+	__slots__ = 'conn',
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def __getattr__(self, name):
+		return getattr(self.conn, name)
+
+	fetch = _timed('fetch')
+	fetchrow = _timed('fetchrow')
+	fetchval = _timed('fetchval')
+	execute = _timed('execute')
+
+	async def copy_records_to_table(self, *args, **kwargs):
+		with metrics.QUERY_SECONDS.labels('copy_records_to_table').time():
+			return await self.conn.copy_records_to_table(*args, **kwargs)
+
+class TimedPool:
+	"""Wraps an asyncpg pool, timing how long it takes to get a connection, and each query as TimedConnection does.
+	Only asyncpg's public API is used, so that new versions of it don't quietly stop the timing.
+	"""
+
+	__slots__ = 'pool',
+
 	def __init__(self, pool):
 		self.pool = pool
-		with open('queries.sql') as f:
-			self.queries = jinja2.Template(f.read(), line_statement_prefix='-- :').module
+
+	async def take(self):
+		"""Acquire a connection, for as long as it takes to give it back with release."""
+		with metrics.POOL_ACQUIRE_SECONDS.time():
+			return TimedConnection(await self.pool.acquire())
+
+	async def release(self, conn):
+		await self.pool.release(conn.conn)
+
+	@contextlib.asynccontextmanager
+	async def acquire(self):
+		conn = await self.take()
+		try:
+			yield conn
+		finally:
+			await self.release(conn)
+
+	def _on_connection(name):
+		async def method(self, *args, **kwargs):
+			async with self.acquire() as conn:
+				return await getattr(conn, name)(*args, **kwargs)
+		method.__name__ = method.__qualname__ = name
+		return method
+
+	fetch = _on_connection('fetch')
+	fetchrow = _on_connection('fetchrow')
+	fetchval = _on_connection('fetchval')
+	execute = _on_connection('execute')
+	del _on_connection
+
+	async def close(self):
+		await self.pool.close()
+
+async def create_pool(**kwargs):
+	"""Create a connection pool for a PostgresStorage. Takes the same arguments as asyncpg.create_pool.
+	Each connection prepares every query when it's opened, so that its types are known before the first message
+	arrives. (asyncpg has no public way to put a statement in its cache, so each query is prepared once more
+	the first time it runs, but without looking up its types again.)
+	"""
+	queries = load_queries()
+
+	async def init(conn):
+		for query in vars(queries).values():
+			await conn.prepare(query)
+
+	pool = await asyncpg.create_pool(**kwargs, init=init)
+	metrics.track_pool(pool)
+	return TimedPool(pool)
+
+def sanitize_shout(content, entities):
+	"""Return the content and entities of a shout as they should be stored, so that replying with it won't mention anyone."""
+	content = content.replace('@', '@\N{invisible separator}')
+	entities = [
+		entity for entity in entities or ()
+		if not isinstance(entity, (types.MessageEntityMention, types.MessageEntityMentionName))
+	]
+	return content, entities
+
+# searches for anything shorter can't use the trigram indexes
+SEARCH_MIN_LENGTH = 3
+
+def escape_like(text):
+	"""escape text so that LIKE matches it literally"""
+	return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def shout_digest(content, encoded_entities):
+	"""the same digest of a shout that the database stores in shout.digest"""
+	digest = hashlib.sha256()
+	for part in (content.encode(), *encoded_entities):
+		digest.update(len(part).to_bytes(4, 'big'))
+		digest.update(part)
+	return digest.digest()[:16]
+
+class BloomFilter:
+	"""A set of shout digests which may wrongly claim to contain a digest (at most error_rate of the time,
+	until capacity digests have been added), but never wrongly claims not to.
+	"""
+
+	__slots__ = 'bits', 'size', 'hashes', 'capacity', 'count'
+
+	def __init__(self, capacity, error_rate):
+		self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+		self.hashes = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray(-(-self.size // 8))
+		self.capacity = capacity
+		self.count = 0
+
+	def _positions(self, digest):
+		# digests are already uniformly distributed, so derive every position from two halves of one
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:16], 'little') | 1
+		return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+	def add(self, digest):
+		for position in self._positions(digest):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, digest):
+		bits = self.bits
+		return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+	@property
+	def full(self):
+		return self.count >= self.capacity
+
+class _ChatShouts:
+	__slots__ = 'candidates', 'recent', 'count', 'size', 'loaded_at', 'generation', 'refill_task'
+
+	def __init__(self, recent_size):
+		# (message, size) pairs, in random order
+		self.candidates = []
+		# IDs of the shouts most recently sent in this chat
+		self.recent = collections.deque(maxlen=recent_size)
+		# number of shouts the chat has in total, as of the last refill
+		self.count = 0
+		self.size = 0
+		self.loaded_at = None
+		# bumped whenever a shout is removed, so that an in flight refill knows its results may be stale
+		self.generation = 0
+		self.refill_task = None
+
+	def is_recent(self, message_id):
+		# a chat with only a couple shouts can't avoid repeating itself
+		window = min(len(self.recent), self.count - 1)
+		return window > 0 and message_id in list(self.recent)[-window:]
+
+class ShoutCache:
+	"""Keeps a random sample of decoded shouts for the most recently active chats,
+	so that most replies don't need a round trip to the database.
+	"""
+
+	# don't keep believing that a chat has no shouts for too long, in case another process saved some
+	EMPTY_CHAT_TTL = 60
+
+	def __init__(self, fetch, *, max_size, batch_size, recent_size):
+		# fetch(chat_id, n) -> (count, [(message, size)])
+		self.fetch = fetch
+		self.max_size = max_size
+		self.batch_size = batch_size
+		self.recent_size = recent_size
+		# refill in the background once a chat gets this low
+		self.low_water = batch_size // 4
+		self.chats = collections.OrderedDict()
+		self.size = 0
+
+	def _chat(self, chat_id):
+		try:
+			chat = self.chats[chat_id]
+		except KeyError:
+			chat = self.chats[chat_id] = _ChatShouts(self.recent_size)
+		else:
+			self.chats.move_to_end(chat_id)
+		return chat
+
+	def _needs_refill(self, chat):
+		return not chat.candidates and (
+			chat.count or chat.loaded_at is None or time.monotonic() - chat.loaded_at > self.EMPTY_CHAT_TTL
+		)
+
+	async def random_shout(self, chat_id):
+		chat = self._chat(chat_id)
+		if self._needs_refill(chat):
+			await self._refill(chat_id, chat)
+		return self._pop(chat_id, chat)
+
+	def random_shout_nowait(self, chat_id):
+		"""Pick a shout only if that doesn't require waiting on the database.
+		Returns (hit, shout). If hit is False, the shout has to be fetched some other way,
+		and the chat is refilled in the background.
+		"""
+		chat = self._chat(chat_id)
+		if self._needs_refill(chat):
+			self._schedule_refill(chat_id, chat)
+			return False, None
+		return True, self._pop(chat_id, chat)
+
+	def sent(self, chat_id, message_id):
+		"""record that a shout which didn't come from the cache was sent"""
+		chat = self.chats.get(chat_id)
+		if chat is not None:
+			chat.recent.append(message_id)
+
+	def _pop(self, chat_id, chat):
+		shout = skipped = None
+		while chat.candidates:
+			candidate, size = chat.candidates.pop()
+			self._shrink(chat, size)
+			if not chat.is_recent(candidate.id):
+				shout = candidate
+				break
+			skipped = skipped or candidate
+		else:
+			shout = skipped
+
+		if len(chat.candidates) <= self.low_water and chat.count > len(chat.candidates):
+			self._schedule_refill(chat_id, chat)
+
+		if shout is not None:
+			chat.recent.append(shout.id)
+		return shout
+
+	def _schedule_refill(self, chat_id, chat):
+		if chat.refill_task is None:
+			chat.refill_task = asyncio.ensure_future(self._do_refill(chat_id, chat))
+		return chat.refill_task
+
+	async def _refill(self, chat_id, chat):
+		# shield so that a cancelled reply doesn't cancel the refill other replies may be waiting on
+		await asyncio.shield(self._schedule_refill(chat_id, chat))
+
+	async def _do_refill(self, chat_id, chat):
+		generation = chat.generation
+		try:
+			count, shouts = await self.fetch(chat_id, self.batch_size)
+		except Exception:
+			logger.exception('Refilling the shout cache for chat %s failed', chat_id)
+			return
+		finally:
+			chat.refill_task = None
+
+		if self.chats.get(chat_id) is not chat or chat.generation != generation:
+			# evicted or modified while we were waiting
+			return
+
+		chat.count = count
+		chat.loaded_at = time.monotonic()
+		have = {message.id for message, size in chat.candidates}
+		for message, size in shouts:
+			if message.id not in have:
+				chat.candidates.append((message, size))
+				self._grow(chat, size)
+		random.shuffle(chat.candidates)
+		self._evict()
+
+	def add(self, chat_id, message, size):
+		"""record that a new shout was saved"""
+		chat = self.chats.get(chat_id)
+		if chat is None:
+			return
+
+		chat.count += 1
+		# keep the candidates a uniform sample of the whole chat
+		if len(chat.candidates) < self.batch_size and chat.count <= self.batch_size:
+			chat.candidates.insert(random.randint(0, len(chat.candidates)), (message, size))
+		elif chat.candidates and random.random() < len(chat.candidates) / chat.count:
+			i = random.randrange(len(chat.candidates))
+			self._shrink(chat, chat.candidates[i][1])
+			chat.candidates[i] = message, size
+		else:
+			return
+		self._grow(chat, size)
+		self._evict()
+
+	def discard(self, chat_id, message_id):
+		"""record that a shout was removed or changed"""
+		chat = self.chats.get(chat_id)
+		if chat is None:
+			return
+
+		chat.generation += 1
+		for i, (message, size) in enumerate(chat.candidates):
+			if message.id == message_id:
+				del chat.candidates[i]
+				self._shrink(chat, size)
+				break
+
+	def discard_chat(self, chat_id):
+		chat = self.chats.pop(chat_id, None)
+		if chat is not None:
+			chat.generation += 1
+			self.size -= chat.size
+
+	def _grow(self, chat, size):
+		chat.size += size
+		self.size += size
+
+	def _shrink(self, chat, size):
+		chat.size -= size
+		self.size -= size
+
+	def _evict(self):
+		# always keep the most recently used chat, even if it's larger than the whole budget
+		while self.size > self.max_size and len(self.chats) > 1:
+			chat_id, chat = self.chats.popitem(last=False)
+			chat.generation += 1
+			self.size -= chat.size
+
+class ShoutQueue:
+	"""Collects shouts to be written so that they can be written in batches,
+	once enough of them have piled up or once the oldest has waited long enough.
+	Putting a shout that's already queued replaces it.
+	"""
+
+	def __init__(self, flush, *, max_size, interval):
+		# flush(batch) where batch is a dict of (chat_id, message_id) -> shout
+		self._flush = flush
+		self.max_size = max_size
+		self.interval = interval
+		self.pending = {}
+		# the batch currently being inserted, and a future that is done once it has been
+		self.flushing = {}
+		self._flushed = None
+		self._timer = None
+		self._lock = asyncio.Lock()
+		# total number of shouts that have been through the queue
+		self.flushed_count = 0
+
+	def __len__(self):
+		return len(self.pending) + len(self.flushing)
+
+	def put(self, key, shout):
+		self.pending[key] = shout
+		if len(self.pending) >= self.max_size:
+			asyncio.ensure_future(self.flush())
+		elif self._timer is None:
+			self._timer = asyncio.get_event_loop().call_later(
+				self.interval,
+				lambda: asyncio.ensure_future(self.flush()),
+			)
+
+	def get(self, key):
+		return self.pending.get(key)
+
+	async def remove(self, key):
+		"""remove a shout that hasn't been written yet. Returns whether it was queued.
+		If it's being written right now, wait for that to finish instead, so that it can then be deleted normally.
+		"""
+		if self.pending.pop(key, None) is not None:
+			return True
+		await self.settle(key)
+		return False
+
+	async def settle(self, key):
+		"""if the shout is being written right now, wait for that to finish"""
+		if key in self.flushing:
+			await asyncio.shield(self._flushed)
+
+	async def flush(self):
+		async with self._lock:
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+			if not self.pending:
+				return
+
+			self.flushing, self.pending = self.pending, {}
+			self._flushed = asyncio.get_event_loop().create_future()
+			try:
+				await self._flush(self.flushing)
+			except Exception:
+				# the inline path would have lost these shouts too
+				logger.exception('Writing a batch of %d shouts failed', len(self.flushing))
+			finally:
+				self.flushed_count += len(self.flushing)
+				self.flushing = {}
+				self._flushed.set_result(None)
+
+class ChatStats:
+	"""A chat's shout statistics, as of fetched_at. top_shouters is [(user_id, shouts)], most first,
+	and days is [(date, shouts)] for each of the last few days, oldest first.
+	response is for the caller to keep whatever it made of them, which goes stale along with them.
+	"""
+
+	__slots__ = 'total', 'top_shouters', 'days', 'fetched_at', 'response'
+
+	def __init__(self, total, top_shouters, days):
+		self.total = total
+		self.top_shouters = top_shouters
+		self.days = days
+		self.fetched_at = time.monotonic()
+		self.response = None
+
+class Storage(abc.ABC):
+	"""Where a Database keeps everything. The Database does the caching and batching, and the Storage does the rest.
+	Entities are passed to and from it encoded, as lists of bytes.
+	A backend has to implement every method, or it can't be created.
+	"""
+
+	@abc.abstractmethod
+	async def close(self):
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def listen_for_opt_changes(self, on_change, on_lost):
+		"""Return every opt state as a dict of peer_id -> state, and call on_change(peer_id, state) for each change from
+		then on (state is None if the peer's state was removed). If changes can't be followed any more, call on_lost()
+		once, after which this may be called again.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def stop_listening(self):
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def state_for(self, peer_id):
+		"""the peer's own state, or None"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def state(self, peer_id, user_id):
+		"""whether the user is opted in within the chat"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def toggle_state(self, peer_id, default_new_state):
+		"""toggle the peer's state, or set it to default_new_state if it has none. Returns the new state."""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def set_state(self, peer_id, new_state):
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def handle_shout(self, chat_id, user_id, message_id, content, encoded_entities, want_reply, save):
+		"""Check whether the user is opted in and if so, pick a random shout from the chat if want_reply,
+		and then save this one if save. Returns (opted in, whether it was saved, reply),
+		where reply is (message_id, content, encoded_entities), or None.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def save_shout(self, chat_id, message_id, content, encoded_entities, user_id):
+		"""Returns whether it was saved, which it isn't if it's already stored or a duplicate.
+		user_id is the sender, or None if that isn't known.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def save_shouts(self, records):
+		"""Save (chat_id, message_id, content, encoded_entities, user_id) records.
+		Returns (chat_id, message_id) of the new ones.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def random_shouts(self, chat_id, n):
+		"""Returns the number of shouts in the chat and up to n distinct random ones from it,
+		as (message_id, content, encoded_entities). If the whole chat fits, all of it is returned.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def update_shout(self, chat_id, message_id, content):
+		"""Change a shout's content, or delete it if that would make it a duplicate."""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def update_shouts(self, records):
+		"""update_shout for each of many (chat_id, message_id, content, encoded_entities) records"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def delete_shout(self, chat_id, message_id):
+		"""Returns how many shouts were deleted."""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def delete_shouts(self, chat_id, message_ids):
+		"""Returns (chat_id, message_id) of each deleted shout. If chat_id is None, the shouts may be in any basic group."""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def delete_chat_shouts(self, chat_id, n):
+		"""Delete up to n of the chat's shouts. Returns their message IDs."""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def forget_chat(self, chat_id):
+		"""clean up after all of a chat's shouts have been deleted"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def shout_chats(self):
+		"""the IDs of the chats that have shouts"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def delete_old_shouts(self, chat_id, max_shouts, cutoff, n):
+		"""Of the chat's n oldest shouts, delete those which aren't among its newest max_shouts, or were sent before
+		the cutoff datetime. Either limit may be None. Returns the message IDs of the deleted shouts.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def backfill_checkpoint(self, chat_id):
+		"""the ID of the last message that was backfilled in the chat, or None"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def copy_shouts(self, chat_id, records, last_message_id):
+		"""Bulk load (message_id, content, encoded_entities, time, user_id) records into the chat, skipping those that
+		are already stored, and set the chat's backfill checkpoint to last_message_id in the same transaction.
+		Returns how many were saved.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def shout_stats(self, chat_id, n, since):
+		"""Returns how many shouts the chat has, its top n shouters as (user_id, shouts), most first,
+		and (date, shouts) for each day (UTC) since the since date that has any, in order.
+		These come from counters kept up to date as shouts are saved and deleted, not from counting shouts.
+		"""
+		raise NotImplementedError
+
+	@abc.abstractmethod
+	async def search_shouts(self, chat_id, text, before, n, timeout):
+		"""Returns (message_id, content) for up to n of the chat's shouts that contain text, ignoring case,
+		newest first, and only those before the message ID before unless it's None.
+		Raises asyncio.TimeoutError if the search takes more than timeout seconds.
+		"""
+		raise NotImplementedError
+
+class PostgresStorage(Storage):
+	def __init__(self, pool):
+		self.pool = pool
+		self.queries = load_queries()
+		self._opt_conn = None
+		self._on_opt_change = self._on_opt_lost = None
+
+	@classmethod
+	async def connect(cls, **kwargs):
+		"""Takes the same arguments as asyncpg.create_pool."""
+		return cls(await create_pool(**kwargs))
+
+	async def close(self):
+		await self.stop_listening()
+		await self.pool.close()
+
+	async def listen_for_opt_changes(self, on_change, on_lost):
+		self._on_opt_change = on_change
+		self._on_opt_lost = on_lost
+		conn = await self.pool.take()
+		try:
+			# listen before loading so that no change can slip in between
+			await conn.add_listener('opt', self._on_opt_notification)
+			states = dict(await conn.fetch(self.queries.all_states))
+		except BaseException:
+			await self.pool.release(conn)
+			raise
+		conn.add_termination_listener(self._on_opt_listener_lost)
+		self._opt_conn = conn
+		return states
+
+	async def stop_listening(self):
+		conn, self._opt_conn = self._opt_conn, None
+		if conn is not None:
+			conn.remove_termination_listener(self._on_opt_listener_lost)
+			await conn.remove_listener('opt', self._on_opt_notification)
+			await self.pool.release(conn)
+
+	def _on_opt_notification(self, conn, pid, channel, payload):
+		peer_id, _, state = payload.partition(' ')
+		self._on_opt_change(int(peer_id), state == 'true' if state else None)
+
+	def _on_opt_listener_lost(self, conn):
+		# the pool's, rather than the one passed in
+		conn, self._opt_conn = self._opt_conn, None
+		if conn is not None:
+			asyncio.ensure_future(self.pool.release(conn))
+		self._on_opt_lost()
+
+	async def state_for(self, peer_id):
+		return await self.pool.fetchval(self.queries.state_for, peer_id)
+
+	async def state(self, peer_id, user_id):
+		return await self.pool.fetchval(self.queries.state, peer_id, user_id)
+
+	async def toggle_state(self, peer_id, default_new_state):
+		return await self.pool.fetchval(self.queries.toggle_state, peer_id, default_new_state)
+
+	async def set_state(self, peer_id, new_state):
+		await self.pool.execute(self.queries.set_state, peer_id, new_state)
+
+	async def handle_shout(self, chat_id, user_id, message_id, content, encoded_entities, want_reply, save):
+		row = await self.pool.fetchrow(
+			self.queries.handle_shout,
+			chat_id, user_id, message_id, content, encoded_entities, want_reply, save,
+		)
+		reply = None if row['message_id'] is None else (row['message_id'], row['content'], row['entities'])
+		return row['state'], row['saved'], reply
+
+	async def save_shout(self, chat_id, message_id, content, encoded_entities, user_id):
+		tag = await self.pool.execute(self.queries.save_shout, chat_id, message_id, content, encoded_entities, user_id)
+		return tag == 'INSERT 0 1'
+
+	async def save_shouts(self, records):
+		# user IDs go alongside the shout_records, since the type doesn't have them
+		return await self.pool.fetch(
+			self.queries.save_shouts,
+			[record[:4] for record in records],
+			[user_id for *_, user_id in records],
+		)
+
+	async def random_shouts(self, chat_id, n):
+		rows = await self.pool.fetch(self.queries.random_shouts, chat_id, n)
+		if not rows:
+			return 0, []
+		return rows[0]['count'], [(message_id, content, entities) for message_id, content, entities, count in rows]
 
 	async def update_shout(self, chat_id, message_id, content):
 		async with self.pool.acquire() as conn, conn.transaction():
 			try:
-				await conn.execute(self.queries.update_shout(), chat_id, message_id, content)
+				# in a savepoint, so that the transaction is still usable if this fails
+				async with conn.transaction():
+					await conn.execute(self.queries.update_shout, chat_id, message_id, content)
 			except asyncpg.UniqueViolationError:
 				# don't store duplicate shouts
-				await self.delete_shout(chat_id, message_id, connection=conn)
+				await conn.execute(self.queries.delete_shout, chat_id, message_id)
+
+	async def update_shouts(self, records):
+		async with self.pool.acquire() as conn:
+			try:
+				await conn.execute(self.queries.update_shouts, records)
+			except asyncpg.UniqueViolationError:
+				# some of them are now duplicates of other shouts. find out which by updating them one at a time.
+				for record in records:
+					try:
+						await conn.execute(self.queries.update_shouts, [record])
+					except asyncpg.UniqueViolationError:
+						# don't store duplicate shouts
+						await conn.execute(self.queries.delete_shout, *record[:2])
+
+	async def delete_shout(self, chat_id, message_id):
+		tag = await self.pool.execute(self.queries.delete_shout, chat_id, message_id)
+		return int(tag.split()[-1])
+
+	async def delete_shouts(self, chat_id, message_ids):
+		if chat_id is None:
+			return await self.pool.fetch(self.queries.delete_group_shouts, message_ids)
+		return await self.pool.fetch(self.queries.delete_shouts, chat_id, message_ids)
+
+	async def delete_chat_shouts(self, chat_id, n):
+		return [message_id for message_id, in await self.pool.fetch(self.queries.delete_chat_shouts, chat_id, n)]
+
+	async def forget_chat(self, chat_id):
+		await self.pool.execute(self.queries.forget_chat, chat_id)
+
+	async def shout_chats(self):
+		return [chat_id for chat_id, in await self.pool.fetch(self.queries.shout_chats)]
+
+	async def delete_old_shouts(self, chat_id, max_shouts, cutoff, n):
+		rows = await self.pool.fetch(self.queries.delete_old_shouts, chat_id, max_shouts, cutoff, n)
+		return [message_id for message_id, in rows]
+
+	async def backfill_checkpoint(self, chat_id):
+		return await self.pool.fetchval(self.queries.backfill_checkpoint, chat_id)
+
+	async def copy_shouts(self, chat_id, records, last_message_id):
+		while True:
+			# COPY can't skip conflicting rows, so leave out the ones that would conflict beforehand
+			unique = {}
+			for record in records:
+				message_id, content, encoded_entities, sent_at, user_id = record
+				unique.setdefault(shout_digest(content, encoded_entities), record)
+
+			try:
+				async with self.pool.acquire() as conn, conn.transaction():
+					stored = await conn.fetch(
+						self.queries.stored_shouts,
+						chat_id, [message_id for message_id, *_ in unique.values()], list(unique),
+					)
+					stored_ids = {row['message_id'] for row in stored}
+					stored_digests = {row['digest'] for row in stored}
+					new = [
+						(chat_id, *record)
+						for digest, record in unique.items()
+						if digest not in stored_digests and record[0] not in stored_ids
+					]
+					if new:
+						await conn.copy_records_to_table(
+							'shout',
+							records=new,
+							columns=('chat_id', 'message_id', 'content', 'entities', 'time', 'user_id'),
+						)
+					await conn.execute(self.queries.set_backfill_checkpoint, chat_id, last_message_id)
+			except asyncpg.UniqueViolationError:
+				# the bot saved one of them while we were checking. try again.
+				continue
+			return len(new)
+
+	async def shout_stats(self, chat_id, n, since):
+		row = await self.pool.fetchrow(self.queries.shout_stats, chat_id, n, since)
+		return row['count'] or 0, [tuple(top) for top in row['top']], [tuple(day) for day in row['days']]
+
+	async def search_shouts(self, chat_id, text, before, n, timeout):
+		# asyncpg cancels the query when it times out, so that the connection is free again
+		rows = await self.pool.fetch(self.queries.search_shouts, chat_id, f'%{escape_like(text)}%', before, n, timeout=timeout)
+		return [tuple(row) for row in rows]
+
+async def open_storage(config):
+	"""Open the Storage that config.py asks for: SQLite if 'sqlite' is set, otherwise PostgreSQL."""
+	if config.get('sqlite') is not None:
+		import sqlite_db
+		return await sqlite_db.SQLiteStorage.connect(config['sqlite'])
+	return await PostgresStorage.connect(**config['database'])
+
+class Database:
+	def __init__(
+		self,
+		storage,
+		*,
+		shout_cache_size=16_000_000,
+		shout_cache_batch_size=64,
+		recent_shouts=8,
+		write_behind=False,
+		write_behind_batch_size=100,
+		write_behind_interval=1.0,
+		dedup_filter_capacity=4096,
+		dedup_filter_error_rate=0.001,
+		dedup_filter_chats=1024,
+		edit_batch_size=100,
+		edit_interval=1.0,
+		retention_max_shouts=None,
+		retention_max_age_days=None,
+		retention_overrides=None,
+		retention_interval=3600,
+		deletion_chunk_size=1000,
+		deletion_pause=0.1,
+		stats_top_shouters=10,
+		stats_days=7,
+		stats_ttl=60,
+		stats_chats=1024,
+		search_page_size=5,
+		search_max_results=50,
+		search_timeout=2.0,
+	):
+		self.storage = storage
+		self.shout_cache = ShoutCache(
+			self._random_shouts,
+			max_size=shout_cache_size,
+			batch_size=shout_cache_batch_size,
+			recent_size=recent_shouts,
+		)
+		self.shout_queue = ShoutQueue(
+			self._save_shouts,
+			max_size=write_behind_batch_size,
+			interval=write_behind_interval,
+		) if write_behind else None
+		# (chat_id, message_id) -> the edited shout, or None if it's no longer a shout
+		self.edit_queue = ShoutQueue(self._apply_edits, max_size=edit_batch_size, interval=edit_interval)
+		# chat_id -> BloomFilter of the digests of some of the chat's stored shouts, least recently used first.
+		# a shout that's in its chat's filter isn't worth trying to insert.
+		self.dedup_filters = collections.OrderedDict()
+		self.dedup_filter_capacity = dedup_filter_capacity
+		self.dedup_filter_error_rate = dedup_filter_error_rate
+		self.dedup_filter_chats = dedup_filter_chats
+		# the default (max shouts, max age in days) to keep per chat. None means unlimited.
+		self.retention = retention_max_shouts, retention_max_age_days
+		# chat_id -> {'max_shouts': ..., 'max_age_days': ...}, overriding the defaults for that chat
+		self.retention_overrides = retention_overrides or {}
+		self.retention_interval = retention_interval
+		# big deletes are split into chunks of this many rows, with this many seconds between them,
+		# so that they don't hold locks for long
+		self.deletion_chunk_size = deletion_chunk_size
+		self.deletion_pause = deletion_pause
+		# chat_id -> ChatStats, least recently used first. dropped whenever the chat's shouts change,
+		# and refetched after stats_ttl seconds in case another process changed them.
+		self.stats = collections.OrderedDict()
+		self.stats_top_shouters = stats_top_shouters
+		self.stats_days = stats_days
+		self.stats_ttl = stats_ttl
+		self.stats_chats = stats_chats
+		# /search shows this many shouts at a time, stops after search_max_results,
+		# and gives up on a query that takes longer than search_timeout seconds
+		self.search_page_size = search_page_size
+		self.search_max_results = search_max_results
+		self.search_timeout = search_timeout
+		self._background_tasks = set()
+		# peer_id -> state, mirroring the opt table. None if it couldn't be kept up to date.
+		self.opt_states = None
+		self._closed = False
+
+	async def start(self):
+		"""Warm up the caches. Call this once before handling any events."""
+		await self._listen_for_opt_changes()
+
+	def start_retention(self):
+		"""Start deleting shouts that are over their chat's retention limits, every retention_interval seconds."""
+		if self.retention != (None, None) or self.retention_overrides:
+			self._run_in_background(self._enforce_retention_periodically())
+
+	def _run_in_background(self, coro):
+		task = asyncio.ensure_future(coro)
+		self._background_tasks.add(task)
+		task.add_done_callback(self._background_tasks.discard)
+
+	async def close(self):
+		"""Write everything that's queued. The storage is left open."""
+		self._closed = True
+		for task in self._background_tasks:
+			task.cancel()
+		await asyncio.gather(*self._background_tasks, return_exceptions=True)
+		if self.shout_queue is not None:
+			await self.shout_queue.flush()
+		await self.edit_queue.flush()
+		await self.storage.stop_listening()
+
+	async def _listen_for_opt_changes(self):
+		self.opt_states = await self.storage.listen_for_opt_changes(self._on_opt_change, self._on_opt_listener_lost)
+
+	def _on_opt_change(self, peer_id, state):
+		if self.opt_states is None:
+			return
+		if state is None:
+			self.opt_states.pop(peer_id, None)
+		else:
+			self.opt_states[peer_id] = state
+
+	def _on_opt_listener_lost(self):
+		logger.warning('Lost the connection listening for opt changes; querying opt states directly until it is back')
+		self.opt_states = None
+		asyncio.ensure_future(self._relisten())
+
+	async def _relisten(self):
+		delay = 1
+		while not self._closed:
+			try:
+				await self._listen_for_opt_changes()
+			except Exception:
+				logger.exception('Listening for opt changes failed, retrying in %s seconds', delay)
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, 60)
+			else:
+				logger.info('Listening for opt changes again')
+				return
+
+	@property
+	def shout_queue_depth(self):
+		"""how many shouts are waiting to be saved"""
+		return 0 if self.shout_queue is None else len(self.shout_queue)
+
+	def _probably_stored(self, chat_id, shout):
+		dedup_filter = self.dedup_filters.get(chat_id)
+		if dedup_filter is None:
+			return False
+		self.dedup_filters.move_to_end(chat_id)
+		return shout['digest'] in dedup_filter
+
+	def _mark_stored(self, chat_id, digest):
+		dedup_filter = self.dedup_filters.get(chat_id)
+		if dedup_filter is None or dedup_filter.full:
+			# start over rather than let the false positive rate climb
+			dedup_filter = self.dedup_filters[chat_id] = BloomFilter(
+				self.dedup_filter_capacity, self.dedup_filter_error_rate,
+			)
+			while len(self.dedup_filters) > self.dedup_filter_chats:
+				self.dedup_filters.popitem(last=False)
+		dedup_filter.add(digest)
+
+	def _forget_stored(self, chat_id):
+		# filters can't have anything removed from them
+		self.dedup_filters.pop(chat_id, None)
+
+	def _cache_state(self, peer_id, state):
+		if self.opt_states is not None:
+			self.opt_states[peer_id] = state
+
+	async def update_shout(self, chat_id, message_id, content):
+		queued = self.shout_queue is not None and self.shout_queue.get((chat_id, message_id))
+		if queued:
+			# it'll be inserted with the new content in due course
+			queued['content'] = content
+			queued['message'].message = content
+			queued['digest'] = shout_digest(content, queued['encoded_entities'])
+			return
+
+		await self.storage.update_shout(chat_id, message_id, content)
+		self.shout_cache.discard(chat_id, message_id)
+		self._forget_stored(chat_id)
+		# it may have been deleted as a duplicate
+		self._stats_changed(chat_id)
+
+	def edit_shout(self, chat_id, message_id, content, entities, *, is_shout=True):
+		"""Record that a message was edited. If it's a stored shout, it's updated (or deleted if it's no longer a shout,
+		or is now a duplicate) a little later, so that several edits in a row only cost one update.
+		"""
+		key = chat_id, message_id
+		shout = self._shout(chat_id, message_id, content, entities) if is_shout else None
+		queued = self.shout_queue is not None and self.shout_queue.get(key)
+		if queued:
+			# it hasn't been inserted yet, so insert the new version instead
+			if shout is None:
+				del self.shout_queue.pending[key]
+			else:
+				shout['user_id'] = queued['user_id']
+				self.shout_queue.pending[key] = shout
+			self._forget_stored(chat_id)
+			return
+		self.edit_queue.put(key, shout)
+
+	async def _apply_edits(self, batch):
+		if self.shout_queue is not None:
+			for key in batch:
+				await self.shout_queue.settle(key)
+
+		deleted = collections.defaultdict(list)
+		updated = []
+		for (chat_id, message_id), shout in batch.items():
+			if shout is None:
+				deleted[chat_id].append(message_id)
+			else:
+				updated.append((chat_id, message_id, shout['content'], shout['encoded_entities']))
+
+		for chat_id, message_ids in deleted.items():
+			await self._delete_shouts(chat_id, message_ids)
+		if not updated:
+			return
+
+		await self.storage.update_shouts(updated)
+		for chat_id, message_id, *_ in updated:
+			self.shout_cache.discard(chat_id, message_id)
+			self._forget_stored(chat_id)
+			# some may have been deleted as duplicates
+			self._stats_changed(chat_id)
+
+	def _shout(self, chat_id, message_id, content, entities, user_id=None):
+		content, entities = sanitize_shout(content, entities)
+		encoded_entities = list(map(bytes, entities))
+		return dict(
+			user_id=user_id,
+			content=content,
+			encoded_entities=encoded_entities,
+			message=self._shout_message(chat_id, message_id, content, entities),
+			size=self._shout_size(content, encoded_entities),
+			digest=shout_digest(content, encoded_entities),
+		)
 
 	async def save_shout(self, message):
-		# sanitize message content
-		content = message.message.replace('@', '@\N{invisible separator}')
-		ixs = []
-		entities = message.entities or []
-		for i, entity in enumerate(entities):
-			if isinstance(entity, (types.MessageEntityMention, types.MessageEntityMentionName)):
-				ixs.append(i)
-		for i in reversed(ixs):
-			del entities[i]
-
-		tag = await self.pool.execute(
-			self.queries.save_shout(),
-			telethon.utils.get_peer_id(message.to_id), message.id, content, list(map(bytes, entities)),
+		"""Save a shout. Returns whether it was new, or None if it was queued to be saved later."""
+		chat_id = telethon.utils.get_peer_id(message.to_id)
+		user_id = message.from_id.user_id if isinstance(message.from_id, types.PeerUser) else None
+		shout = self._shout(chat_id, message.id, message.message, message.entities, user_id)
+		if self._probably_stored(chat_id, shout):
+			return False
+
+		if self.shout_queue is not None:
+			self.shout_queue.put((chat_id, message.id), shout)
+			self._mark_stored(chat_id, shout['digest'])
+			return None
+
+		inserted = await self.storage.save_shout(
+			chat_id, message.id, shout['content'], shout['encoded_entities'], user_id,
 		)
-		return tag == 'INSERT 0 1'
+		if inserted:
+			self.shout_cache.add(chat_id, shout['message'], shout['size'])
+			self._stats_changed(chat_id)
+		# either way, it's stored now
+		self._mark_stored(chat_id, shout['digest'])
+		return inserted
+
+	async def handle_shout(self, chat_id, user_id, message_id, content, entities, want_reply):
+		"""Do everything that a shout needs from the database: check whether the user has opted in,
+		pick a random shout to reply with if want_reply, and save the new shout if they have opted in.
+		This takes at most one round trip, and none if the caches can cover it.
+
+		Returns (opted_in, reply). reply is None if not want_reply or if the chat has no shouts yet.
+		"""
+		shout = self._shout(chat_id, message_id, content, entities, user_id)
+
+		opted_in = None
+		if self.opt_states is not None:
+			opted_in = self._cached_state(chat_id, user_id)
+			if not opted_in:
+				return False, None
+
+		reply = None
+		# if we don't know whether they're opted in yet, the database may as well pick the reply too
+		query_reply = want_reply and opted_in is None
+		if want_reply and opted_in:
+			hit, reply = self.shout_cache.random_shout_nowait(chat_id)
+			query_reply = not hit
+
+		stored = self._probably_stored(chat_id, shout)
+		query_save = self.shout_queue is None and not stored
+		if opted_in and not query_reply and not query_save:
+			if not stored:
+				self.shout_queue.put((chat_id, message_id), shout)
+				self._mark_stored(chat_id, shout['digest'])
+			return True, reply
+
+		opted_in, saved, reply_row = await self.storage.handle_shout(
+			chat_id, user_id, message_id, shout['content'], shout['encoded_entities'],
+			query_reply, query_save,
+		)
+		if not opted_in:
+			return False, None
+
+		if saved:
+			self.shout_cache.add(chat_id, shout['message'], shout['size'])
+			self._stats_changed(chat_id)
+		elif not query_save and not stored:
+			self.shout_queue.put((chat_id, message_id), shout)
+		if not stored:
+			self._mark_stored(chat_id, shout['digest'])
+
+		if query_reply and reply_row is not None:
+			reply_id, reply_content, reply_entities = reply_row
+			reply = self._shout_message(
+				chat_id,
+				reply_id,
+				reply_content,
+				[BinaryReader(encoded).tgread_object() for encoded in reply_entities],
+			)
+			self.shout_cache.sent(chat_id, reply.id)
+		return True, reply
+
+	async def _save_shouts(self, batch):
+		inserted = await self.storage.save_shouts([
+			(chat_id, message_id, shout['content'], shout['encoded_entities'], shout['user_id'])
+			for (chat_id, message_id), shout in batch.items()
+		])
+		for chat_id, message_id in inserted:
+			shout = batch[chat_id, message_id]
+			self.shout_cache.add(chat_id, shout['message'], shout['size'])
+			self._stats_changed(chat_id)
+
+	async def backfill_checkpoint(self, chat_id):
+		"""the ID of the last message that was backfilled in the chat, or 0"""
+		return await self.storage.backfill_checkpoint(chat_id) or 0
+
+	async def copy_shouts(self, chat_id, records, last_message_id):
+		"""Bulk load (message_id, content, encoded_entities, time, user_id) records into the chat, skipping those that
+		are already stored, and set the chat's backfill checkpoint to last_message_id in the same transaction.
+		Returns how many were saved.
+		"""
+		saved = await self.storage.copy_shouts(chat_id, records, last_message_id)
+		if saved:
+			self._stats_changed(chat_id)
+		return saved
+
+	async def chat_stats(self, chat_id):
+		"""Returns the chat's ChatStats, which are cached until its shouts change."""
+		stats = self.stats.get(chat_id)
+		if stats is not None and time.monotonic() - stats.fetched_at < self.stats_ttl:
+			self.stats.move_to_end(chat_id)
+			return stats
+
+		today = datetime.datetime.now(datetime.timezone.utc).date()
+		days = [today - datetime.timedelta(days=i) for i in reversed(range(self.stats_days))]
+		total, top_shouters, day_counts = await self.storage.shout_stats(chat_id, self.stats_top_shouters, days[0])
+		day_counts = dict(day_counts)
+		stats = self.stats[chat_id] = ChatStats(total, top_shouters, [(day, day_counts.get(day, 0)) for day in days])
+		self.stats.move_to_end(chat_id)
+		while len(self.stats) > self.stats_chats:
+			self.stats.popitem(last=False)
+		return stats
+
+	def _stats_changed(self, chat_id):
+		self.stats.pop(chat_id, None)
+
+	async def search_shouts(self, chat_id, text, *, before=None, shown=0):
+		"""Returns the next page of (message_id, content) of the chat's shouts that contain text, newest first,
+		and whether there's another page after it. A page starts before the message ID before (from the newest shout
+		if it's None), and shown is how many results came before it, which search_max_results counts against.
+		The text should be at least SEARCH_MIN_LENGTH characters long, or the index can't help.
+		Shouts that are still queued to be saved aren't found.
+		Raises asyncio.TimeoutError if the search takes longer than search_timeout seconds.
+		"""
+		n = min(self.search_page_size, self.search_max_results - shown)
+		if n <= 0:
+			return [], False
+		# one more than the page, to know whether there's another
+		results = await self.storage.search_shouts(chat_id, text, before, n + 1, self.search_timeout)
+		return results[:n], len(results) > n and shown + n < self.search_max_results
 
 	async def random_shout(self, peer):
-		chat_id = telethon.utils.get_peer_id(peer)
-		row = await self.pool.fetchrow(self.queries.random_shout(), chat_id)
-		if row is None:
-			return None
-		message_id, content, encoded_entities = row
-		entities = [BinaryReader(encoded).tgread_object() for encoded in encoded_entities]
+		return await self.shout_cache.random_shout(telethon.utils.get_peer_id(peer))
+
+	async def _random_shouts(self, chat_id, n):
+		count, rows = await self.storage.random_shouts(chat_id, n)
+		# these are known to be stored, so we may as well remember that
+		for message_id, content, encoded_entities in rows:
+			self._mark_stored(chat_id, shout_digest(content, encoded_entities))
+		return count, [
+			(
+				self._shout_message(
+					chat_id,
+					message_id,
+					content,
+					[BinaryReader(encoded).tgread_object() for encoded in encoded_entities],
+				),
+				self._shout_size(content, encoded_entities),
+			)
+			for message_id, content, encoded_entities in rows
+		]
+
+	@staticmethod
+	def _shout_message(chat_id, message_id, content, entities):
 		return types.Message(
 			id=message_id,
 			peer_id=types.PeerChat(chat_id=chat_id),
@@ -64,23 +1205,142 @@ class Database:
 			entities=entities,
 		)
 
-	async def delete_shout(self, chat_id, message_id, *, connection=None):
-		tag = await (connection or self.pool).execute(self.queries.delete_shout(), chat_id, message_id)
-		return int(tag.split()[-1])
+	@staticmethod
+	def _shout_size(content, encoded_entities):
+		# a rough estimate of how much memory the decoded message takes up. 1000 covers the Message object itself
+		return 1000 + sys.getsizeof(content) + sum(200 + len(encoded) for encoded in encoded_entities)
+
+	async def delete_shout(self, chat_id, message_id):
+		queued = False
+		if self.shout_queue is not None:
+			queued = await self.shout_queue.remove((chat_id, message_id))
+		deleted = await self.storage.delete_shout(chat_id, message_id)
+		self.shout_cache.discard(chat_id, message_id)
+		self._forget_stored(chat_id)
+		if deleted:
+			self._stats_changed(chat_id)
+		return deleted + queued
+
+	async def delete_shouts(self, chat_id, message_ids):
+		"""Delete many shouts from one chat at once. chat_id may be None if the messages weren't in a channel.
+		Returns how many were deleted.
+		"""
+		if chat_id is None:
+			queues = [self.edit_queue] + ([self.shout_queue] if self.shout_queue is not None else [])
+			message_ids = set(message_ids)
+			keys = {
+				key
+				for queue in queues
+				for key in (*queue.pending, *queue.flushing)
+				if key[1] in message_ids and is_basic_group(key[0])
+			}
+		else:
+			keys = [(chat_id, message_id) for message_id in message_ids]
+
+		queued = 0
+		for key in keys:
+			await self.edit_queue.remove(key)
+			if self.shout_queue is not None:
+				queued += await self.shout_queue.remove(key)
+
+		return await self._delete_shouts(chat_id, list(message_ids)) + queued
+
+	async def _delete_shouts(self, chat_id, message_ids):
+		deleted = await self.storage.delete_shouts(chat_id, message_ids)
+		for chat_id, message_id in deleted:
+			self.shout_cache.discard(chat_id, message_id)
+			self._forget_stored(chat_id)
+			self._stats_changed(chat_id)
+		return len(deleted)
 
 	async def delete_by_chat(self, chat_id):
-		tag = await self.pool.execute(self.queries.delete_by_chat(), guild_or_user)
-		return int(tag.split()[-1])
+		"""Delete everything stored about a chat's shouts, a chunk at a time. Returns how many shouts were deleted."""
+		for queue in (queue for queue in (self.shout_queue, self.edit_queue) if queue is not None):
+			for key in [key for key in (*queue.pending, *queue.flushing) if key[0] == chat_id]:
+				await queue.remove(key)
+
+		deleted = 0
+		while True:
+			chunk = await self.storage.delete_chat_shouts(chat_id, self.deletion_chunk_size)
+			deleted += len(chunk)
+			if len(chunk) < self.deletion_chunk_size:
+				break
+			await asyncio.sleep(self.deletion_pause)
+		await self.storage.forget_chat(chat_id)
+
+		self.shout_cache.discard_chat(chat_id)
+		self._forget_stored(chat_id)
+		self._stats_changed(chat_id)
+		return deleted
+
+	def forget_chat(self, chat_id):
+		"""Delete a chat's shouts in the background, e.g. because the bot was removed from it."""
+		self._run_in_background(self._forget_chat(chat_id))
+
+	async def _forget_chat(self, chat_id):
+		try:
+			deleted = await self.delete_by_chat(chat_id)
+		except Exception:
+			logger.exception('Deleting the shouts of chat %d failed', chat_id)
+		else:
+			logger.info('Deleted %d shouts from chat %d', deleted, chat_id)
+
+	def retention_policy(self, chat_id):
+		"""(max shouts, max age in days) to keep in the chat"""
+		max_shouts, max_age_days = self.retention
+		override = self.retention_overrides.get(chat_id, {})
+		return override.get('max_shouts', max_shouts), override.get('max_age_days', max_age_days)
+
+	async def enforce_retention(self):
+		"""Delete the shouts that are over their chat's retention limits. Returns how many were deleted."""
+		deleted = 0
+		for chat_id in await self.storage.shout_chats():
+			max_shouts, max_age_days = self.retention_policy(chat_id)
+			if max_shouts is None and max_age_days is None:
+				continue
+			cutoff = None
+			if max_age_days is not None:
+				cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=max_age_days)
+
+			while True:
+				chunk = await self.storage.delete_old_shouts(chat_id, max_shouts, cutoff, self.deletion_chunk_size)
+				for message_id in chunk:
+					self.shout_cache.discard(chat_id, message_id)
+				if chunk:
+					self._forget_stored(chat_id)
+					self._stats_changed(chat_id)
+				deleted += len(chunk)
+				# everything over the limits is at the start, so anything left over in this chunk is within them
+				if len(chunk) < self.deletion_chunk_size:
+					break
+				await asyncio.sleep(self.deletion_pause)
+		return deleted
+
+	async def _enforce_retention_periodically(self):
+		while not self._closed:
+			try:
+				deleted = await self.enforce_retention()
+			except Exception:
+				logger.exception('Enforcing the retention policy failed')
+			else:
+				if deleted:
+					logger.info('Deleted %d shouts which were over the retention limits', deleted)
+			await asyncio.sleep(self.retention_interval)
 
 	async def state_for(self, peer_id):
-		return await self.pool.fetchval(self.queries.state_for(), peer_id)
+		if self.opt_states is not None:
+			return self.opt_states.get(peer_id)
+		return await self.storage.state_for(peer_id)
 
 	async def toggle_state(self, peer_id, *, default_new_state=False):
 		"""toggle the state for a user or chat. If there's no entry already, new state = default_new_state."""
-		return await self.pool.fetchval(self.queries.toggle_state(), peer_id, default_new_state)
+		new_state = await self.storage.toggle_state(peer_id, default_new_state)
+		self._cache_state(peer_id, new_state)
+		return new_state
 
 	async def set_state(self, peer_id, new_state):
-		await self.pool.execute(self.queries.set_state(), peer_id, new_state)
+		await self.storage.set_state(peer_id, new_state)
+		self._cache_state(peer_id, new_state)
 
 	async def toggle_user_state(self, user_id, chat_id=None) -> bool:
 		"""Toggle whether the user has opted in to the bot.
@@ -97,4 +1357,12 @@ class Database:
 		return await self.toggle_state(user_id, default_new_state=default_new_state)
 
 	async def state(self, peer_id, user_id):
-		return await self.pool.fetchval(self.queries.state(), peer_id, user_id)
+		if self.opt_states is None:
+			return await self.storage.state(peer_id, user_id)
+		return self._cached_state(peer_id, user_id)
+
+	def _cached_state(self, peer_id, user_id):
+		state = self.opt_states.get(user_id)
+		if state is None:
+			state = self.opt_states.get(peer_id, True)  # default state
+		return state
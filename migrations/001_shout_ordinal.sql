@@ -0,0 +1,111 @@
+-- Copyright © 2018–2020 lambda#0987
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- adds the dense per chat ordinal used by random_shout to an existing database
+
+BEGIN;
+
+ALTER TABLE shout ADD COLUMN ordinal INT4;
+
+UPDATE shout s
+SET ordinal = numbered.ordinal
+FROM (
+	SELECT chat_id, message_id, row_number() OVER (PARTITION BY chat_id ORDER BY message_id) - 1 AS ordinal
+	FROM shout) AS numbered
+WHERE (s.chat_id, s.message_id) = (numbered.chat_id, numbered.message_id);
+
+CREATE UNIQUE INDEX shout_ordinal_idx ON shout (chat_id, ordinal);
+
+CREATE TABLE shout_count (
+	chat_id INT8 NOT NULL PRIMARY KEY,
+	count INT4 NOT NULL);
+
+INSERT INTO shout_count (chat_id, count)
+SELECT chat_id, COUNT(*)
+FROM shout
+GROUP BY chat_id;
+
+-- number newly inserted shouts after the current last ordinal of their chat
+CREATE FUNCTION shout_insert_ordinals() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	WITH added AS (
+		SELECT chat_id, COUNT(*) AS n
+		FROM new_shout
+		GROUP BY chat_id
+		ORDER BY chat_id),
+	counter AS (
+		INSERT INTO shout_count AS c (chat_id, count)
+		SELECT chat_id, n FROM added
+		ON CONFLICT (chat_id) DO UPDATE
+		SET count = c.count + EXCLUDED.count
+		RETURNING chat_id, count),
+	numbered AS (
+		SELECT chat_id, message_id, row_number() OVER (PARTITION BY chat_id ORDER BY message_id) AS rn
+		FROM new_shout)
+	UPDATE shout s
+	SET ordinal = counter.count - added.n + numbered.rn - 1
+	FROM numbered JOIN added USING (chat_id) JOIN counter USING (chat_id)
+	WHERE (s.chat_id, s.message_id) = (numbered.chat_id, numbered.message_id);
+
+	RETURN NULL;
+END $$;
+
+-- fill the holes left by deleted shouts with the shouts at the end of their chat
+CREATE FUNCTION shout_delete_ordinals() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	-- lock the counters first so that the renumbering (which is a separate statement)
+	-- also sees shouts that were committed while we were waiting
+	PERFORM 1
+	FROM shout_count
+	WHERE chat_id IN (SELECT chat_id FROM old_shout)
+	ORDER BY chat_id
+	FOR UPDATE;
+
+	WITH removed AS (
+		SELECT chat_id, COUNT(*) AS n
+		FROM old_shout
+		WHERE ordinal IS NOT NULL
+		GROUP BY chat_id),
+	counter AS (
+		UPDATE shout_count c
+		SET count = c.count - removed.n
+		FROM removed
+		WHERE c.chat_id = removed.chat_id
+		RETURNING c.chat_id, c.count),
+	holes AS (
+		SELECT o.chat_id, o.ordinal, row_number() OVER (PARTITION BY o.chat_id ORDER BY o.ordinal) AS rn
+		FROM old_shout o JOIN counter USING (chat_id)
+		WHERE o.ordinal < counter.count),
+	movers AS (
+		SELECT s.chat_id, s.ordinal, row_number() OVER (PARTITION BY s.chat_id ORDER BY s.ordinal) AS rn
+		FROM shout s JOIN counter USING (chat_id)
+		WHERE s.ordinal >= counter.count)
+	UPDATE shout s
+	SET ordinal = holes.ordinal
+	FROM movers JOIN holes USING (chat_id, rn)
+	WHERE (s.chat_id, s.ordinal) = (movers.chat_id, movers.ordinal);
+
+	RETURN NULL;
+END $$;
+
+CREATE TRIGGER shout_insert_ordinals
+AFTER INSERT ON shout
+REFERENCING NEW TABLE AS new_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_insert_ordinals();
+
+CREATE TRIGGER shout_delete_ordinals
+AFTER DELETE ON shout
+REFERENCING OLD TABLE AS old_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_delete_ordinals();
+
+COMMIT;
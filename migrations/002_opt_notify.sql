@@ -0,0 +1,35 @@
+-- Copyright © 2018–2020 lambda#0987
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- notifies bot processes of changes to the opt table so that they can cache it
+
+BEGIN;
+
+-- lets every bot process keep its cached opt states up to date.
+-- payload: "peer_id state", or just "peer_id" if the row was deleted
+CREATE FUNCTION opt_notify() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	IF TG_OP = 'DELETE' THEN
+		PERFORM pg_notify('opt', OLD.peer_id::TEXT);
+	ELSE
+		PERFORM pg_notify('opt', NEW.peer_id || ' ' || NEW.state);
+	END IF;
+	RETURN NULL;
+END $$;
+
+CREATE TRIGGER opt_notify
+AFTER INSERT OR UPDATE OR DELETE ON opt
+FOR EACH ROW EXECUTE PROCEDURE opt_notify();
+
+COMMIT;
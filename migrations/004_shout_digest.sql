@@ -0,0 +1,32 @@
+-- Copyright © 2018–2020 lambda#0987
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- replaces the unique index on the full content of each shout with one on a digest of it. requires PostgreSQL 12.
+-- this rewrites the shout table, so expect it to take a while on a big database.
+
+BEGIN;
+
+CREATE FUNCTION shout_digest(content TEXT, entities BYTEA[]) RETURNS BYTEA
+LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE AS $$
+	SELECT substring(sha256(string_agg(int4send(length(part)) || part, ''::BYTEA ORDER BY i)) FROM 1 FOR 16)
+	FROM unnest(array_prepend(convert_to(content, 'UTF8'), entities)) WITH ORDINALITY AS parts (part, i)
+$$;
+
+ALTER TABLE shout ADD COLUMN digest BYTEA NOT NULL GENERATED ALWAYS AS (shout_digest(content, entities)) STORED;
+
+CREATE UNIQUE INDEX shout_digest_unique_idx ON shout (chat_id, digest);
+DROP INDEX shout_content_unique_idx;
+
+COMMIT;
@@ -0,0 +1,19 @@
+-- Copyright © 2018–2020 lambda#0987
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- how far backfill.py has got through each chat's history
+CREATE TABLE backfill_checkpoint (
+	chat_id INT8 NOT NULL PRIMARY KEY,
+	last_message_id INT4 NOT NULL);
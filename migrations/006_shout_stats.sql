@@ -0,0 +1,85 @@
+-- Copyright © 2020 Io Mintz <io@mintz.cc>
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- records who sent each shout, and keeps per chat, per user, per day shout counts for /stats.
+-- existing shouts are counted under user 0, since their senders aren't known.
+
+BEGIN;
+
+ALTER TABLE shout ADD COLUMN user_id INT8;
+
+-- how many shouts each user has stored in each chat, per day (UTC), kept up to date by the triggers below
+-- so that /stats doesn't have to count shouts
+CREATE TABLE shout_stats (
+	chat_id INT8 NOT NULL,
+	-- 0 for shouts saved before their senders were recorded
+	user_id INT8 NOT NULL,
+	day DATE NOT NULL,
+	count INT4 NOT NULL,
+
+	PRIMARY KEY (chat_id, user_id, day));
+
+CREATE INDEX shout_stats_day_idx ON shout_stats (chat_id, day);
+
+CREATE FUNCTION shout_insert_stats() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	INSERT INTO shout_stats AS s (chat_id, user_id, day, count)
+	SELECT chat_id, COALESCE(user_id, 0), (time AT TIME ZONE 'UTC')::DATE, COUNT(*)
+	FROM new_shout
+	GROUP BY 1, 2, 3
+	-- in a consistent order, so that concurrent inserts can't deadlock
+	ORDER BY 1, 2, 3
+	ON CONFLICT (chat_id, user_id, day) DO UPDATE
+	SET count = s.count + EXCLUDED.count;
+
+	RETURN NULL;
+END $$;
+
+-- counters that reach 0 are left in place, and cleaned up when the chat is forgotten
+CREATE FUNCTION shout_delete_stats() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	WITH removed AS (
+		SELECT chat_id, COALESCE(user_id, 0) AS user_id, (time AT TIME ZONE 'UTC')::DATE AS day, COUNT(*) AS n
+		FROM old_shout
+		GROUP BY 1, 2, 3),
+	locked AS (
+		-- see shout_insert_stats
+		SELECT s.chat_id, s.user_id, s.day
+		FROM shout_stats s JOIN removed USING (chat_id, user_id, day)
+		ORDER BY 1, 2, 3
+		FOR UPDATE OF s)
+	UPDATE shout_stats s
+	SET count = s.count - removed.n
+	FROM removed JOIN locked USING (chat_id, user_id, day)
+	WHERE (s.chat_id, s.user_id, s.day) = (removed.chat_id, removed.user_id, removed.day);
+
+	RETURN NULL;
+END $$;
+
+CREATE TRIGGER shout_insert_stats
+AFTER INSERT ON shout
+REFERENCING NEW TABLE AS new_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_insert_stats();
+
+CREATE TRIGGER shout_delete_stats
+AFTER DELETE ON shout
+REFERENCING OLD TABLE AS old_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_delete_stats();
+
+INSERT INTO shout_stats (chat_id, user_id, day, count)
+SELECT chat_id, 0, (time AT TIME ZONE 'UTC')::DATE, COUNT(*)
+FROM shout
+WHERE time IS NOT NULL
+GROUP BY 1, 2, 3;
+
+COMMIT;
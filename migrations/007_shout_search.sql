@@ -0,0 +1,28 @@
+-- Copyright © 2020 Io Mintz <io@mintz.cc>
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- indexes shouts by their content's trigrams, for /search.
+-- both extensions are trusted, so the database's owner can create them without being a superuser.
+-- on a big shout table, building the index takes a while, and blocks writes until it's done.
+
+BEGIN;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- finds a chat's shouts that contain some text (ILIKE '%text%'), as long as the text is at least 3 characters long
+CREATE INDEX shout_search_idx ON shout USING GIN (chat_id, content gin_trgm_ops);
+
+COMMIT;
@@ -0,0 +1,24 @@
+-- Copyright © 2020 Io Mintz <io@mintz.cc>
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- indexes basic groups' shouts by message ID, for deletions that telegram doesn't say the chat of.
+-- on a big shout table, building the index takes a while, and blocks writes until it's done.
+
+BEGIN;
+
+-- the bounds are db.BASIC_GROUP_MIN_ID and BASIC_GROUP_MAX_ID
+CREATE INDEX shout_group_message_idx ON shout (message_id) WHERE chat_id BETWEEN -999999999999 AND -1;
+
+COMMIT;
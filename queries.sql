@@ -26,34 +26,222 @@ DELETE FROM shout
 WHERE (chat_id, message_id) = ($1, $2)
 -- :endmacro
 
+-- :macro update_shouts()
+-- params: shout_record[]
+-- returns: (chat_id, message_id) of each shout that was updated
+UPDATE shout s
+SET content = e.content, entities = e.entities
+FROM UNNEST($1::shout_record[]) AS e
+WHERE (s.chat_id, s.message_id) = (e.chat_id, e.message_id)
+RETURNING s.chat_id, s.message_id
+-- :endmacro
+
+-- :macro delete_shouts()
+-- params: chat_id, message_ids
+-- returns: (chat_id, message_id) of each shout that was deleted
+DELETE FROM shout
+WHERE chat_id = $1 AND message_id = ANY($2::INT4[])
+RETURNING chat_id, message_id
+-- :endmacro
+
+-- :macro delete_group_shouts()
+-- params: message_ids
+-- returns: (chat_id, message_id) of each shout that was deleted
+-- for deletions that telegram doesn't give the chat of, which only happens outside of channels.
+-- there, message IDs are unique across all of the bot's chats. basic groups are the chat IDs in
+-- [db.BASIC_GROUP_MIN_ID, db.BASIC_GROUP_MAX_ID], which shout_group_message_idx covers.
+DELETE FROM shout
+WHERE message_id = ANY($1::INT4[]) AND chat_id BETWEEN {{ basic_group_min_id }} AND {{ basic_group_max_id }}
+RETURNING chat_id, message_id
+-- :endmacro
+
 -- :macro save_shout()
--- params: chat_id, message_id, content, entities
-INSERT INTO shout(chat_id, message_id, content, entities)
-VALUES($1, $2, $3, $4)
+-- params: chat_id, message_id, content, entities, user_id
+INSERT INTO shout(chat_id, message_id, content, entities, user_id)
+VALUES($1, $2, $3, $4, $5)
+ON CONFLICT DO NOTHING
+-- :endmacro
+
+-- :macro save_shouts()
+-- params: shout_record[], the user_id of each record
+-- returns: (chat_id, message_id) of each shout that wasn't already stored
+INSERT INTO shout (chat_id, message_id, content, entities, user_id)
+SELECT *
+-- the shout_records' fields are expanded into columns
+FROM UNNEST($1::shout_record[], $2::INT8[]) AS records (chat_id, message_id, content, entities, user_id)
 ON CONFLICT DO NOTHING
+RETURNING chat_id, message_id
 -- :endmacro
 
--- :macro random_row_pred(table, pred)
-FROM {{ table }}
-WHERE {{ pred }}
-OFFSET FLOOR(RANDOM() * (
-	SELECT COUNT(*)
-	FROM {{ table }}
-	WHERE {{ pred }}
-))
-FETCH FIRST ROW ONLY
+-- :macro stored_shouts()
+-- params: chat_id, message_ids, digests
+-- returns: the message_id and digest of each shout in the chat which has one of the message_ids or digests
+-- (joining on the arrays makes for index lookups. = ANY would be checked against every shout in the chat.)
+SELECT message_id, digest
+FROM shout
+WHERE chat_id = $1 AND message_id IN (SELECT unnest($2::INT4[]))
+UNION ALL
+SELECT message_id, digest
+FROM shout
+WHERE chat_id = $1 AND digest IN (SELECT unnest($3::BYTEA[]))
+-- :endmacro
+
+-- :macro backfill_checkpoint()
+-- params: chat_id
+SELECT last_message_id
+FROM backfill_checkpoint
+WHERE chat_id = $1
+-- :endmacro
+
+-- :macro set_backfill_checkpoint()
+-- params: chat_id, last_message_id
+INSERT INTO backfill_checkpoint (chat_id, last_message_id)
+VALUES ($1, $2)
+ON CONFLICT (chat_id) DO UPDATE
+SET last_message_id = EXCLUDED.last_message_id
+-- :endmacro
+
+-- :macro handle_shout()
+-- params: chat_id, user_id, message_id, content, entities, want_reply, save
+-- returns: whether the user is opted in, whether the shout was saved, and a random shout from before this one
+-- (all NULL if not want_reply or there aren't any)
+WITH state AS (
+	SELECT {{ state_expr('$1', '$2') }} AS state),
+reply AS (
+	SELECT message_id, content, entities
+	FROM state, shout
+	WHERE state AND $6 AND chat_id = $1 AND ordinal = (
+		SELECT FLOOR(RANDOM() * count)::INT4
+		FROM shout_count
+		WHERE chat_id = $1)),
+saved AS (
+	INSERT INTO shout (chat_id, message_id, content, entities, user_id)
+	SELECT $1, $3, $4, $5, $2
+	FROM state
+	WHERE state AND $7
+	ON CONFLICT DO NOTHING
+	RETURNING 1)
+SELECT state, EXISTS (SELECT FROM saved) AS saved, message_id, content, entities
+FROM state LEFT JOIN reply ON true
 -- :endmacro
 
 -- :macro random_shout()
 -- params: chat_id
 SELECT message_id, content, entities
-{{ random_row_pred('shout', 'chat_id = $1') }}
+FROM shout
+WHERE chat_id = $1 AND ordinal = (
+	SELECT FLOOR(RANDOM() * count)::INT4
+	FROM shout_count
+	WHERE chat_id = $1)
 -- :endmacro
 
--- :macro delete_by_chat()
--- params: chat_id
+-- :macro random_shouts()
+-- params: chat_id, n
+-- returns: up to n distinct random shouts from the chat, each alongside the total number of shouts in the chat.
+-- if the whole chat fits, all of it is returned.
+WITH counter AS (
+	SELECT count
+	FROM shout_count
+	WHERE chat_id = $1)
+SELECT message_id, content, entities, counter.count
+FROM counter, shout
+WHERE chat_id = $1 AND ordinal = ANY(ARRAY(
+	SELECT CASE WHEN count <= $2 THEN i - 1 ELSE FLOOR(RANDOM() * count)::INT4 END
+	FROM counter, generate_series(1, LEAST(count, $2)) AS i))
+-- :endmacro
+
+-- :macro delete_chat_shouts()
+-- params: chat_id, n
+-- returns: the message_id of each deleted shout
+-- deletes up to n of the chat's shouts. they're taken from the end so that the delete trigger has no holes to fill.
 DELETE FROM shout
-WHERE chat_id = $1
+WHERE (chat_id, message_id) IN (
+	SELECT chat_id, message_id
+	FROM shout
+	WHERE chat_id = $1
+	ORDER BY ordinal DESC
+	LIMIT $2)
+RETURNING message_id
+-- :endmacro
+
+-- :macro forget_chat()
+-- params: chat_id
+-- cleans up after all of a chat's shouts have been deleted
+WITH checkpoint AS (
+	DELETE FROM backfill_checkpoint
+	WHERE chat_id = $1),
+stats AS (
+	DELETE FROM shout_stats
+	WHERE chat_id = $1)
+DELETE FROM shout_count
+WHERE chat_id = $1 AND count = 0
+-- :endmacro
+
+-- :macro shout_chats()
+SELECT chat_id
+FROM shout_count
+-- :endmacro
+
+-- :macro delete_old_shouts()
+-- params: chat_id, max_shouts, cutoff, n
+-- returns: the message_id of each deleted shout
+-- looks at the chat's n oldest shouts, and deletes those which are either not among the newest max_shouts
+-- or older than cutoff. a NULL limit doesn't apply.
+WITH oldest AS (
+	SELECT message_id, time, row_number() OVER (ORDER BY message_id) AS rn
+	FROM shout
+	WHERE chat_id = $1
+	ORDER BY message_id
+	LIMIT $4),
+doomed AS (
+	SELECT message_id
+	FROM oldest, shout_count c
+	WHERE c.chat_id = $1 AND (rn <= c.count - $2 OR time < $3))
+DELETE FROM shout s
+USING doomed
+WHERE s.chat_id = $1 AND s.message_id = doomed.message_id
+RETURNING s.message_id
+-- :endmacro
+
+-- :macro shout_stats()
+-- params: chat_id, n, since
+-- returns: how many shouts the chat has, its top n shouters with how many shouts each has,
+-- and how many of its shouts are from each day since the since date
+SELECT
+	(SELECT count FROM shout_count WHERE chat_id = $1) AS count,
+	ARRAY(
+		SELECT ROW(user_id, SUM(count))
+		FROM shout_stats
+		WHERE chat_id = $1 AND user_id != 0
+		GROUP BY user_id
+		HAVING SUM(count) > 0
+		ORDER BY SUM(count) DESC, user_id
+		LIMIT $2) AS top,
+	ARRAY(
+		SELECT ROW(day, SUM(count))
+		FROM shout_stats
+		WHERE chat_id = $1 AND day >= $3
+		GROUP BY day
+		ORDER BY day) AS days
+-- :endmacro
+
+-- :macro search_shouts()
+-- params: chat_id, pattern, before, n
+-- returns: the message_id and content of up to n of the chat's shouts whose content matches the ILIKE pattern,
+-- newest first, and only those before the message_id before unless it's NULL.
+-- paging by message_id rather than OFFSET means that later pages don't have to go through the earlier ones again.
+-- the matches are found first, so that they come from shout_search_idx. otherwise the planner may walk the chat's
+-- shouts backwards along the primary key until it's found n of them, which goes through the whole chat if there
+-- aren't that many.
+WITH match AS MATERIALIZED (
+	SELECT message_id, content
+	FROM shout
+	WHERE chat_id = $1 AND content ILIKE $2 AND ($3::INT4 IS NULL OR message_id < $3)
+)
+SELECT message_id, content
+FROM match
+ORDER BY message_id DESC
+LIMIT $4
 -- :endmacro
 
 -- :macro state_for()
@@ -63,14 +251,23 @@ FROM opt
 WHERE peer_id = $1
 -- :endmacro
 
--- :macro state()
--- params: peer_type, peer_id, user_id
-SELECT COALESCE(
-	(SELECT state FROM opt WHERE peer_id = $2),
-	(SELECT state FROM opt WHERE peer_id = $1),
+-- :macro all_states()
+SELECT peer_id, state
+FROM opt
+-- :endmacro
+
+-- :macro state_expr(peer_id, user_id)
+COALESCE(
+	(SELECT state FROM opt WHERE peer_id = {{ user_id }}),
+	(SELECT state FROM opt WHERE peer_id = {{ peer_id }}),
 	true) -- default state
 -- :endmacro
 
+-- :macro state()
+-- params: peer_id, user_id
+SELECT {{ state_expr('$1', '$2') }}
+-- :endmacro
+
 -- :macro toggle_state()
 -- params: peer_id, default_new_state
 -- returns: new state
@@ -15,17 +15,200 @@
 
 SET TIME ZONE 'UTC';
 
+-- for /search. btree_gin lets chat_id go in the same GIN index as the content's trigrams.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- identifies a shout's content for deduplication, so that the unique index doesn't have to store the content itself.
+-- each part is prefixed with its length so that different splits of the same bytes can't collide.
+-- db.shout_digest computes the same thing. convert_to is only stable because it looks up the encoding by name,
+-- so this is immutable as long as that name is a constant.
+CREATE FUNCTION shout_digest(content TEXT, entities BYTEA[]) RETURNS BYTEA
+LANGUAGE SQL IMMUTABLE STRICT PARALLEL SAFE AS $$
+	SELECT substring(sha256(string_agg(int4send(length(part)) || part, ''::BYTEA ORDER BY i)) FROM 1 FOR 16)
+	FROM unnest(array_prepend(convert_to(content, 'UTF8'), entities)) WITH ORDINALITY AS parts (part, i)
+$$;
+
 CREATE TABLE shout (
 	chat_id INT8 NOT NULL,
 	message_id INT4 NOT NULL,
 	content TEXT NOT NULL,
 	entities BYTEA[] NOT NULL DEFAULT ARRAY[]::BYTEA[],
 	time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	-- who sent it. NULL for shouts saved before this was recorded.
+	user_id INT8,
+	-- dense per chat: always in [0, shout_count.count), so that picking a random shout is a single index lookup.
+	-- maintained by the triggers below, so leave it NULL when inserting.
+	ordinal INT4,
+	digest BYTEA NOT NULL GENERATED ALWAYS AS (shout_digest(content, entities)) STORED,
 
 	PRIMARY KEY (chat_id, message_id));
 
-CREATE UNIQUE INDEX shout_content_unique_idx ON shout (chat_id, content, entities);
+-- lets many shouts be inserted with a single statement
+CREATE TYPE shout_record AS (
+	chat_id INT8,
+	message_id INT4,
+	content TEXT,
+	entities BYTEA[]);
+
+CREATE UNIQUE INDEX shout_digest_unique_idx ON shout (chat_id, digest);
+CREATE UNIQUE INDEX shout_ordinal_idx ON shout (chat_id, ordinal);
+-- finds a chat's shouts that contain some text (ILIKE '%text%'), as long as the text is at least 3 characters long
+CREATE INDEX shout_search_idx ON shout USING GIN (chat_id, content gin_trgm_ops);
+-- finds the shouts that deletions without a chat are for. the bounds are db.BASIC_GROUP_MIN_ID and BASIC_GROUP_MAX_ID.
+CREATE INDEX shout_group_message_idx ON shout (message_id) WHERE chat_id BETWEEN -999999999999 AND -1;
+
+CREATE TABLE shout_count (
+	chat_id INT8 NOT NULL PRIMARY KEY,
+	count INT4 NOT NULL);
+
+-- number newly inserted shouts after the current last ordinal of their chat
+CREATE FUNCTION shout_insert_ordinals() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	WITH added AS (
+		SELECT chat_id, COUNT(*) AS n
+		FROM new_shout
+		GROUP BY chat_id
+		ORDER BY chat_id),
+	counter AS (
+		INSERT INTO shout_count AS c (chat_id, count)
+		SELECT chat_id, n FROM added
+		ON CONFLICT (chat_id) DO UPDATE
+		SET count = c.count + EXCLUDED.count
+		RETURNING chat_id, count),
+	numbered AS (
+		SELECT chat_id, message_id, row_number() OVER (PARTITION BY chat_id ORDER BY message_id) AS rn
+		FROM new_shout)
+	UPDATE shout s
+	SET ordinal = counter.count - added.n + numbered.rn - 1
+	FROM numbered JOIN added USING (chat_id) JOIN counter USING (chat_id)
+	WHERE (s.chat_id, s.message_id) = (numbered.chat_id, numbered.message_id);
+
+	RETURN NULL;
+END $$;
+
+-- fill the holes left by deleted shouts with the shouts at the end of their chat
+CREATE FUNCTION shout_delete_ordinals() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	-- lock the counters first so that the renumbering (which is a separate statement)
+	-- also sees shouts that were committed while we were waiting
+	PERFORM 1
+	FROM shout_count
+	WHERE chat_id IN (SELECT chat_id FROM old_shout)
+	ORDER BY chat_id
+	FOR UPDATE;
+
+	WITH removed AS (
+		SELECT chat_id, COUNT(*) AS n
+		FROM old_shout
+		WHERE ordinal IS NOT NULL
+		GROUP BY chat_id),
+	counter AS (
+		UPDATE shout_count c
+		SET count = c.count - removed.n
+		FROM removed
+		WHERE c.chat_id = removed.chat_id
+		RETURNING c.chat_id, c.count),
+	holes AS (
+		SELECT o.chat_id, o.ordinal, row_number() OVER (PARTITION BY o.chat_id ORDER BY o.ordinal) AS rn
+		FROM old_shout o JOIN counter USING (chat_id)
+		WHERE o.ordinal < counter.count),
+	movers AS (
+		SELECT s.chat_id, s.ordinal, row_number() OVER (PARTITION BY s.chat_id ORDER BY s.ordinal) AS rn
+		FROM shout s JOIN counter USING (chat_id)
+		WHERE s.ordinal >= counter.count)
+	UPDATE shout s
+	SET ordinal = holes.ordinal
+	FROM movers JOIN holes USING (chat_id, rn)
+	WHERE (s.chat_id, s.ordinal) = (movers.chat_id, movers.ordinal);
+
+	RETURN NULL;
+END $$;
+
+CREATE TRIGGER shout_insert_ordinals
+AFTER INSERT ON shout
+REFERENCING NEW TABLE AS new_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_insert_ordinals();
+
+CREATE TRIGGER shout_delete_ordinals
+AFTER DELETE ON shout
+REFERENCING OLD TABLE AS old_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_delete_ordinals();
+
+-- how many shouts each user has stored in each chat, per day (UTC), kept up to date by the triggers below
+-- so that /stats doesn't have to count shouts
+CREATE TABLE shout_stats (
+	chat_id INT8 NOT NULL,
+	-- 0 for shouts saved before their senders were recorded
+	user_id INT8 NOT NULL,
+	day DATE NOT NULL,
+	count INT4 NOT NULL,
+
+	PRIMARY KEY (chat_id, user_id, day));
+
+CREATE INDEX shout_stats_day_idx ON shout_stats (chat_id, day);
+
+CREATE FUNCTION shout_insert_stats() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	INSERT INTO shout_stats AS s (chat_id, user_id, day, count)
+	SELECT chat_id, COALESCE(user_id, 0), (time AT TIME ZONE 'UTC')::DATE, COUNT(*)
+	FROM new_shout
+	GROUP BY 1, 2, 3
+	-- in a consistent order, so that concurrent inserts can't deadlock
+	ORDER BY 1, 2, 3
+	ON CONFLICT (chat_id, user_id, day) DO UPDATE
+	SET count = s.count + EXCLUDED.count;
+
+	RETURN NULL;
+END $$;
+
+-- counters that reach 0 are left in place, and cleaned up when the chat is forgotten
+CREATE FUNCTION shout_delete_stats() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	WITH removed AS (
+		SELECT chat_id, COALESCE(user_id, 0) AS user_id, (time AT TIME ZONE 'UTC')::DATE AS day, COUNT(*) AS n
+		FROM old_shout
+		GROUP BY 1, 2, 3),
+	locked AS (
+		-- see shout_insert_stats
+		SELECT s.chat_id, s.user_id, s.day
+		FROM shout_stats s JOIN removed USING (chat_id, user_id, day)
+		ORDER BY 1, 2, 3
+		FOR UPDATE OF s)
+	UPDATE shout_stats s
+	SET count = s.count - removed.n
+	FROM removed JOIN locked USING (chat_id, user_id, day)
+	WHERE (s.chat_id, s.user_id, s.day) = (removed.chat_id, removed.user_id, removed.day);
+
+	RETURN NULL;
+END $$;
+
+CREATE TRIGGER shout_insert_stats
+AFTER INSERT ON shout
+REFERENCING NEW TABLE AS new_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_insert_stats();
+
+CREATE TRIGGER shout_delete_stats
+AFTER DELETE ON shout
+REFERENCING OLD TABLE AS old_shout
+FOR EACH STATEMENT EXECUTE PROCEDURE shout_delete_stats();
+
+-- how far backfill.py has got through each chat's history
+CREATE TABLE backfill_checkpoint (
+	chat_id INT8 NOT NULL PRIMARY KEY,
+	last_message_id INT4 NOT NULL);
 
 CREATE TABLE opt (
 	peer_id INT8 NOT NULL PRIMARY KEY,
 	state BOOLEAN NOT NULL);
+
+-- lets every bot process keep its cached opt states up to date.
+-- payload: "peer_id state", or just "peer_id" if the row was deleted
+CREATE FUNCTION opt_notify() RETURNS TRIGGER LANGUAGE plpgsql AS $$ BEGIN
+	IF TG_OP = 'DELETE' THEN
+		PERFORM pg_notify('opt', OLD.peer_id::TEXT);
+	ELSE
+		PERFORM pg_notify('opt', NEW.peer_id || ' ' || NEW.state);
+	END IF;
+	RETURN NULL;
+END $$;
+
+CREATE TRIGGER opt_notify
+AFTER INSERT OR UPDATE OR DELETE ON opt
+FOR EACH ROW EXECUTE PROCEDURE opt_notify();
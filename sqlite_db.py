@@ -0,0 +1,294 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Storage in an SQLite database file, for when running PostgreSQL isn't worth it.
+Only one process may use the file at a time, since opt states are cached without being told about other processes' changes.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import json
+import random
+import sqlite3
+import time
+
+import db
+from utils import metrics
+
+def _encode_entities(encoded_entities):
+	return b''.join(len(encoded).to_bytes(4, 'big') + encoded for encoded in encoded_entities)
+
+def _decode_entities(blob):
+	encoded_entities = []
+	i = 0
+	while i < len(blob):
+		length = int.from_bytes(blob[i:i + 4], 'big')
+		encoded_entities.append(blob[i + 4:i + 4 + length])
+		i += 4 + length
+	return encoded_entities
+
+def _in_thread(f):
+	"""turn a method that uses self.conn into a coroutine method which runs it on the storage's thread"""
+	timer = metrics.QUERY_SECONDS.labels(f.__name__.lstrip('_'))
+
+	def timed(self, args):
+		with timer.time():
+			return f(self, *args)
+
+	@functools.wraps(f)
+	async def wrapper(self, *args):
+		return await asyncio.get_event_loop().run_in_executor(self._executor, timed, self, args)
+
+	return wrapper
+
+class SQLiteStorage(db.Storage):
+	"""Runs every query on one thread, which owns the connection. Everything is in process, so most calls take
+	microseconds, and the thread hop is most of the cost.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.queries = db.load_queries('sqlite_queries.sql')
+		self.conn = None
+		# sqlite3 connections may only be used from the thread that opened them
+		self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='sqlite')
+
+	@classmethod
+	async def connect(cls, path):
+		"""Open (and create if need be) the database at path, which may be ':memory:'."""
+		storage = cls(path)
+		await storage._open()
+		return storage
+
+	@_in_thread
+	def _open(self):
+		# transactions are started explicitly, where they're needed
+		self.conn = sqlite3.connect(self.path, isolation_level=None)
+		self.conn.execute('PRAGMA journal_mode = WAL')
+		# in WAL mode, this can only lose the last few transactions on power loss, not corrupt anything
+		self.conn.execute('PRAGMA synchronous = NORMAL')
+		with open('sqlite_schema.sql') as f:
+			script = f.read()
+		# the equivalents of the migrations, for databases created before them
+		upgrades = []
+		columns = [name for _, name, *_ in self.conn.execute('PRAGMA table_info(shout)')]
+		if columns and 'user_id' not in columns:
+			# 006_shout_stats.sql
+			script = f'ALTER TABLE shout ADD COLUMN user_id INTEGER;\n{script}'
+			upgrades.append(self.queries.count_shouts_per_day)
+		if columns and self._fetchval("SELECT 1 FROM sqlite_master WHERE name = 'shout_search'") is None:
+			# 007_shout_search.sql
+			upgrades.append(self.queries.index_shouts_for_search)
+		if upgrades:
+			script = 'BEGIN;\n' + ';\n'.join([script, *upgrades]) + ';\nCOMMIT;\n'
+		self.conn.executescript(script)
+
+	async def close(self):
+		await self._close()
+		self._executor.shutdown()
+
+	@_in_thread
+	def _close(self):
+		self.conn.close()
+
+	@contextlib.contextmanager
+	def _transaction(self):
+		self.conn.execute('BEGIN')
+		try:
+			yield
+		except BaseException:
+			self.conn.execute('ROLLBACK')
+			raise
+		self.conn.execute('COMMIT')
+
+	def _fetchval(self, query, *args):
+		row = self.conn.execute(query, args).fetchone()
+		return None if row is None else row[0]
+
+	async def listen_for_opt_changes(self, on_change, on_lost):
+		# this is the only process using the database, and Database already caches its own changes
+		return await self._all_states()
+
+	@_in_thread
+	def _all_states(self):
+		return {peer_id: bool(state) for peer_id, state in self.conn.execute(self.queries.all_states)}
+
+	async def stop_listening(self):
+		pass
+
+	@_in_thread
+	def state_for(self, peer_id):
+		state = self._fetchval(self.queries.state_for, peer_id)
+		return None if state is None else bool(state)
+
+	@_in_thread
+	def state(self, peer_id, user_id):
+		return bool(self._fetchval(self.queries.state, peer_id, user_id))
+
+	@_in_thread
+	def toggle_state(self, peer_id, default_new_state):
+		return bool(self._fetchval(self.queries.toggle_state, peer_id, default_new_state))
+
+	@_in_thread
+	def set_state(self, peer_id, new_state):
+		self.conn.execute(self.queries.set_state, (peer_id, new_state))
+
+	@_in_thread
+	def handle_shout(self, chat_id, user_id, message_id, content, encoded_entities, want_reply, save):
+		with self._transaction():
+			if not self._fetchval(self.queries.state, chat_id, user_id):
+				return False, False, None
+
+			reply = None
+			if want_reply:
+				row = self.conn.execute(self.queries.random_shout, (chat_id,)).fetchone()
+				if row is not None:
+					reply_id, reply_content, reply_entities = row
+					reply = reply_id, reply_content, _decode_entities(reply_entities)
+
+			return True, save and self._save_shout(chat_id, message_id, content, encoded_entities, user_id), reply
+
+	def _save_shout(self, chat_id, message_id, content, encoded_entities, user_id):
+		cursor = self.conn.execute(self.queries.save_shout, (
+			chat_id, message_id, content,
+			_encode_entities(encoded_entities), db.shout_digest(content, encoded_entities), user_id,
+		))
+		return cursor.rowcount == 1
+
+	@_in_thread
+	def save_shout(self, chat_id, message_id, content, encoded_entities, user_id):
+		return self._save_shout(chat_id, message_id, content, encoded_entities, user_id)
+
+	@_in_thread
+	def save_shouts(self, records):
+		with self._transaction():
+			return [record[:2] for record in records if self._save_shout(*record)]
+
+	@_in_thread
+	def random_shouts(self, chat_id, n):
+		with self._transaction():
+			count = self._fetchval(self.queries.shout_count, chat_id)
+			if not count:
+				return 0, []
+			ordinals = range(count) if count <= n else random.sample(range(count), n)
+			rows = self.conn.execute(self.queries.shouts_by_ordinal, (chat_id, json.dumps(list(ordinals))))
+			return count, [(message_id, content, _decode_entities(entities)) for message_id, content, entities in rows]
+
+	@_in_thread
+	def update_shout(self, chat_id, message_id, content):
+		with self._transaction():
+			entities = self._fetchval(self.queries.shout_entities, chat_id, message_id)
+			if entities is not None:
+				self._update_shout(chat_id, message_id, content, _decode_entities(entities))
+
+	@_in_thread
+	def update_shouts(self, records):
+		with self._transaction():
+			for record in records:
+				self._update_shout(*record)
+
+	def _update_shout(self, chat_id, message_id, content, encoded_entities):
+		try:
+			self.conn.execute(self.queries.update_shout, (
+				chat_id, message_id, content,
+				_encode_entities(encoded_entities), db.shout_digest(content, encoded_entities),
+			))
+		except sqlite3.IntegrityError:
+			# don't store duplicate shouts
+			self.conn.execute(self.queries.delete_shout, (chat_id, message_id))
+
+	@_in_thread
+	def delete_shout(self, chat_id, message_id):
+		return self.conn.execute(self.queries.delete_shout, (chat_id, message_id)).rowcount
+
+	@_in_thread
+	def delete_shouts(self, chat_id, message_ids):
+		message_ids = json.dumps(list(message_ids))
+		if chat_id is None:
+			return self.conn.execute(self.queries.delete_group_shouts, (message_ids,)).fetchall()
+		return self.conn.execute(self.queries.delete_shouts, (chat_id, message_ids)).fetchall()
+
+	@_in_thread
+	def delete_chat_shouts(self, chat_id, n):
+		return [message_id for message_id, in self.conn.execute(self.queries.delete_chat_shouts, (chat_id, n))]
+
+	@_in_thread
+	def forget_chat(self, chat_id):
+		with self._transaction():
+			self.conn.execute(self.queries.forget_chat_checkpoint, (chat_id,))
+			self.conn.execute(self.queries.forget_chat_stats, (chat_id,))
+			self.conn.execute(self.queries.forget_chat_count, (chat_id,))
+
+	@_in_thread
+	def shout_chats(self):
+		return [chat_id for chat_id, in self.conn.execute(self.queries.shout_chats)]
+
+	@_in_thread
+	def delete_old_shouts(self, chat_id, max_shouts, cutoff, n):
+		cutoff = None if cutoff is None else int(cutoff.timestamp())
+		rows = self.conn.execute(self.queries.delete_old_shouts, (chat_id, max_shouts, cutoff, n))
+		return [message_id for message_id, in rows]
+
+	@_in_thread
+	def backfill_checkpoint(self, chat_id):
+		return self._fetchval(self.queries.backfill_checkpoint, chat_id)
+
+	@_in_thread
+	def copy_shouts(self, chat_id, records, last_message_id):
+		with self._transaction():
+			cursor = self.conn.executemany(self.queries.copy_shout, (
+				(
+					chat_id, message_id, content, _encode_entities(encoded_entities),
+					db.shout_digest(content, encoded_entities), int(sent_at.timestamp()), user_id,
+				)
+				for message_id, content, encoded_entities, sent_at, user_id in records
+			))
+			self.conn.execute(self.queries.set_backfill_checkpoint, (chat_id, last_message_id))
+			# changes made by the triggers aren't counted
+			return cursor.rowcount
+
+	@_in_thread
+	def shout_stats(self, chat_id, n, since):
+		with self._transaction():
+			total = self._fetchval(self.queries.shout_count, chat_id) or 0
+			top = self.conn.execute(self.queries.top_shouters, (chat_id, n)).fetchall()
+			days = self.conn.execute(self.queries.shouts_per_day, (chat_id, since.isoformat())).fetchall()
+		return total, top, [(datetime.date.fromisoformat(day), count) for day, count in days]
+
+	@_in_thread
+	def search_shouts(self, chat_id, text, before, n, timeout):
+		# as a phrase, the trigram tokenizer matches it anywhere, ignoring case
+		phrase = '"' + text.replace('"', '""') + '"'
+		deadline = time.monotonic() + timeout
+		timed_out = False
+
+		def check_deadline():
+			nonlocal timed_out
+			timed_out = time.monotonic() > deadline
+			# anything true interrupts the query
+			return timed_out
+
+		self.conn.set_progress_handler(check_deadline, 1000)
+		try:
+			return self.conn.execute(self.queries.search_shouts, (chat_id, phrase, before, n)).fetchall()
+		except sqlite3.OperationalError as exc:
+			if timed_out:
+				raise asyncio.TimeoutError from exc
+			raise
+		finally:
+			self.conn.set_progress_handler(None, 0)
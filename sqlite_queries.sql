@@ -0,0 +1,243 @@
+-- Copyright © 2020 Io Mintz <io@mintz.cc>
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- the queries of sqlite_db.SQLiteStorage. lists of IDs are passed as JSON arrays.
+
+-- :macro save_shout()
+-- params: chat_id, message_id, content, entities, digest, user_id
+INSERT OR IGNORE INTO shout (chat_id, message_id, content, entities, digest, user_id)
+VALUES (?1, ?2, ?3, ?4, ?5, ?6)
+-- :endmacro
+
+-- :macro copy_shout()
+-- params: chat_id, message_id, content, entities, digest, time, user_id
+INSERT OR IGNORE INTO shout (chat_id, message_id, content, entities, digest, time, user_id)
+VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7)
+-- :endmacro
+
+-- :macro shout_entities()
+-- params: chat_id, message_id
+SELECT entities
+FROM shout
+WHERE chat_id = ?1 AND message_id = ?2
+-- :endmacro
+
+-- :macro update_shout()
+-- params: chat_id, message_id, content, entities, digest
+UPDATE shout
+SET content = ?3, entities = ?4, digest = ?5
+WHERE chat_id = ?1 AND message_id = ?2
+-- :endmacro
+
+-- :macro delete_shout()
+-- params: chat_id, message_id
+DELETE FROM shout
+WHERE chat_id = ?1 AND message_id = ?2
+-- :endmacro
+
+-- :macro delete_shouts()
+-- params: chat_id, message_ids
+DELETE FROM shout
+WHERE chat_id = ?1 AND message_id IN (SELECT value FROM json_each(?2))
+RETURNING chat_id, message_id
+-- :endmacro
+
+-- :macro delete_group_shouts()
+-- params: message_ids
+-- see queries.sql
+DELETE FROM shout
+WHERE message_id IN (SELECT value FROM json_each(?1)) AND chat_id BETWEEN {{ basic_group_min_id }} AND {{ basic_group_max_id }}
+RETURNING chat_id, message_id
+-- :endmacro
+
+-- :macro shout_count()
+-- params: chat_id
+SELECT count
+FROM shout_count
+WHERE chat_id = ?1
+-- :endmacro
+
+-- :macro random_shout()
+-- params: chat_id
+SELECT message_id, content, entities
+FROM shout
+WHERE chat_id = ?1 AND ordinal = (
+	SELECT abs(random()) % count
+	FROM shout_count
+	WHERE chat_id = ?1)
+-- :endmacro
+
+-- :macro shouts_by_ordinal()
+-- params: chat_id, ordinals
+-- CROSS JOIN makes sqlite look each ordinal up in the index. with IN, it scans the whole chat instead.
+SELECT message_id, content, entities
+FROM json_each(?2) AS o CROSS JOIN shout
+WHERE shout.chat_id = ?1 AND shout.ordinal = o.value
+-- :endmacro
+
+-- :macro delete_chat_shouts()
+-- params: chat_id, n
+DELETE FROM shout
+WHERE chat_id = ?1 AND message_id IN (
+	SELECT message_id
+	FROM shout
+	WHERE chat_id = ?1
+	ORDER BY ordinal DESC
+	LIMIT ?2)
+RETURNING message_id
+-- :endmacro
+
+-- :macro forget_chat_checkpoint()
+-- params: chat_id
+DELETE FROM backfill_checkpoint
+WHERE chat_id = ?1
+-- :endmacro
+
+-- :macro forget_chat_stats()
+-- params: chat_id
+DELETE FROM shout_stats
+WHERE chat_id = ?1
+-- :endmacro
+
+-- :macro forget_chat_count()
+-- params: chat_id
+DELETE FROM shout_count
+WHERE chat_id = ?1 AND count = 0
+-- :endmacro
+
+-- :macro shout_chats()
+SELECT chat_id
+FROM shout_count
+-- :endmacro
+
+-- :macro delete_old_shouts()
+-- params: chat_id, max_shouts, cutoff, n
+-- see queries.sql
+WITH oldest AS (
+	SELECT message_id, time, row_number() OVER (ORDER BY message_id) AS rn
+	FROM shout
+	WHERE chat_id = ?1
+	ORDER BY message_id
+	LIMIT ?4),
+doomed AS (
+	SELECT message_id
+	FROM oldest, shout_count c
+	WHERE c.chat_id = ?1 AND (rn <= c.count - ?2 OR time < ?3))
+DELETE FROM shout
+WHERE chat_id = ?1 AND message_id IN (SELECT message_id FROM doomed)
+RETURNING message_id
+-- :endmacro
+
+-- :macro top_shouters()
+-- params: chat_id, n
+SELECT user_id, sum(count) AS shouts
+FROM shout_stats
+WHERE chat_id = ?1 AND user_id != 0
+GROUP BY user_id
+HAVING shouts > 0
+ORDER BY shouts DESC, user_id
+LIMIT ?2
+-- :endmacro
+
+-- :macro shouts_per_day()
+-- params: chat_id, since
+SELECT day, sum(count)
+FROM shout_stats
+WHERE chat_id = ?1 AND day >= ?2
+GROUP BY day
+ORDER BY day
+-- :endmacro
+
+-- :macro count_shouts_per_day()
+-- for databases from before shout_stats, whose shouts are counted under user 0
+INSERT INTO shout_stats (chat_id, user_id, day, count)
+SELECT chat_id, 0, date(time, 'unixepoch'), count(*)
+FROM shout
+GROUP BY 1, 2, 3
+-- :endmacro
+
+-- :macro search_shouts()
+-- params: chat_id, phrase, before, n
+-- see queries.sql. CROSS JOIN makes sqlite start from the shouts that match, instead of matching against
+-- every shout in the chat.
+SELECT k.message_id, s.content
+FROM shout_search
+	CROSS JOIN shout_search_key k ON k.id = shout_search.rowid
+	JOIN shout s ON s.chat_id = k.chat_id AND s.message_id = k.message_id
+WHERE shout_search MATCH ?2 AND k.chat_id = ?1 AND (?3 IS NULL OR k.message_id < ?3)
+ORDER BY k.message_id DESC
+LIMIT ?4
+-- :endmacro
+
+-- :macro index_shouts_for_search()
+-- for databases from before shout_search
+INSERT INTO shout_search_key (chat_id, message_id)
+SELECT chat_id, message_id
+FROM shout;
+
+INSERT INTO shout_search (rowid, content)
+SELECT k.id, s.content
+FROM shout_search_key k JOIN shout s ON s.chat_id = k.chat_id AND s.message_id = k.message_id
+-- :endmacro
+
+-- :macro backfill_checkpoint()
+-- params: chat_id
+SELECT last_message_id
+FROM backfill_checkpoint
+WHERE chat_id = ?1
+-- :endmacro
+
+-- :macro set_backfill_checkpoint()
+-- params: chat_id, last_message_id
+INSERT INTO backfill_checkpoint (chat_id, last_message_id)
+VALUES (?1, ?2)
+ON CONFLICT (chat_id) DO UPDATE
+SET last_message_id = excluded.last_message_id
+-- :endmacro
+
+-- :macro all_states()
+SELECT peer_id, state
+FROM opt
+-- :endmacro
+
+-- :macro state_for()
+-- params: peer_id
+SELECT state
+FROM opt
+WHERE peer_id = ?1
+-- :endmacro
+
+-- :macro state()
+-- params: peer_id, user_id
+SELECT COALESCE(
+	(SELECT state FROM opt WHERE peer_id = ?2),
+	(SELECT state FROM opt WHERE peer_id = ?1),
+	1) -- default state
+-- :endmacro
+
+-- :macro toggle_state()
+-- params: peer_id, default_new_state
+INSERT INTO opt (peer_id, state) VALUES (?1, ?2)
+ON CONFLICT (peer_id) DO UPDATE
+SET state = NOT state
+RETURNING state
+-- :endmacro
+
+-- :macro set_state()
+-- params: peer_id, new_state
+INSERT INTO opt (peer_id, state) VALUES (?1, ?2)
+ON CONFLICT (peer_id) DO UPDATE
+SET state = excluded.state
+-- :endmacro
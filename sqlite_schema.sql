@@ -0,0 +1,133 @@
+-- Copyright © 2020 Io Mintz <io@mintz.cc>
+--
+-- CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+-- the same tables as schema.sql, for sqlite_db.SQLiteStorage. run every time it's opened, so it must be idempotent.
+
+CREATE TABLE IF NOT EXISTS shout (
+	chat_id INTEGER NOT NULL,
+	message_id INTEGER NOT NULL,
+	content TEXT NOT NULL,
+	-- the encoded entities, each prefixed with its length as 4 big endian bytes
+	entities BLOB NOT NULL DEFAULT x'',
+	-- unix time
+	time INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+	-- dense per chat, as in schema.sql. maintained by the triggers below.
+	ordinal INTEGER,
+	-- db.shout_digest. sqlite has no sha256, so it's computed by the caller.
+	digest BLOB NOT NULL,
+	-- who sent it. NULL for shouts saved before this was recorded (see SQLiteStorage._open).
+	user_id INTEGER,
+
+	PRIMARY KEY (chat_id, message_id)
+) WITHOUT ROWID;
+
+CREATE UNIQUE INDEX IF NOT EXISTS shout_digest_unique_idx ON shout (chat_id, digest);
+CREATE UNIQUE INDEX IF NOT EXISTS shout_ordinal_idx ON shout (chat_id, ordinal);
+-- see schema.sql
+CREATE INDEX IF NOT EXISTS shout_group_message_idx ON shout (message_id) WHERE chat_id BETWEEN -999999999999 AND -1;
+
+CREATE TABLE IF NOT EXISTS shout_count (
+	chat_id INTEGER NOT NULL PRIMARY KEY,
+	count INTEGER NOT NULL);
+
+-- sqlite triggers run once per row, so each shout only has to take the next ordinal or fill one hole
+CREATE TRIGGER IF NOT EXISTS shout_insert_ordinal AFTER INSERT ON shout BEGIN
+	INSERT INTO shout_count (chat_id, count) VALUES (new.chat_id, 1)
+	ON CONFLICT (chat_id) DO UPDATE SET count = count + 1;
+
+	UPDATE shout
+	SET ordinal = (SELECT count - 1 FROM shout_count WHERE chat_id = new.chat_id)
+	WHERE chat_id = new.chat_id AND message_id = new.message_id;
+END;
+
+-- move the last shout of the chat into the hole
+CREATE TRIGGER IF NOT EXISTS shout_delete_ordinal AFTER DELETE ON shout BEGIN
+	UPDATE shout_count SET count = count - 1 WHERE chat_id = old.chat_id;
+
+	UPDATE shout
+	SET ordinal = old.ordinal
+	WHERE chat_id = old.chat_id AND ordinal = (SELECT count FROM shout_count WHERE chat_id = old.chat_id);
+END;
+
+-- as in schema.sql. days are 'YYYY-MM-DD' in UTC.
+CREATE TABLE IF NOT EXISTS shout_stats (
+	chat_id INTEGER NOT NULL,
+	user_id INTEGER NOT NULL,
+	day TEXT NOT NULL,
+	count INTEGER NOT NULL,
+
+	PRIMARY KEY (chat_id, user_id, day)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS shout_stats_day_idx ON shout_stats (chat_id, day);
+
+CREATE TRIGGER IF NOT EXISTS shout_insert_stats AFTER INSERT ON shout BEGIN
+	INSERT INTO shout_stats (chat_id, user_id, day, count)
+	VALUES (new.chat_id, coalesce(new.user_id, 0), date(new.time, 'unixepoch'), 1)
+	ON CONFLICT (chat_id, user_id, day) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS shout_delete_stats AFTER DELETE ON shout BEGIN
+	UPDATE shout_stats
+	SET count = count - 1
+	WHERE chat_id = old.chat_id AND user_id = coalesce(old.user_id, 0) AND day = date(old.time, 'unixepoch');
+END;
+
+-- finds shouts by what they contain, for /search, like the trigram index in schema.sql (needs sqlite 3.34).
+-- fts5 tables are keyed by integer rowids, which shout doesn't have, so shout_search_key hands them out.
+CREATE TABLE IF NOT EXISTS shout_search_key (
+	id INTEGER PRIMARY KEY,
+	chat_id INTEGER NOT NULL,
+	message_id INTEGER NOT NULL,
+
+	UNIQUE (chat_id, message_id));
+
+-- contentless, since shout already has the content
+CREATE VIRTUAL TABLE IF NOT EXISTS shout_search USING fts5(content, content='', tokenize='trigram');
+
+CREATE TRIGGER IF NOT EXISTS shout_insert_search AFTER INSERT ON shout BEGIN
+	INSERT INTO shout_search_key (chat_id, message_id) VALUES (new.chat_id, new.message_id);
+	INSERT INTO shout_search (rowid, content) VALUES (last_insert_rowid(), new.content);
+END;
+
+-- contentless fts5 tables can only forget a row given the content it was indexed with
+CREATE TRIGGER IF NOT EXISTS shout_delete_search AFTER DELETE ON shout BEGIN
+	INSERT INTO shout_search (shout_search, rowid, content)
+	SELECT 'delete', id, old.content
+	FROM shout_search_key
+	WHERE chat_id = old.chat_id AND message_id = old.message_id;
+
+	DELETE FROM shout_search_key WHERE chat_id = old.chat_id AND message_id = old.message_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS shout_update_search AFTER UPDATE OF content ON shout BEGIN
+	INSERT INTO shout_search (shout_search, rowid, content)
+	SELECT 'delete', id, old.content
+	FROM shout_search_key
+	WHERE chat_id = old.chat_id AND message_id = old.message_id;
+
+	INSERT INTO shout_search (rowid, content)
+	SELECT id, new.content
+	FROM shout_search_key
+	WHERE chat_id = new.chat_id AND message_id = new.message_id;
+END;
+
+CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+	chat_id INTEGER NOT NULL PRIMARY KEY,
+	last_message_id INTEGER NOT NULL);
+
+CREATE TABLE IF NOT EXISTS opt (
+	peer_id INTEGER NOT NULL PRIMARY KEY,
+	state INTEGER NOT NULL);
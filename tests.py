@@ -1,8 +1,33 @@
 #!/usr/bin/env python
 
+import asyncio
+import datetime
+import marshal
+import os
+import sys
+import tempfile
+import time
+import traceback
 import unicodedata
+import unittest
 
-from utils.shout import is_shout
+import asyncpg
+from telethon import errors
+from telethon.tl import functions, types
+
+import bot
+import db
+import sqlite_db
+from backfill import backfill, read_fixture
+from benchmarks import scratch_schema
+from benchmarks.pipeline import FakeClient, replay, synthetic_messages
+from bot import format_stats, parse_search_button_data, search_button_data, search_page
+from utils import _split_lines, remove_code_and_mentions
+from utils.outbox import Outbox, _merge
+from utils.permissions import AdminCache
+from utils.profiling import Sampler
+from utils.shout import is_shout, is_shout_many, unicode_properties
+from utils.workers import ChatWorkers
 
 assert not is_shout('W')
 assert not is_shout('')
@@ -33,3 +58,549 @@ assert is_shout('F U')
 assert is_shout('FU')
 assert is_shout('you went to college to be a WELL EDUCATED CITIZEN OF THE WORLD, nick')
 assert is_shout('🅱️🅱️🅱️')
+
+# postgres needs a server, so it's only checked if there's one to use (any scratch data is cleaned up afterwards)
+TEST_DATABASE_DSN = os.environ.get('TEST_DATABASE_DSN')
+
+def message(text, *entities):
+	return types.Message(id=1, peer_id=types.PeerChat(chat_id=1), message=text, entities=list(entities) or None)
+
+def test_is_shout_long():
+	# long enough to be classified in several chunks
+	assert is_shout('A' * 3000 + 'a' * 2999)
+	assert not is_shout('A' * 3000 + 'a' * 3000)
+	assert is_shout('a' * 2000 + ' ' * 5000 + 'A' * 2001)
+	assert not is_shout('Ä' * 1500 + 'ä' * 1000 + 'a' * 500)
+	assert is_shout('\u200b' * 4000 + 'FU')
+	# exactly one chunk
+	assert is_shout('A' * 513 + 'a' * 511)
+	assert not is_shout('A' * 512 + 'a' * 512)
+
+def test_is_shout_many():
+	strs = ['I SHALL', 'I shall', '', 'OK', 'PR IT', 'ÑANDÚ lol', 'ñandú LOL', 'A' * 3000 + 'a' * 2999]
+	assert is_shout_many(strs) == [True, False, False, False, True, True, False, True]
+	assert is_shout_many(strs) == list(map(is_shout, strs))
+	assert is_shout_many(iter(())) == []
+
+def test_remove_code_and_mentions():
+	assert remove_code_and_mentions(message('HELLO THERE')) == 'HELLO THERE'
+	assert remove_code_and_mentions(message('HELLO THERE', types.MessageEntityBold(0, 5))) == 'HELLO THERE'
+	assert remove_code_and_mentions(message('hi @someone `SELECT`', types.MessageEntityMention(3, 8), types.MessageEntityCode(12, 8))) == 'hi  '
+	# offsets are in UTF-16 code units, so the emoji counts twice
+	assert remove_code_and_mentions(message('🅱 @x LOUD', types.MessageEntityMentionName(3, 2, user_id=1))) == '🅱  LOUD'
+	assert remove_code_and_mentions(message('`a` `b`', types.MessageEntityCode(0, 3), types.MessageEntityCode(4, 3))) == ' '
+
+def test_split_lines():
+	# long code blocks are sent in several messages, split between lines where possible
+	assert list(_split_lines('a' * 10 + '\n' + 'b' * 5 + '\n' + 'c' * 25, 12)) == ['a' * 10, 'b' * 5, 'c' * 6, 'c' * 6, 'c' * 6, 'c' * 7]
+	# the limit is in UTF-16 code units
+	assert list(_split_lines('🅱' * 3 + '\n' + '🅱', 6)) == ['🅱' * 3, '🅱']
+
+def test_unicode_properties():
+	assert '\N{soft hyphen}' in unicode_properties.get('Default_Ignorable_Code_Point')
+	assert ' ' not in unicode_properties.get('Default_Ignorable_Code_Point')
+	assert '\U000e0001' in unicode_properties.get('Default_Ignorable_Code_Point')
+	assert 'Ѐ' in unicode_properties.get('Uppercase')
+	assert 'a' not in unicode_properties.get('Uppercase')
+	assert 'a' in unicode_properties.get('Cased')
+
+class FakeDatabase:
+	"""just enough of db.Database for backfill"""
+
+	def __init__(self, *, opted_out=()):
+		self.opted_out = opted_out
+		self.checkpoints = {}
+		self.shouts = {}
+
+	async def backfill_checkpoint(self, chat_id):
+		return self.checkpoints.get(chat_id, 0)
+
+	async def state(self, chat_id, user_id):
+		return user_id not in self.opted_out
+
+	async def copy_shouts(self, chat_id, records, last_message_id):
+		for message_id, content, encoded_entities, time, user_id in records:
+			self.shouts[chat_id, message_id] = content
+		self.checkpoints[chat_id] = last_message_id
+		return len(records)
+
+class Interrupted(Exception):
+	pass
+
+async def interrupted_after(messages, n):
+	async for message in messages:
+		if not n:
+			raise Interrupted
+		n -= 1
+		yield message
+
+FIXTURE = 'fixtures/backfill_messages.txt'
+FIXTURE_CHAT_ID = -1000001234567
+
+def test_backfill():
+	# leaves out messages that aren't shouts, the bot's own replies, service messages and the opted out user's shouts
+	fake_db = FakeDatabase(opted_out={1003})
+	assert asyncio.run(backfill(read_fixture(FIXTURE), fake_db, bot_id=42, batch_size=5)) == (23, 10)
+	assert sorted(message_id for chat_id, message_id in fake_db.shouts) == [4, 8, 12, 16, 20, 24, 28, 32, 36, 40]
+	assert fake_db.shouts[FIXTURE_CHAT_ID, 12] == 'STOP YELLING @\N{invisible separator}alice'
+	assert fake_db.checkpoints == {FIXTURE_CHAT_ID: 40}
+
+def test_backfill_resumes():
+	fake_db = FakeDatabase(opted_out={1003})
+	asyncio.run(backfill(read_fixture(FIXTURE), fake_db, bot_id=42, batch_size=5))
+
+	# picks up after the last complete batch
+	resumed_db = FakeDatabase(opted_out={1003})
+	try:
+		asyncio.run(backfill(interrupted_after(read_fixture(FIXTURE), 12), resumed_db, bot_id=42, batch_size=5))
+	except Interrupted:
+		pass
+	assert resumed_db.checkpoints == {FIXTURE_CHAT_ID: 16}
+	assert asyncio.run(backfill(read_fixture(FIXTURE), resumed_db, bot_id=42, batch_size=5)) == (13, 6)
+	assert resumed_db.shouts == fake_db.shouts
+	assert asyncio.run(backfill(read_fixture(FIXTURE), resumed_db, bot_id=42, batch_size=5)) == (0, 0)
+
+async def check_storage(storage):
+	"""the behavior that every db.Storage must have, as seen through a db.Database"""
+	database = db.Database(
+		storage,
+		shout_cache_batch_size=4,
+		deletion_chunk_size=3,
+		deletion_pause=0,
+		search_page_size=4,
+		search_max_results=6,
+	)
+	await database.start()
+	chat_id = -1  # a basic group
+	bold = types.MessageEntityBold(0, 4)
+
+	def shout(message_id, text, peer=types.PeerChat(chat_id=1)):
+		return types.Message(id=message_id, peer_id=peer, message=text, entities=[bold])
+
+	async def stored(chat_id):
+		count, rows = await storage.random_shouts(chat_id, 1000)
+		assert count == len(rows)
+		return {message_id: (content, entities) for message_id, content, entities in rows}
+
+	try:
+		assert await database.state(chat_id, 1) is True
+		assert await database.toggle_state(chat_id) is False
+		assert await storage.state(chat_id, 1) is False
+		# the opposite of the chat's
+		assert await database.toggle_user_state(1, chat_id) is True
+		assert await storage.state(chat_id, 1) is True
+		await database.set_state(2, False)
+		assert await storage.state_for(2) is False
+		assert await storage.state(chat_id, 2) is False
+		assert await storage.state_for(3) is None
+		await storage.stop_listening()
+		assert await storage.listen_for_opt_changes(lambda *args: None, lambda: None) == {chat_id: False, 1: True, 2: False}
+
+		assert await database.save_shout(shout(1, 'LOUD ONE @someone'))
+		assert not await database.save_shout(shout(1, 'LOUD ONE @someone'))
+		# same content, different message
+		assert not await storage.save_shout(chat_id, 2, 'LOUD ONE @\N{invisible separator}someone', [bytes(bold)], 1)
+		assert await stored(chat_id) == {1: ('LOUD ONE @\N{invisible separator}someone', [bytes(bold)])}
+		records = [(chat_id, i, f'LOUD {i}', [], 100 + i % 2) for i in range(2, 9)] + [(chat_id, 9, 'LOUD 2', [], 100)]
+		assert sorted(await storage.save_shouts(records)) \
+			== [(chat_id, i) for i in range(2, 9)]
+
+		assert await database.handle_shout(chat_id, 2, 20, 'NOPE', None, True) == (False, None)
+		opted_in, reply = await database.handle_shout(chat_id, 1, 10, 'LOUD TEN', None, True)
+		assert opted_in and reply.id in range(1, 9)
+		assert await storage.handle_shout(chat_id, 1, 11, 'LOUD ELEVEN', [], False, True) == (True, True, None)
+		assert await storage.handle_shout(chat_id, 1, 11, 'LOUD ELEVEN', [], False, True) == (True, False, None)
+		opted_in, saved, (message_id, content, entities) = await storage.handle_shout(chat_id, 1, 12, 'X', [], True, False)
+		assert opted_in and not saved and message_id in (await stored(chat_id))
+		assert set(await stored(chat_id)) == {*range(1, 9), 10, 11}
+
+		count, rows = await storage.random_shouts(chat_id, 4)
+		# "up to n": postgres picks ordinals with replacement
+		assert count == 10 and 0 < len({message_id for message_id, *_ in rows}) == len(rows) <= 4
+		assert await storage.random_shouts(chat_id + 1, 4) == (0, [])
+
+		# edits
+		database.edit_shout(chat_id, 2, 'EDITED TWO', None)
+		# now a duplicate of 4
+		database.edit_shout(chat_id, 3, 'LOUD 4', None)
+		database.edit_shout(chat_id, 5, 'not a shout', None, is_shout=False)
+		await database.edit_queue.flush()
+		shouts = await stored(chat_id)
+		assert shouts[2] == ('EDITED TWO', []) and 3 not in shouts and 5 not in shouts and shouts[4] == ('LOUD 4', [])
+		await storage.update_shout(chat_id, 6, 'LOUD 7')
+		await storage.update_shout(chat_id, 8, 'EIGHT')
+		shouts = await stored(chat_id)
+		assert 6 not in shouts and shouts[8] == ('EIGHT', [])
+
+		# deletes
+		assert await database.delete_shout(chat_id, 10) == 1
+		assert await database.delete_shout(chat_id, 10) == 0
+		await storage.save_shout(-1001234567890, 11, 'IN A CHANNEL', [], None)
+		# a deletion without a chat only applies to basic groups
+		assert await database.delete_shouts(None, [11, 12]) == 1
+		assert await database.delete_shouts(chat_id, [1, 2, 99]) == 2
+		assert set(await stored(chat_id)) == {4, 7, 8}
+		assert set(await stored(-1001234567890)) == {11}
+
+		# stats, counted as shouts were saved and deleted
+		today = datetime.datetime.now(datetime.timezone.utc).date()
+		stats = await database.chat_stats(chat_id)
+		assert stats.total == 3 and stats.top_shouters == [(100, 2), (101, 1)]
+		assert stats.days == [(today - datetime.timedelta(days=i), 0) for i in range(6, 0, -1)] + [(today, 3)]
+		assert await database.chat_stats(chat_id) is stats
+		channel_stats = await database.chat_stats(-1001234567890)
+		# the sender of that one isn't known
+		assert channel_stats.total == 1 and channel_stats.top_shouters == [] and channel_stats.days[-1] == (today, 1)
+
+		# backfill
+		now = datetime.datetime.now(datetime.timezone.utc)
+		old = now - datetime.timedelta(days=30)
+		assert await database.backfill_checkpoint(chat_id) == 0
+		records = [(100 + i, f'OLD {i}', [], old, 102) for i in range(5)]
+		records += [(200, 'LOUD 4', [], now, 102), (201, 'NEW', [], now, 102)]
+		assert await database.copy_shouts(chat_id, records, 201) == 6
+		new_stats = await database.chat_stats(chat_id)
+		assert new_stats is not stats and new_stats.total == 9
+		assert new_stats.top_shouters == [(102, 6), (100, 2), (101, 1)] and new_stats.days[-1] == (today, 4)
+		assert await database.backfill_checkpoint(chat_id) == 201
+		assert await database.copy_shouts(chat_id, records, 201) == 0
+
+		# retention: keep at most 6 shouts, then none older than a week
+		database.retention = 6, None
+		assert await database.enforce_retention() == 3
+		# oldest by message ID
+		assert set(await stored(chat_id)) == {*range(100, 105), 201}
+		database.retention_overrides = {chat_id: {'max_age_days': 7}}
+		assert await database.enforce_retention() == 5
+		assert set(await stored(chat_id)) == {201}
+		assert set(await storage.shout_chats()) == {chat_id, -1001234567890}
+
+		await storage.save_shouts([(chat_id, i, f'MORE {i}', [], 1) for i in range(300, 310)])
+		await storage.save_shout(chat_id, 310, '100% MORE_', [], 1)
+
+		# search, newest first, a page at a time, up to 6 results in all
+		results, more = await database.search_shouts(chat_id, 'more 30')
+		assert results == [(i, f'MORE {i}') for i in range(309, 305, -1)] and more
+		results, more = await database.search_shouts(chat_id, 'more 30', before=306, shown=4)
+		assert results == [(305, 'MORE 305'), (304, 'MORE 304')] and not more
+		# % and _ aren't wildcards
+		assert await database.search_shouts(chat_id, '0% m') == ([(310, '100% MORE_')], False)
+		assert await database.search_shouts(chat_id, 'RE_') == ([(310, '100% MORE_')], False)
+		assert await database.search_shouts(chat_id, '"LOUD"') == ([], False)
+		await storage.update_shout(chat_id, 301, 'CHANGED')
+		assert await database.search_shouts(chat_id, 'chang') == ([(301, 'CHANGED')], False)
+		assert await database.search_shouts(chat_id, 'MORE 301') == ([], False)
+		# deleted by retention
+		assert await database.search_shouts(chat_id, 'old') == ([], False)
+		assert await database.search_shouts(-1001234567890, 'more') == ([], False)
+
+		assert await database.delete_by_chat(chat_id) == 12
+		assert await database.search_shouts(chat_id, 'more') == ([], False)
+		assert await storage.random_shouts(chat_id, 4) == (0, [])
+		assert await storage.shout_stats(chat_id, 10, today - datetime.timedelta(days=100)) == (0, [], [])
+		assert await database.backfill_checkpoint(chat_id) == 0
+		assert await storage.shout_chats() == [-1001234567890]
+	finally:
+		await database.close()
+
+def test_sqlite_storage():
+	async def check():
+		storage = await sqlite_db.SQLiteStorage.connect(':memory:')
+		try:
+			await check_storage(storage)
+		finally:
+			await storage.close()
+
+	asyncio.run(check())
+
+def test_incomplete_storage():
+	class CloseOnly(db.Storage):
+		async def close(self):
+			pass
+
+	# a backend that's missing a method can't be created at all
+	try:
+		CloseOnly()
+	except TypeError:
+		pass
+	else:
+		raise AssertionError('CloseOnly was created')
+
+def test_postgres_storage():
+	if not TEST_DATABASE_DSN:
+		raise unittest.SkipTest('TEST_DATABASE_DSN is not set')
+
+	async def check():
+		conn = await asyncpg.connect(TEST_DATABASE_DSN)
+		async with scratch_schema(conn) as schema:
+			storage = await db.PostgresStorage.connect(dsn=TEST_DATABASE_DSN, server_settings={'search_path': schema})
+			try:
+				await check_storage(storage)
+			finally:
+				await storage.close()
+		await conn.close()
+
+	asyncio.run(check())
+
+def test_basic_group_indexes():
+	# the partial indexes for deletions without a chat only apply to queries with the same bounds
+	for path in 'schema.sql', 'sqlite_schema.sql', 'migrations/008_shout_group_message.sql':
+		with open(path) as f:
+			assert f'WHERE chat_id BETWEEN {db.BASIC_GROUP_MIN_ID} AND {db.BASIC_GROUP_MAX_ID};' in f.read()
+
+def sampled():
+	sampler = Sampler()
+	sampler._sample(sys._getframe())
+	sampler._sample(sys._getframe())
+	return sampler
+
+def test_profiling():
+	sampler = sampled()
+	(key, self_count, total_count), = sampler.top(1)
+	assert key[2] == 'sampled' and self_count == total_count == 2
+	stats = marshal.loads(sampler.pstats())
+	assert stats[key][:2] == (2, 2)
+	assert [caller[2] for caller in stats[key][4]] == ['test_profiling']
+
+def test_merge():
+	# a reply's formatting survives being merged with another reply
+	merged = _merge('I SHALL', message('PR IT', types.MessageEntityBold(0, 2)))
+	assert merged.message == 'I SHALL\nPR IT'
+	assert [(entity.offset, entity.length) for entity in merged.entities] == [(8, 2)]
+
+class RecordingClient:
+	def __init__(self):
+		self.requests = []
+
+	async def send_message(self, entity, text, **kwargs):
+		self.requests.append(('send', text))
+		return types.Message(id=len(self.requests), peer_id=None, message=text)
+
+	async def delete_messages(self, entity, message_ids):
+		self.requests.append(('delete', message_ids))
+
+async def closed(parked=False):
+	client = RecordingClient()
+	outbox = Outbox(client)
+	if parked:
+		outbox._chat(1, 1).parked_until = time.monotonic() + 60
+	sent = outbox.send(1, 1, 'I SHALL', delete_after=60)
+	outbox.delete_messages(1, 1, [100], 60)
+	await outbox.close(timeout=0.1)
+	return client.requests, await sent
+
+def test_outbox_close():
+	# closing sends what's queued, and deletes what's waiting to be deleted without waiting out the delay
+	requests, sent = asyncio.run(closed())
+	assert requests == [('send', 'I SHALL'), ('delete', [100]), ('delete', [1])] and sent.id == 1
+	# but gives up on a chat that can't be sent to in time
+	assert asyncio.run(closed(parked=True)) == ([], None)
+
+def test_workers():
+	async def worked():
+		workers = ChatWorkers(workers=2)
+		workers.start()
+		done = []
+		async def job(name, delay=0):
+			await asyncio.sleep(delay)
+			done.append(name)
+		await workers.submit(1, job, 'slow chat', 0.05)
+		await workers.submit(2, job, 'fast chat')
+		await workers.submit(None, job, 'no chat')
+		await workers.close()
+		return done
+
+	# a job for no chat in particular waits for every chat's earlier jobs, but doesn't hold up any chat's worker
+	assert asyncio.run(worked()) == ['fast chat', 'slow chat', 'no chat']
+
+def test_workers_backpressure():
+	async def worked():
+		workers = ChatWorkers(workers=1, queue_size=1, backpressure_timeout=0.05)
+		workers.start()
+		done = []
+		async def job(name, delay=0):
+			await asyncio.sleep(delay)
+			done.append(name)
+		await workers.submit(1, job, 'running', 0.03)
+		await workers.submit(1, job, 'queued')
+		# waits for room while the job for no chat is submitted, and then gets some
+		waiting = asyncio.ensure_future(workers.submit(1, job, 'waited', 0.02))
+		await asyncio.sleep(0)
+		await workers.submit(None, job, 'no chat')
+		await waiting
+		# dropped for want of room, which mustn't hold up the next job for no chat
+		await workers.submit(1, job, 'slow', 0.2)
+		await workers.submit(1, job, 'full')
+		dropped = await workers.submit(1, job, 'dropped')
+		await workers.submit(None, job, 'no chat again')
+		await workers.close()
+		return done, dropped
+
+	assert asyncio.run(worked()) == (['running', 'queued', 'waited', 'no chat', 'slow', 'full', 'no chat again'], False)
+
+def test_pipeline():
+	async def replayed():
+		return await replay(list(synthetic_messages(300, chats=5)), await sqlite_db.SQLiteStorage.connect(':memory:'))
+
+	# every message makes it through the whole bot
+	report = asyncio.run(replayed())
+	assert report.messages == len(report.latencies) == 300
+	assert report.errors == report.dropped == 0
+	assert report.storage_calls['handle_shout'] and report.requests['send_message']
+
+def admin(user_id, delete_messages=True):
+	return types.ChannelParticipantAdmin(
+		user_id, promoted_by=1, date=None, admin_rights=types.ChatAdminRights(delete_messages=delete_messages),
+	)
+
+class FakeTelegram:
+	def __init__(self, participants, *, can_list_admins=True):
+		self.participants = {participant.user_id: participant for participant in participants}
+		self.can_list_admins = can_list_admins
+		self.requests = []
+
+	async def __call__(self, request):
+		self.requests.append(type(request).__name__)
+		await asyncio.sleep(0)
+		if isinstance(request, functions.channels.GetParticipantsRequest):
+			if not self.can_list_admins:
+				raise errors.ChatAdminRequiredError(request)
+			admins = [p for p in self.participants.values() if not isinstance(p, types.ChannelParticipant)]
+			return types.channels.ChannelParticipants(len(admins), admins, chats=[], users=[])
+		if request.participant not in self.participants:
+			raise errors.UserNotParticipantError(request)
+		return types.channels.ChannelParticipant(self.participants[request.participant], chats=[], users=[])
+
+async def check_admin_cache():
+	chat = -1001234567890
+	participants = [admin(1), admin(2, delete_messages=False), types.ChannelParticipant(3, date=None)]
+
+	# warm: one request answers for the whole chat
+	telegram = FakeTelegram(participants)
+	admins = AdminCache(telegram)
+	assert await asyncio.gather(*(admins.can_delete_messages(chat, chat, user_id) for user_id in (1, 2, 3, 4))) \
+		== [True, False, False, False]
+	assert telegram.requests == ['GetParticipantsRequest']
+	# promoted, then demoted
+	admins.update(chat, 3, admin(3))
+	assert await admins.can_delete_messages(chat, chat, 3)
+	admins.update(chat, 1, None)
+	assert not await admins.can_delete_messages(chat, chat, 1)
+	# an admin who left and came back has to be checked again, along with the rest of the admins
+	admins.update(chat, 1, admin(1))
+	admins.invalidate(chat, 1)
+	assert await admins.can_delete_messages(chat, chat, 1)
+	assert telegram.requests == ['GetParticipantsRequest'] * 2
+
+	# cold, with checks at the same time sharing a request
+	telegram = FakeTelegram(participants, can_list_admins=False)
+	admins = AdminCache(telegram, ttl=0.05, max_size=2)
+	assert await asyncio.gather(admins.can_delete_messages(chat, chat, 1), admins.can_delete_messages(chat, chat, 1)) \
+		== [True, True]
+	assert telegram.requests == ['GetParticipantsRequest', 'GetParticipantRequest']
+	assert not await admins.can_delete_messages(chat, chat, 4)
+	# least recently used first out
+	assert await admins.can_delete_messages(chat, chat, 1)
+	await admins.can_delete_messages(chat, chat, 2)
+	assert list(admins.users) == [(chat, 1), (chat, 2)]
+	# expired
+	await asyncio.sleep(0.05)
+	telegram.requests.clear()
+	assert await admins.can_delete_messages(chat, chat, 1)
+	assert telegram.requests == ['GetParticipantsRequest', 'GetParticipantRequest']
+
+	admins.forget_chat(chat)
+	assert not admins.users and not admins.chats
+
+def test_admin_cache():
+	asyncio.run(check_admin_cache())
+
+def test_format_stats():
+	async def formatted_stats():
+		# the fake client has never seen these users, so their names aren't known
+		stats = db.ChatStats(3, [(100, 2), (101, 1)], [(datetime.date(2020, 1, 1), 0), (datetime.date(2020, 1, 2), 3)])
+		return await format_stats(FakeClient(), stats), await format_stats(FakeClient(), db.ChatStats(0, [], []))
+
+	assert asyncio.run(formatted_stats()) == (
+		'3 SHOUTS SAVED\n\nTOP SHOUTERS:\n1. USER 100: 2\n2. USER 101: 1\n\nSHOUTS PER DAY (UTC):\nWED JAN 01: 0\nTHU JAN 02: 3',
+		"I HAVEN'T SAVED ANY SHOUTS FROM THIS CHAT YET",
+	)
+
+def test_search():
+	async def searched():
+		client = FakeClient()
+		client.db = db.Database(await sqlite_db.SQLiteStorage.connect(':memory:'), search_page_size=2)
+		channel_id = -1001234567890
+		try:
+			await client.db.storage.save_shouts([(channel_id, i, f'SHOUT {i}' + '!' * 300 * (i == 3), [], 1) for i in range(1, 4)])
+			return (
+				await search_page(client, channel_id, 'shout'),
+				await search_page(client, channel_id, 'shout', before=2, shown=2),
+				await search_page(client, channel_id, 'whisper'),
+			)
+		finally:
+			await client.db.storage.close()
+
+	(first_text, first_buttons), (second_text, second_buttons), nothing = asyncio.run(searched())
+	# newest first, and long shouts are cut short
+	assert first_text == f'1. SHOUT 3{"!" * 192}…\nhttps://t.me/c/1234567890/3\n2. SHOUT 2\nhttps://t.me/c/1234567890/2'
+	assert len(first_buttons) == 1
+	assert second_text == '3. SHOUT 1\nhttps://t.me/c/1234567890/1' and second_buttons is None
+	assert nothing == ('NO SHOUTS FOUND', None)
+	assert parse_search_button_data(search_button_data('A:B', 2, 2)) == ('A:B', 2, 2)
+
+def test_command_list():
+	with open('command_list.txt') as f:
+		assert bot.command_list() == f.read()
+	assert {'reload', 'profile', 'memprofile'}.isdisjoint(bot.LISTED_COMMANDS)
+
+def test_reload():
+	async def reloaded():
+		client = FakeClient()
+		await bot.setup_client(client, {'owner_ids': set()}, await sqlite_db.SQLiteStorage.connect(':memory:'))
+		database = client.db
+		old_handlers = [callback for callback, _ in client.list_event_handlers()]
+		cwd = os.getcwd()
+		try:
+			with tempfile.TemporaryDirectory() as directory:
+				# the config is read from the working directory
+				os.chdir(directory)
+				with open('config.py', 'w') as f:
+					f.write("{'owner_ids': {1}}")
+				elapsed = await bot.reload(client)
+		finally:
+			os.chdir(cwd)
+			await bot.close_client(client)
+			reloaded_bot = sys.modules['bot']
+			# the rest of the tests use the bot they imported
+			sys.modules['bot'] = bot
+		return client, database, old_handlers, elapsed, reloaded_bot
+
+	client, database, old_handlers, elapsed, reloaded_bot = asyncio.run(reloaded())
+	# the new config and handlers are used, and nothing else is replaced
+	assert client.config == {'owner_ids': {1}} and client.db is database and elapsed > 0
+	new_handlers = [callback for callback, _ in client.list_event_handlers()]
+	assert len(new_handlers) == len(old_handlers) and not set(new_handlers) & set(old_handlers)
+	assert client.handler_module is reloaded_bot is not bot
+	assert client.handler_module.commands['reload'] is not bot.commands['reload']
+
+def main():
+	"""Run every test, even after one fails, and exit with 1 if any did."""
+	failed = []
+	for name, test in list(globals().items()):
+		if not name.startswith('test_') or not callable(test):
+			continue
+		try:
+			test()
+		except unittest.SkipTest as exc:
+			print(f'Skipped {name}: {exc}', file=sys.stderr)
+		except Exception:
+			traceback.print_exc()
+			failed.append(name)
+
+	if failed:
+		print('Failed:', ', '.join(failed), file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
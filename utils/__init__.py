@@ -21,7 +21,7 @@ import traceback
 from functools import wraps
 
 from telethon.tl import types
-from telethon.helpers import add_surrogate, del_surrogate
+from telethon.helpers import add_surrogate
 
 from . import shout
 
@@ -41,15 +41,35 @@ def peer_id(peer):
 			return getattr(peer, attr)
 	raise TypeError('probably not a peer idk')
 
+_REMOVED_ENTITY_TYPES = types.MessageEntityCode, types.MessageEntityMention, types.MessageEntityMentionName
+
 def remove_code_and_mentions(message):
-	content = list(add_surrogate(message.message))
-	slices = []
-	for ent, txt in message.get_entities_text():
-		if isinstance(ent, (types.MessageEntityCode, types.MessageEntityMention, types.MessageEntityMentionName)):
-			slices.append(slice(ent.offset, ent.offset + ent.length))
-	for s in reversed(slices):
-		del content[s]
-	return del_surrogate(''.join(content))
+	text = message.message
+	# entity offsets and lengths are in UTF-16 code units
+	ranges = sorted(
+		(entity.offset, entity.offset + entity.length)
+		for entity in message.entities or ()
+		if isinstance(entity, _REMOVED_ENTITY_TYPES)
+	)
+	if not ranges or not text:
+		return text
+
+	if max(text) <= '\uffff':
+		# no astral characters, so UTF-16 offsets are the same as str indices
+		return _remove_ranges(text, ranges, 1)
+
+	encoded = text.encode('utf-16-le', 'surrogatepass')
+	return _remove_ranges(encoded, ranges, 2).decode('utf-16-le', 'surrogatepass')
+
+def _remove_ranges(seq, ranges, width):
+	pieces = []
+	pos = 0
+	for start, end in ranges:
+		if start * width > pos:
+			pieces.append(seq[pos:start * width])
+		pos = max(pos, end * width)
+	pieces.append(seq[pos:])
+	return seq[:0].join(pieces)
 
 # modified from jishaku/exception_handling.py @ 1.18.2
 # © 2019 Devon (Gorialis) R
@@ -83,12 +103,38 @@ async def send_traceback(message, verbosity: int, *exc_info):
 	:return: The last message sent
 	"""
 	traceback_content = "".join(traceback.format_exception(*exc_info, verbosity))
+	return await send_code(message, traceback_content)
+
+# in UTF-16 code units
+MAX_MESSAGE_LENGTH = 4096
 
+async def send_code(message, content, **kwargs):
+	"""Reply to message with content as a code block, split over as many messages as it takes."""
 	def code_converter(content):
-		content = content.strip()
 		return content, [types.MessageEntityCode(offset=0, length=len(add_surrogate(content)))]
 
-	return await message.reply(traceback_content, parse_mode=code_converter)
+	for chunk in _split_lines(content.strip(), MAX_MESSAGE_LENGTH):
+		sent = await message.reply(chunk, parse_mode=code_converter, **kwargs)
+	return sent
+
+def _split_lines(text, limit):
+	"""split text into chunks at most limit UTF-16 code units long, between lines where possible"""
+	chunk = []
+	length = 0
+	for line in text.splitlines():
+		line_length = len(add_surrogate(line))
+		if chunk and length + 1 + line_length > limit:
+			yield '\n'.join(chunk)
+			chunk, length = [], 0
+		while line_length > limit:
+			# too long to fit on its own. limit // 2 characters can't be more than limit code units.
+			yield line[:limit // 2]
+			line = line[limit // 2:]
+			line_length = len(add_surrogate(line))
+		length += (1 if chunk else 0) + line_length
+		chunk.append(line)
+	if chunk or not text:
+		yield '\n'.join(chunk)
 
 class ReplExceptionCatcher:  # pylint: disable=too-few-public-methods
 	def __init__(self, message):
@@ -0,0 +1,62 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Prometheus metrics. They're always collected (each observation costs about a microsecond),
+and served over HTTP if serve() is called.
+"""
+
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram
+
+# most of what we time takes well under 10ms, which the default buckets don't say much about
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _histogram(name, documentation, labels=()):
+	return Histogram('captain_capslock_' + name, documentation, labels, buckets=LATENCY_BUCKETS)
+
+HANDLER_SECONDS = _histogram('handler_seconds', 'Time spent in each event handler and worker job', ['handler'])
+QUERY_SECONDS = _histogram('query_seconds', 'Time spent running each query', ['query'])
+POOL_ACQUIRE_SECONDS = _histogram('pool_acquire_seconds', 'Time spent waiting for a database connection')
+SEND_SECONDS = _histogram('send_seconds', 'Time spent on each request to Telegram made by the outbox', ['method'])
+WORKER_LAG_SECONDS = _histogram('worker_lag_seconds', 'Time jobs spent waiting in a worker queue')
+
+SHOUTS = Counter('captain_capslock_is_shout_total', 'Messages checked for being shouts', ['result'])
+REPLY_ROLLS = Counter(
+	'captain_capslock_reply_rolls_total',
+	'Shouts which were chosen to be replied to (SHOUT_RESPONSE_PROBABILITY) or not',
+	['result'],
+)
+FLOOD_WAITS = Counter('captain_capslock_flood_waits_total', 'Flood waits which parked a chat in the outbox')
+JOBS_DROPPED = Counter('captain_capslock_jobs_dropped_total', 'Jobs dropped because their worker was backed up')
+ADMIN_LOOKUPS = Counter(
+	'captain_capslock_admin_lookups_total',
+	'Permission checks for /remove, by whether they were answered without asking Telegram',
+	['result'],
+)
+
+POOL_CONNECTIONS = Gauge('captain_capslock_pool_connections', 'Open database connections', ['state'])
+QUEUED = Gauge('captain_capslock_queued', 'Items waiting in each queue', ['queue'])
+
+def track_pool(pool):
+	POOL_CONNECTIONS.labels('in_use').set_function(lambda: pool.get_size() - pool.get_idle_size())
+	POOL_CONNECTIONS.labels('idle').set_function(pool.get_idle_size)
+
+def track_queue(name, length):
+	"""report length() as the size of the named queue"""
+	QUEUED.labels(name).set_function(length)
+
+def serve(port, address='127.0.0.1'):
+	"""Serve the metrics in the Prometheus text format from a background thread."""
+	prometheus_client.start_http_server(port, addr=address)
@@ -0,0 +1,345 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import copy
+import logging
+import time
+
+from telethon import errors
+from telethon.helpers import add_surrogate
+from telethon.tl import types
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+class TokenBucket:
+	"""Allows rate calls per second on average, and up to capacity calls at once."""
+
+	__slots__ = 'rate', 'capacity', 'tokens', 'updated'
+
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def reserve(self):
+		"""Take a token and return how many seconds to wait before using it."""
+		self._refill()
+		self.tokens -= 1
+		# tokens goes negative when we're over the limit, so that later callers queue up behind earlier ones
+		return max(0.0, -self.tokens / self.rate)
+
+	def time_to_full(self):
+		self._refill()
+		return (self.capacity - self.tokens) / self.rate
+
+def _text(message):
+	return message if isinstance(message, str) else message.message
+
+def _merge(first, second):
+	"""join two messages, each either a str or a Message (whose formatting is kept), with a newline"""
+	if isinstance(first, str) and isinstance(second, str):
+		return first + '\n' + second
+
+	entities = [] if isinstance(first, str) else list(first.entities or ())
+	# entity offsets are in UTF-16 code units
+	offset = len(add_surrogate(_text(first))) + 1
+	for entity in () if isinstance(second, str) else second.entities or ():
+		entity = copy.copy(entity)
+		entity.offset += offset
+		entities.append(entity)
+	return types.Message(id=0, peer_id=None, message=_text(first) + '\n' + _text(second), entities=entities)
+
+class _Send:
+	__slots__ = 'text', 'kwargs', 'auto', 'delete_after', 'queued_at', 'futures'
+
+	def __init__(self, text, kwargs, auto, delete_after):
+		self.text = text
+		self.kwargs = kwargs
+		self.auto = auto
+		self.delete_after = delete_after
+		self.queued_at = time.monotonic()
+		self.futures = [asyncio.get_event_loop().create_future()]
+
+class _Delete:
+	__slots__ = 'message_ids', 'futures'
+
+	def __init__(self, message_ids):
+		self.message_ids = message_ids
+		self.futures = []
+
+class _Chat:
+	__slots__ = 'entity', 'queue', 'bucket', 'task', 'parked_until', 'deletes', 'delete_timer', 'forget_timer'
+
+	def __init__(self, entity, bucket):
+		self.entity = entity
+		self.queue = collections.deque()
+		self.bucket = bucket
+		self.task = None
+		# monotonic time until which Telegram told us to stop sending to this chat
+		self.parked_until = 0.0
+		# message IDs waiting to be deleted together
+		self.deletes = []
+		self.delete_timer = None
+		self.forget_timer = None
+
+class Outbox:
+	"""Sends and deletes messages on behalf of handlers, one chat at a time, within Telegram's rate limits.
+
+	Each chat has its own queue, which is sent in order. A chat that gets a FloodWaitError is parked until the
+	wait is over, without holding up other chats. Automatic replies that are still queued after stale_after
+	seconds are dropped, and automatic replies that pile up behind each other are sent as one message.
+	Messages to be deleted later are deleted in one request per chat.
+	"""
+
+	def __init__(
+		self,
+		client,
+		*,
+		global_rate=30,
+		global_burst=30,
+		chat_rate=0.33,
+		chat_burst=3,
+		stale_after=30.0,
+	):
+		self.client = client
+		self.global_bucket = TokenBucket(global_rate, global_burst)
+		self.chat_rate = chat_rate
+		self.chat_burst = chat_burst
+		self.stale_after = stale_after
+		self.chats = {}
+		self.dropped_count = 0
+		self.merged_count = 0
+
+	def _chat(self, chat_id, entity):
+		try:
+			chat = self.chats[chat_id]
+		except KeyError:
+			chat = self.chats[chat_id] = _Chat(entity, TokenBucket(self.chat_rate, self.chat_burst))
+		if chat.forget_timer is not None:
+			chat.forget_timer.cancel()
+			chat.forget_timer = None
+		return chat
+
+	def respond(self, event, text, *, auto=False, delete_after=None, **kwargs):
+		"""Send a message to the event's chat. Returns a future for the sent message, which is None if sending failed
+		or the message was dropped. Set auto for replies that nobody asked for, which may be dropped or merged when
+		the chat falls behind. If delete_after is given, delete the message that many seconds after it's sent.
+		"""
+		return self.send(event.chat_id, event.input_chat or event.chat_id, text, auto=auto, delete_after=delete_after, **kwargs)
+
+	def reply(self, event, text, **kwargs):
+		return self.respond(event, text, reply_to=event.message.id, **kwargs)
+
+	def send(self, chat_id, entity, text, *, auto=False, delete_after=None, **kwargs):
+		chat = self._chat(chat_id, entity)
+		op = _Send(text, kwargs, auto, delete_after)
+		chat.queue.append(op)
+		self._wake(chat_id, chat)
+		return op.futures[0]
+
+	def delete(self, event, message_ids, delay=0):
+		self.delete_messages(event.chat_id, event.input_chat or event.chat_id, message_ids, delay)
+
+	def delete_messages(self, chat_id, entity, message_ids, delay=0):
+		"""Delete messages after delay seconds, along with any others already waiting to be deleted in the chat."""
+		chat = self._chat(chat_id, entity)
+		chat.deletes.extend(message_ids)
+		# push back the whole batch, so that nothing is deleted earlier than asked
+		if chat.delete_timer is not None:
+			chat.delete_timer.cancel()
+		chat.delete_timer = asyncio.get_event_loop().call_later(delay, self._flush_deletes, chat_id, chat)
+
+	def _flush_deletes(self, chat_id, chat):
+		chat.delete_timer = None
+		if not chat.deletes:
+			return
+		chat.queue.append(_Delete(chat.deletes))
+		chat.deletes = []
+		self._wake(chat_id, chat)
+
+	def _wake(self, chat_id, chat):
+		if chat.task is None:
+			chat.task = asyncio.ensure_future(self._drain(chat_id, chat))
+
+	async def _drain(self, chat_id, chat):
+		try:
+			while chat.queue:
+				await self._wait_turn(chat)
+				op = self._next(chat)
+				if op is None:
+					continue
+				try:
+					result = await self._run(chat, op)
+				except errors.FloodError as exc:
+					seconds = getattr(exc, 'seconds', None)
+					if seconds is None:
+						self._fail(chat_id, op, exc)
+						continue
+					logger.warning('Parking chat %s for %d seconds: %s', chat_id, seconds, exc)
+					chat.parked_until = time.monotonic() + seconds
+					metrics.FLOOD_WAITS.inc()
+					# try it again when we're allowed to. if it's an auto reply, it may be stale by then.
+					chat.queue.appendleft(op)
+					continue
+				except Exception as exc:
+					self._fail(chat_id, op, exc)
+					continue
+
+				for fut in op.futures:
+					if not fut.done():
+						fut.set_result(result)
+				if isinstance(op, _Send) and op.delete_after is not None and result is not None:
+					self.delete_messages(chat_id, chat.entity, [result.id], op.delete_after)
+		finally:
+			chat.task = None
+
+		if not chat.deletes:
+			# forget the chat once its bucket would be full anyway, so that bursts are still limited until then
+			chat.forget_timer = asyncio.get_event_loop().call_later(
+				chat.bucket.time_to_full(), self._forget, chat_id, chat,
+			)
+
+	def _forget(self, chat_id, chat):
+		if chat.task is None and not chat.queue and not chat.deletes and self.chats.get(chat_id) is chat:
+			del self.chats[chat_id]
+
+	async def _wait_turn(self, chat):
+		parked = chat.parked_until - time.monotonic()
+		if parked > 0:
+			await asyncio.sleep(parked)
+		await asyncio.sleep(chat.bucket.reserve())
+		await asyncio.sleep(self.global_bucket.reserve())
+
+	def _next(self, chat):
+		"""pop the next operation to run, dropping stale auto replies and merging the ones behind it"""
+		op = chat.queue.popleft()
+		if not isinstance(op, _Send) or not op.auto:
+			return op
+
+		now = time.monotonic()
+		if now - op.queued_at > self.stale_after:
+			self._drop(op)
+			return None
+
+		while chat.queue:
+			next_op = chat.queue[0]
+			if not isinstance(next_op, _Send) or not next_op.auto or next_op.kwargs != op.kwargs:
+				break
+			chat.queue.popleft()
+			if now - next_op.queued_at > self.stale_after:
+				self._drop(next_op)
+				continue
+			if len(_text(op.text)) + 1 + len(_text(next_op.text)) > MAX_MESSAGE_LENGTH:
+				# not worth sending two messages to catch up. the newer one is just as good.
+				self._drop(op)
+				op = next_op
+				continue
+			op.text = _merge(op.text, next_op.text)
+			op.futures.extend(next_op.futures)
+			self.merged_count += 1
+
+		return op
+
+	def _drop(self, op):
+		self.dropped_count += 1
+		for fut in op.futures:
+			fut.set_result(None)
+
+	def _fail(self, chat_id, op, exc):
+		logger.error('Failed to %s in chat %s', 'send a message' if isinstance(op, _Send) else 'delete messages', chat_id, exc_info=exc)
+		for fut in op.futures:
+			if not fut.done():
+				fut.set_result(None)
+
+	async def _run(self, chat, op):
+		if isinstance(op, _Send):
+			with metrics.SEND_SECONDS.labels('send_message').time():
+				return await self.client.send_message(chat.entity, op.text, **op.kwargs)
+
+		try:
+			with metrics.SEND_SECONDS.labels('delete_messages').time():
+				return await self.client.delete_messages(chat.entity, op.message_ids)
+		except errors.MessageDeleteForbiddenError:
+			# some of them weren't ours to delete, so delete the rest one by one
+			if len(op.message_ids) == 1:
+				return None
+			for message_id in op.message_ids:
+				try:
+					with metrics.SEND_SECONDS.labels('delete_messages').time():
+						await self.client.delete_messages(chat.entity, [message_id])
+				except errors.MessageDeleteForbiddenError:
+					pass
+
+	def queued(self):
+		return sum(len(chat.queue) for chat in self.chats.values())
+
+	def stats(self):
+		"""(chats with queued messages, total queued messages, auto replies dropped, auto replies merged)"""
+		return (
+			sum(1 for chat in self.chats.values() if chat.queue),
+			self.queued(),
+			self.dropped_count,
+			self.merged_count,
+		)
+
+	async def close(self, timeout=10):
+		"""Send the messages that are queued and delete the ones waiting to be deleted, without waiting out their delay
+		(waiting at most timeout seconds in all), then stop.
+		"""
+		try:
+			await asyncio.wait_for(self._finish(), timeout)
+		except asyncio.TimeoutError:
+			logger.warning('Gave up on %d queued messages and deletions', self.queued())
+
+		for chat in self.chats.values():
+			for timer in chat.delete_timer, chat.forget_timer:
+				if timer is not None:
+					timer.cancel()
+		tasks = [chat.task for chat in self.chats.values() if chat.task is not None]
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		# nothing is going to send these now
+		for chat in self.chats.values():
+			for op in chat.queue:
+				for fut in op.futures:
+					if not fut.done():
+						fut.set_result(None)
+			chat.queue.clear()
+
+	async def _finish(self):
+		while True:
+			# including any that sending just scheduled
+			for chat_id, chat in list(self.chats.items()):
+				if chat.delete_timer is not None:
+					chat.delete_timer.cancel()
+					self._flush_deletes(chat_id, chat)
+			tasks = [chat.task for chat in self.chats.values() if chat.task is not None]
+			if not tasks:
+				return
+			# not gather, which would cancel them if this times out. close does that itself, after logging what's left.
+			await asyncio.wait(tasks)
@@ -0,0 +1,162 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import logging
+import time
+
+from telethon import errors
+from telethon.tl import functions, types
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+def can_delete_messages(participant):
+	return bool(
+		isinstance(participant, (types.ChannelParticipantAdmin, types.ChannelParticipantCreator))
+		and participant.admin_rights.delete_messages
+	)
+
+class AdminCache:
+	"""Remembers who may delete messages in each supergroup, so that most permission checks don't ask Telegram.
+
+	Answers are kept for ttl seconds, for at most max_size (chat, user) pairs, least recently used first out.
+	If warm is set, the first check in a chat fetches the chat's whole list of admins in one request instead,
+	which answers the check for everyone else in the chat too. Updates about members and admins replace what
+	they make stale.
+	"""
+
+	def __init__(self, client, *, ttl=600, max_size=10_000, warm=True):
+		self.client = client
+		self.ttl = ttl
+		self.max_size = max_size
+		self.warm = warm
+		# (chat_id, user_id) -> (expires_at, can delete messages)
+		self.users = collections.OrderedDict()
+		# chat_id -> (expires_at, IDs of the users who can delete messages, or None if the list couldn't be fetched)
+		self.chats = collections.OrderedDict()
+		# requests in flight, so that checks made at the same time share one
+		self.pending = {}
+
+	async def can_delete_messages(self, chat_id, channel, user_id):
+		"""Whether the user may delete messages in the supergroup. channel is anything telethon accepts as one."""
+		now = time.monotonic()
+		try:
+			expires_at, allowed = self.users[chat_id, user_id]
+		except KeyError:
+			pass
+		else:
+			if expires_at > now:
+				self.users.move_to_end((chat_id, user_id))
+				metrics.ADMIN_LOOKUPS.labels('hit').inc()
+				return allowed
+
+		admins = self._chat_admins(chat_id, now)
+		if admins is not None:
+			metrics.ADMIN_LOOKUPS.labels('hit').inc()
+			return user_id in admins
+
+		metrics.ADMIN_LOOKUPS.labels('miss').inc()
+		if self.warm and chat_id not in self.chats:
+			admins = await self._shared(chat_id, self._fetch_admins(chat_id, channel))
+			if admins is not None:
+				return user_id in admins
+
+		return await self._shared((chat_id, user_id), self._fetch_participant(chat_id, channel, user_id))
+
+	def _chat_admins(self, chat_id, now):
+		try:
+			expires_at, admins = self.chats[chat_id]
+		except KeyError:
+			return None
+		if expires_at <= now:
+			# fetch it again next time
+			del self.chats[chat_id]
+			return None
+		self.chats.move_to_end(chat_id)
+		return admins
+
+	async def _shared(self, key, coro):
+		try:
+			task = self.pending[key]
+		except KeyError:
+			task = self.pending[key] = asyncio.ensure_future(coro)
+			task.add_done_callback(lambda _: self.pending.pop(key, None))
+		else:
+			coro.close()
+		# shield so that one cancelled check doesn't cancel the request the others are waiting on
+		return await asyncio.shield(task)
+
+	async def _fetch_participant(self, chat_id, channel, user_id):
+		try:
+			result = await self.client(functions.channels.GetParticipantRequest(channel=channel, participant=user_id))
+		except errors.UserNotParticipantError:
+			allowed = False
+		else:
+			allowed = can_delete_messages(result.participant)
+		self._put(chat_id, user_id, allowed)
+		return allowed
+
+	async def _fetch_admins(self, chat_id, channel):
+		try:
+			# 200 is as many as telegram returns at once, and a supergroup can't have more admins than that anyway
+			result = await self.client(functions.channels.GetParticipantsRequest(
+				channel=channel, filter=types.ChannelParticipantsAdmins(), offset=0, limit=200, hash=0,
+			))
+		except errors.RPCError as exc:
+			logger.info('Could not list the admins of chat %s, checking them one at a time instead: %r', chat_id, exc)
+			admins = None
+		else:
+			admins = {participant.user_id for participant in result.participants if can_delete_messages(participant)}
+
+		self.chats[chat_id] = time.monotonic() + self.ttl, admins
+		self.chats.move_to_end(chat_id)
+		while len(self.chats) > self.max_size:
+			self.chats.popitem(last=False)
+		return admins
+
+	def _put(self, chat_id, user_id, allowed):
+		self.users[chat_id, user_id] = time.monotonic() + self.ttl, allowed
+		self.users.move_to_end((chat_id, user_id))
+		while len(self.users) > self.max_size:
+			self.users.popitem(last=False)
+
+	def update(self, chat_id, user_id, participant):
+		"""Record a user's new participant object (None if they're no longer in the chat)."""
+		allowed = can_delete_messages(participant)
+		self._put(chat_id, user_id, allowed)
+		try:
+			_, admins = self.chats[chat_id]
+		except KeyError:
+			return
+		if admins is not None:
+			if allowed:
+				admins.add(user_id)
+			else:
+				admins.discard(user_id)
+
+	def invalidate(self, chat_id, user_id):
+		"""Forget whether the user may delete messages, e.g. because they joined or left the chat."""
+		self.users.pop((chat_id, user_id), None)
+		# the chat's list of admins might be stale for them too
+		if user_id in (self.chats.get(chat_id, (None, None))[1] or ()):
+			del self.chats[chat_id]
+
+	def forget_chat(self, chat_id):
+		self.chats.pop(chat_id, None)
+		for key in [key for key in self.users if key[0] == chat_id]:
+			del self.users[key]
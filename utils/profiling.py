@@ -0,0 +1,210 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Profiling of the running bot, for the /profile and /memprofile commands."""
+
+import asyncio
+import collections
+import io
+import linecache
+import marshal
+import os.path
+import sys
+import threading
+import time
+import tracemalloc
+
+def _key(code):
+	"""the pstats key for a code object"""
+	return code.co_filename, code.co_firstlineno, code.co_name
+
+def _label(key):
+	filename, lineno, name = key
+	return f'{os.path.basename(filename)}:{lineno}({name})'
+
+def _is_idle(frame):
+	# the event loop waiting for something to happen
+	return frame.f_code.co_name in ('select', 'poll') and frame.f_code.co_filename.endswith('selectors.py')
+
+class Sampler:
+	"""Samples the stack of a thread every interval seconds from a background thread.
+	Unlike cProfile, this only slows down the profiled thread while a sample is being taken.
+	"""
+
+	def __init__(self, thread_id=None, *, interval=0.005):
+		self.thread_id = threading.get_ident() if thread_id is None else thread_id
+		self.interval = interval
+		self.samples = 0
+		self.idle_samples = 0
+		# key -> samples with the function at the top of the stack
+		self.self_counts = collections.Counter()
+		# key -> samples with the function anywhere on the stack
+		self.total_counts = collections.Counter()
+		# (caller key, callee key) -> samples
+		self.call_counts = collections.Counter()
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self._thread.join()
+
+	def _run(self):
+		while not self._stopped.wait(self.interval):
+			frame = sys._current_frames().get(self.thread_id)
+			if frame is not None:
+				self._sample(frame)
+
+	def _sample(self, frame):
+		self.samples += 1
+		if _is_idle(frame):
+			self.idle_samples += 1
+			return
+
+		self.self_counts[_key(frame.f_code)] += 1
+		seen = set()
+		callee = None
+		while frame is not None:
+			key = _key(frame.f_code)
+			# recursive functions are only counted once per sample
+			if key not in seen:
+				seen.add(key)
+				self.total_counts[key] += 1
+			if callee is not None:
+				self.call_counts[key, callee] += 1
+			callee = key
+			frame = frame.f_back
+
+	def top(self, n):
+		"""the n functions that the most samples were taken in, as (key, self samples, total samples)"""
+		return [(key, count, self.total_counts[key]) for key, count in self.self_counts.most_common(n)]
+
+	def pstats(self):
+		"""The samples in the format written by cProfile, for pstats, snakeviz etc.
+		Call counts are sample counts, and times are estimated from them.
+		"""
+		callers = collections.defaultdict(dict)
+		for (caller, callee), count in self.call_counts.items():
+			callers[callee][caller] = count, count, 0.0, count * self.interval
+
+		stats = {}
+		for key, total in self.total_counts.items():
+			count = self.self_counts[key]
+			stats[key] = total, total, count * self.interval, total * self.interval, callers[key]
+		return marshal.dumps(stats)
+
+	def format(self, n):
+		busy = self.samples - self.idle_samples
+		lines = [
+			f'{self.samples} samples, {busy} ({busy / max(self.samples, 1):.0%}) busy',
+			f'{"self":>6} {"total":>6}  function',
+		]
+		for key, count, total in self.top(n):
+			lines.append(f'{count / busy:6.1%} {total / busy:6.1%}  {_label(key)}')
+		return '\n'.join(lines)
+
+class LagMonitor:
+	"""Measures how late the event loop is to wake up a task that sleeps for interval seconds at a time."""
+
+	def __init__(self, *, interval=0.05):
+		self.interval = interval
+		self.lags = []
+		self._task = None
+
+	def start(self):
+		self._task = asyncio.ensure_future(self._run())
+
+	async def stop(self):
+		self._task.cancel()
+		await asyncio.gather(self._task, return_exceptions=True)
+
+	async def _run(self):
+		while True:
+			started = time.perf_counter()
+			await asyncio.sleep(self.interval)
+			self.lags.append(time.perf_counter() - started - self.interval)
+
+	def format(self):
+		if not self.lags:
+			return 'event loop lag: no samples'
+		lags = sorted(self.lags)
+		p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+		return (
+			f'event loop lag: mean {sum(lags) / len(lags) * 1000:.1f}ms, '
+			f'p99 {p99 * 1000:.1f}ms, max {lags[-1] * 1000:.1f}ms'
+		)
+
+async def profile_cpu(seconds, *, interval=0.005):
+	"""Sample the event loop's thread for seconds. Returns (Sampler, LagMonitor)."""
+	sampler = Sampler(interval=interval)
+	lag = LagMonitor()
+	sampler.start()
+	lag.start()
+	try:
+		await asyncio.sleep(seconds)
+	finally:
+		await lag.stop()
+		sampler.stop()
+	return sampler, lag
+
+async def profile_memory(seconds, n, *, frames=1):
+	"""Compare tracemalloc snapshots taken seconds apart.
+	Returns a description of the n sites that allocated the most, and a LagMonitor.
+	"""
+	started_tracing = not tracemalloc.is_tracing()
+	if started_tracing:
+		tracemalloc.start(frames)
+	lag = LagMonitor()
+	try:
+		before = _snapshot()
+		lag.start()
+		try:
+			await asyncio.sleep(seconds)
+		finally:
+			await lag.stop()
+		after = _snapshot()
+	finally:
+		if started_tracing:
+			tracemalloc.stop()
+
+	diff = after.compare_to(before, 'lineno')
+	lines = [
+		f'{sum(stat.size_diff for stat in diff) / 1024:+.1f} KiB in total, '
+		f'{sum(stat.size for stat in diff) / 1024 / 1024:.1f} MiB traced',
+		f'{"change":>10} {"blocks":>7}  site',
+	]
+	for stat in diff[:n]:
+		frame = stat.traceback[0]
+		line = linecache.getline(frame.filename, frame.lineno).strip()
+		lines.append(f'{stat.size_diff / 1024:+9.1f}K {stat.count_diff:+7d}  {os.path.basename(frame.filename)}:{frame.lineno}')
+		if line:
+			lines.append(f'{"":>19}{line}')
+	return '\n'.join(lines), lag
+
+def _snapshot():
+	return tracemalloc.take_snapshot().filter_traces((
+		tracemalloc.Filter(False, tracemalloc.__file__),
+		tracemalloc.Filter(False, linecache.__file__),
+		tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+	))
+
+def pstats_file(sampler, name='profile.pstats'):
+	"""the sampler's pstats data as a file to upload"""
+	f = io.BytesIO(sampler.pstats())
+	f.name = name
+	return f
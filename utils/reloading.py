@@ -0,0 +1,61 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib
+import importlib.util
+import os.path
+import sys
+
+# these only define functions and constants, so nothing is lost by running them again.
+# the rest of utils defines the classes of objects that live as long as the bot does (and metrics, which can only be
+# registered once), so changes to them still need a restart.
+# dependencies come first, so that what imports them gets the new versions.
+RELOADABLE_MODULES = ['utils.shout', 'utils', 'utils.profiling']
+
+def reload_utils():
+	for name in RELOADABLE_MODULES:
+		importlib.reload(sys.modules[name])
+	from utils import shout
+	# so that the first message afterwards doesn't wait for them
+	shout.is_shout_many(())
+
+def load_again(module):
+	"""Run module's file again as a new module, and return that.
+	The old module is left alone, since its functions may still be running.
+	"""
+	name = module.__name__
+	if name in ('__main__', '__mp_main__'):
+		# it was run as a script, and must not be run as one again
+		name = os.path.splitext(os.path.basename(module.__file__))[0]
+	spec = importlib.util.spec_from_file_location(name, module.__file__)
+	new = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(new)
+	sys.modules[name] = new
+	return new
+
+def reload_functions(functions):
+	"""Reload the utils modules and the modules the values of the dict functions come from,
+	and replace each function with its new version, in place.
+	"""
+	reload_utils()
+	modules = {}
+	new = {}
+	for key, f in functions.items():
+		module = sys.modules[f.__module__]
+		if module not in modules:
+			modules[module] = load_again(module)
+		new[key] = getattr(modules[module], f.__name__)
+	# only once everything has loaded, so that a mistake leaves the old ones in use
+	functions.update(new)
@@ -13,6 +13,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
 
+import re
+
+from . import unicode_properties
+
 IGNORED_WORDS = frozenset({
 	'OK',
 	'XD',
@@ -27,23 +31,113 @@ IGNORED_WORDS = frozenset({
 	'TIL',
 })
 
-def is_shout(str):
-	# This import is done here because this is the __init__ file,
-	# which is run when utils.shout.gen_derived_core_properties is run.
-	# If this import were at the top level, the code generator would not be able to run
-	# without the file that it generates.
-	from .derived_core_properties import DEFAULT_IGNORABLE
+# code points outside of planes 0 and 1 are never uppercase or whitespace, so there's no need to check them
+_TABLE_LIMIT = 0x20000
+# long messages are classified this many characters at a time, so that we can stop once the verdict is decided
+_CHUNK_SIZE = 1024
+
+_non_ascii = re.compile('[^\x00-\x7f]+')
+
+# per code point classes, filled in by _load_tables
+_upper = _ignorable = _ascii_upper = _ascii_ignorable = None
+
+def _load_tables():
+	global _upper, _ignorable, _ascii_upper, _ascii_ignorable
+
+	upper = set()
+	ignorable = set(unicode_properties.get('Default_Ignorable_Code_Point'))
+	for c in map(chr, range(_TABLE_LIMIT)):
+		if c.isupper():
+			upper.add(c)
+		elif c.isspace():
+			ignorable.add(c)
+
+	_upper = frozenset(upper)
+	_ignorable = frozenset(ignorable)
+	# for bytes.translate
+	_ascii_upper = bytes(i for i in range(0x80) if chr(i) in upper)
+	_ascii_ignorable = bytes(i for i in range(0x80) if chr(i) in ignorable)
+
+def _count(str):
+	"""Return the number of uppercase characters in str,
+	and the number of characters that are neither whitespace nor default ignorable.
+	"""
+	# ASCII is by far the most common, and can be counted entirely in C
+	is_ascii = str.isascii()
+	# encoding without an error handler is quicker, when there's nothing to leave out
+	ascii = str.encode() if is_ascii else str.encode('ascii', 'ignore')
+	upper = len(ascii) - len(ascii.translate(None, _ascii_upper))
+	length = len(ascii.translate(None, _ascii_ignorable))
 
+	if not is_ascii:
+		rest = ''.join(_non_ascii.findall(str))
+		upper += sum(map(_upper.__contains__, rest))
+		length += len(rest) - sum(map(_ignorable.__contains__, rest))
+
+	return upper, length
+
+def is_shout(str):
 	if str in IGNORED_WORDS:
 		return False
 
-	length = len(str)
-	count = 0
+	if _upper is None:
+		_load_tables()
 
-	for c in str:
-		if c.isspace() or c in DEFAULT_IGNORABLE:
-			length -= 1
-		if c.isupper():
-			count += 1
+	# more than half of the characters that aren't whitespace or default ignorable must be uppercase
+	total = len(str)
+	if total <= _CHUNK_SIZE:
+		# most messages are short enough that there's nothing to stop early for
+		upper, length = _count(str)
+		return length > 1 and upper > length - upper
+
+	upper = length = 0
+	for start in range(0, total, _CHUNK_SIZE):
+		chunk_upper, chunk_length = _count(str[start:start + _CHUNK_SIZE])
+		upper += chunk_upper
+		length += chunk_length
+
+		remaining = total - start - _CHUNK_SIZE
+		if remaining <= 0:
+			break
+		# stop as soon as the rest of the message can't change the verdict
+		other = length - upper
+		if upper > other + remaining:
+			return True
+		if other >= upper + remaining:
+			return False
+
+	return length > 1 and upper > length - upper
+
+def is_shout_many(strs):
+	"""Classify many strings at once. Returns a list of booleans, in the same order as strs."""
+	if _upper is None:
+		_load_tables()
+
+	# is_shout and _count inlined, with everything they look up for each string looked up once
+	ignored = IGNORED_WORDS
+	ascii_upper = _ascii_upper
+	ascii_ignorable = _ascii_ignorable
+	is_upper = _upper.__contains__
+	is_ignorable = _ignorable.__contains__
+	non_ascii = _non_ascii.findall
+	results = []
+	append = results.append
+	for str in strs:
+		if str in ignored:
+			append(False)
+			continue
+		if len(str) > _CHUNK_SIZE:
+			# worth stopping early for
+			append(is_shout(str))
+			continue
 
-	return length > 1 and count / length > 0.5
+		is_ascii = str.isascii()
+		ascii = str.encode() if is_ascii else str.encode('ascii', 'ignore')
+		upper = len(ascii) - len(ascii.translate(None, ascii_upper))
+		length = len(ascii.translate(None, ascii_ignorable))
+		if not is_ascii:
+			rest = ''.join(non_ascii(str))
+			upper += sum(map(is_upper, rest))
+			length += len(rest) - sum(map(is_ignorable, rest))
+		append(length > 1 and upper > length - upper)
+	return results
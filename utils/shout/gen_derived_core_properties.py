@@ -17,29 +17,40 @@
 
 import functools
 import itertools
+import sys
 from pathlib import Path
 
 here = Path(__file__).parent
 properties_path = here / 'DerivedCoreProperties.txt'
 
+# properties generated when none are given on the command line
+DEFAULT_PROPERTIES = 'Default_Ignorable_Code_Point', 'Uppercase', 'Lowercase', 'Cased'
+
 # if the amount of shadowing builtins that i do bothers you, please fix your syntax highlighter / linter
 
-def get_derived_core_properties():
-	properties = {}
+def get_property_ranges(properties):
+	"""Return a dict of property name to a sorted list of non-overlapping, non-adjacent [start, stop) ranges."""
+	ranges = {property: [] for property in properties}
 
 	with open(properties_path) as f:
 		for property, range in parse_properties(f):
-			properties.setdefault(property, set()).update(map(chr, range))
+			if property in ranges:
+				ranges[property].append((range.start, range.stop))
 
-	return {property: frozenset(chars) for property, chars in properties.items()}
+	return {property: merge_ranges(property_ranges) for property, property_ranges in ranges.items()}
 
-def get_derived_core_property(property):
-	desired = property
+def merge_ranges(ranges):
+	merged = []
+	for start, stop in sorted(ranges):
+		if merged and start <= merged[-1][1]:
+			merged[-1][1] = max(merged[-1][1], stop)
+		else:
+			merged.append([start, stop])
+	return merged
 
+def get_version():
 	with open(properties_path) as f:
-		for property, range in parse_properties(f):
-			if property == desired:
-				yield from map(chr, range)
+		return f.readline().lstrip('#').strip()
 
 def parse_properties(f):
 	for line in map(str.strip, f):
@@ -62,13 +73,27 @@ hex_to_int = functools.partial(int, base=16)
 def inclusive_range(start, stop=None, step=1):
 	return range(start, start + 1 if stop is None else stop + 1, step)
 
-def main():
+def constant_name(property):
+	return property.upper()
+
+def main(properties=DEFAULT_PROPERTIES):
+	ranges = get_property_ranges(properties)
+	missing = [property for property, property_ranges in ranges.items() if not property_ranges]
+	if missing:
+		raise SystemExit(f'unknown properties: {", ".join(missing)}')
+
 	with open(here / 'derived_core_properties.py', 'w') as f:
-		f.write('# generated by gen_derived_core_properties.py\n')
-		f.write("DEFAULT_IGNORABLE = frozenset('")
-		for c in get_derived_core_property('Default_Ignorable_Code_Point'):
-			f.write(c)
-		f.write("')\n")
+		f.write(f'# generated by gen_derived_core_properties.py from {get_version()}\n')
+		f.write('# Each property is a sorted array of the bounds [start, stop, start, stop, ...] of the ranges of\n')
+		f.write('# code points that have it. Use utils.shout.unicode_properties rather than importing this directly.\n\n')
+		f.write('from array import array\n')
+
+		for property, property_ranges in ranges.items():
+			f.write(f"\n{constant_name(property)} = array('I', (\n")
+			bounds = [bound for range in property_ranges for bound in range]
+			for i in range(0, len(bounds), 8):
+				f.write('\t' + ' '.join(f'{bound:#x},' for bound in bounds[i:i + 8]) + '\n')
+			f.write('))\n')
 
 if __name__ == '__main__':
-	main()
+	main(sys.argv[1:] or DEFAULT_PROPERTIES)
@@ -0,0 +1,69 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Membership tests for the Unicode derived core properties generated by gen_derived_core_properties.py.
+
+>>> '\N{soft hyphen}' in get('Default_Ignorable_Code_Point')
+True
+"""
+
+import bisect
+import functools
+
+class CodePointRanges:
+	"""A set of code points, stored as the sorted bounds of the ranges they make up."""
+
+	__slots__ = 'bounds', 'ascii'
+
+	def __init__(self, bounds):
+		# bisecting a list is faster than bisecting an array, which has to box every element it looks at
+		self.bounds = list(bounds)
+		# most lookups are ASCII, so those skip the bisection
+		self.ascii = frozenset(c for c in map(chr, range(0x80)) if self._bisect(c))
+
+	def _bisect(self, c, bisect_right=bisect.bisect_right):
+		# the bounds alternate between starts and stops, so we're inside a range iff we're after a start
+		return bisect_right(self.bounds, ord(c)) & 1 == 1
+
+	def __contains__(self, c):
+		if c < '\x80':
+			return c in self.ascii
+		return self._bisect(c)
+
+	def ranges(self):
+		bounds = iter(self.bounds)
+		return [range(start, stop) for start, stop in zip(bounds, bounds)]
+
+	def __iter__(self):
+		for range in self.ranges():
+			yield from map(chr, range)
+
+	def __len__(self):
+		return sum(map(len, self.ranges()))
+
+@functools.lru_cache(maxsize=None)
+def get(property):
+	"""Return the CodePointRanges for the named property, e.g. 'Uppercase'.
+	The tables aren't loaded until the first time this is called.
+	"""
+	# imported here so that gen_derived_core_properties can run without the file it generates
+	from . import derived_core_properties
+	from .gen_derived_core_properties import constant_name
+
+	try:
+		bounds = getattr(derived_core_properties, constant_name(property))
+	except AttributeError:
+		raise LookupError(f'{property} was not generated. Run gen_derived_core_properties.py {property}') from None
+	return CodePointRanges(bounds)
@@ -0,0 +1,169 @@
+# Copyright © 2020 Io Mintz <io@mintz.cc>
+#
+# CAPTAIN CAPSLOCK is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CAPTAIN CAPSLOCK is distributed in the hope that it will be fun,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with CAPTAIN CAPSLOCK.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import logging
+import time
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+class _Worker:
+	__slots__ = 'queue', 'task', 'lag', 'queued', 'handled', 'dropped', 'done', 'skipped', 'waiters'
+
+	def __init__(self, queue_size):
+		self.queue = asyncio.Queue(queue_size)
+		self.task = None
+		# how long the most recently started job waited in the queue
+		self.lag = 0.0
+		# jobs submitted, counting the ones still waiting for room in the queue
+		self.queued = 0
+		self.handled = 0
+		self.dropped = 0
+		# jobs handled or dropped, in the order they were submitted
+		self.done = 0
+		# the numbers of dropped jobs that haven't been counted in done yet, because jobs submitted before them haven't been
+		self.skipped = set()
+		# (number of jobs done, future to resolve once that many have been), oldest first
+		self.waiters = collections.deque()
+
+	def until_handled(self, n):
+		"""wait until the first n jobs submitted have been handled or dropped"""
+		if self.done >= n:
+			return None
+		future = asyncio.get_event_loop().create_future()
+		self.waiters.append((n, future))
+		return future
+
+	def finish(self):
+		self.handled += 1
+		self.done += 1
+		self._wake()
+
+	def skip(self, number):
+		"""count the job that was submitted number'th as done once every job submitted before it is"""
+		self.dropped += 1
+		if number <= self.done:
+			# a job submitted after it was queued first, and has been counted in its place
+			self.done += 1
+		else:
+			self.skipped.add(number)
+		self._wake()
+
+	def _wake(self):
+		while self.done + 1 in self.skipped:
+			self.skipped.remove(self.done + 1)
+			self.done += 1
+		while self.waiters and self.waiters[0][0] <= self.done:
+			_, future = self.waiters.popleft()
+			if not future.done():
+				future.set_result(None)
+
+class ChatWorkers:
+	"""Runs jobs on a fixed number of worker tasks, each with its own queue.
+	Jobs are assigned to workers by chat ID, so each chat's jobs run in order,
+	while one slow chat only holds up the chats that share its worker.
+
+	Jobs for no chat in particular (such as deletions that telegram doesn't say the chat of) run on a worker of their
+	own, each once every job that was queued for a chat before it has run.
+	"""
+
+	def __init__(self, *, workers=16, queue_size=256, backpressure_timeout=1.0):
+		self.workers = [_Worker(queue_size) for _ in range(workers)]
+		self.any_chat_worker = _Worker(queue_size)
+		# how long submit waits for room in a full queue before dropping the job
+		self.backpressure_timeout = backpressure_timeout
+
+	def _all_workers(self):
+		return [*self.workers, self.any_chat_worker]
+
+	def start(self):
+		for worker in self._all_workers():
+			worker.task = asyncio.ensure_future(self._work(worker))
+
+	async def submit(self, chat_id, f, *args):
+		"""Queue f(*args) to be run on the chat's worker, or after every chat's queued jobs if chat_id is None.
+		Returns whether it was queued.
+		If the worker's queue is full, wait for room, then give up and drop the job.
+		"""
+		if chat_id is None:
+			worker = self.any_chat_worker
+			marks = [(worker, worker.queued) for worker in self.workers]
+		else:
+			worker = self.workers[chat_id % len(self.workers)]
+			marks = None
+		job = time.monotonic(), f, args, marks
+		# counted before waiting for room, so that jobs for no chat submitted in the meantime wait for this one too
+		worker.queued += 1
+		number = worker.queued
+		try:
+			worker.queue.put_nowait(job)
+		except asyncio.QueueFull:
+			try:
+				await asyncio.wait_for(worker.queue.put(job), self.backpressure_timeout)
+			except asyncio.TimeoutError:
+				worker.skip(number)
+				metrics.JOBS_DROPPED.inc()
+				logger.warning(
+					'Dropped a job for chat %s: worker %d has been full for %s seconds (%d dropped so far)',
+					chat_id, self._all_workers().index(worker), self.backpressure_timeout, worker.dropped,
+				)
+				return False
+			except asyncio.CancelledError:
+				worker.skip(number)
+				raise
+		return True
+
+	async def _work(self, worker):
+		while True:
+			queued_at, f, args, marks = await worker.queue.get()
+			for other, mark in marks or ():
+				future = other.until_handled(mark)
+				if future is not None:
+					await future
+			started = time.monotonic()
+			worker.lag = started - queued_at
+			metrics.WORKER_LAG_SECONDS.observe(worker.lag)
+			try:
+				await f(*args)
+			except Exception:
+				logger.exception('Unhandled exception in %s', getattr(f, '__qualname__', f))
+			finally:
+				metrics.HANDLER_SECONDS.labels(getattr(f, '__name__', 'other')).observe(time.monotonic() - started)
+				worker.queue.task_done()
+				worker.finish()
+
+	def queued(self):
+		return sum(worker.queue.qsize() for worker in self._all_workers())
+
+	def stats(self):
+		"""a list of (queue depth, lag in seconds, jobs handled, jobs dropped) for each worker,
+		the last being the one for jobs for no chat in particular
+		"""
+		return [(worker.queue.qsize(), worker.lag, worker.handled, worker.dropped) for worker in self._all_workers()]
+
+	async def close(self, timeout=10):
+		"""Finish the jobs that are already queued (waiting at most timeout seconds), then stop the workers."""
+		try:
+			await asyncio.wait_for(asyncio.gather(*(worker.queue.join() for worker in self._all_workers())), timeout)
+		except asyncio.TimeoutError:
+			logger.warning('Gave up waiting for %d queued jobs', self.queued())
+
+		for worker in self._all_workers():
+			if worker.task is not None:
+				worker.task.cancel()
+		await asyncio.gather(*(worker.task for worker in self._all_workers() if worker.task), return_exceptions=True)